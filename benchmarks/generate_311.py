@@ -0,0 +1,167 @@
+# Synthetic Boston 311 data
+#
+# Writes a CSV with the column set of the city's 311 export. The data is
+# seeded, so the same seed and row count always give the same file.
+# Cardinalities and skew are close to the real feed: a few case types,
+# departments and locations account for most cases.
+#
+#   python benchmarks/generate_311.py --rows 1000000 --output benchmarks/data/311_1m.csv
+
+# imports
+import argparse
+import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+
+# settings
+chunk_rows = 500_000            # rows generated and written at a time, memory stays flat for any size
+start_ts = np.datetime64('2015-01-01T00:00:00')
+span_seconds = 10 * 365 * 24 * 3600
+
+# columns in the order of the city export
+columns = [
+    '_id', 'case_enquiry_id', 'open_dt', 'sla_target_dt', 'closed_dt', 'on_time', 'case_status',
+    'closure_reason', 'case_title', 'subject', 'reason', 'type', 'queue', 'department',
+    'submitted_photo', 'closed_photo', 'location', 'fire_district', 'pwd_district',
+    'city_council_district', 'police_district', 'neighborhood', 'neighborhood_services_district',
+    'ward', 'precinct', 'location_street_name', 'location_zipcode', 'latitude', 'longitude',
+    'geom_4326', 'source',
+]
+
+neighborhoods = [
+    'Dorchester', 'Roxbury', 'South Boston / South Boston Waterfront', 'Jamaica Plain', 'Allston / Brighton',
+    'Back Bay', 'East Boston', 'Downtown / Financial District', 'South End', 'Hyde Park', 'Roslindale',
+    'West Roxbury', 'Charlestown', 'Mattapan', 'Beacon Hill', 'Fenway / Kenmore / Audubon Circle / Longwood',
+    'Mission Hill', 'Greater Mattapan', 'Boston', 'Chestnut Hill', 'Brighton', 'Allston',
+]
+departments = ['PWDx', 'BTDT', 'ISD', 'PARK', 'INFO', 'PROP', 'BWSC', 'GEN_', 'ANML', 'DISB', 'BPS_', 'ONS_', 'BHA_', 'CAFE']
+sources = ['Citizens Connect App', 'Constituent Call', 'City Worker App', 'Self Service', 'Employee Generated', 'Twitter', 'Email', 'Maximo Integration']
+subjects = ['Public Works Department', 'Transportation - Traffic Division', 'Inspectional Services', 'Parks & Recreation Department',
+            "Mayor's 24 Hour Hotline", 'Property Management', 'Boston Water & Sewer Commission', 'Animal Control']
+closure_reasons = ['Case Resolved', 'Case Noted', 'Case Invalid', 'Duplicate of Existing Case', 'Case Resolved. Issue addressed']
+streets = ['Washington St', 'Dorchester Ave', 'Blue Hill Ave', 'Massachusetts Ave', 'Columbia Rd', 'Tremont St',
+           'Commonwealth Ave', 'Centre St', 'Boylston St', 'Hyde Park Ave', 'Beacon St', 'Cambridge St']
+
+n_types = 220
+n_queues = 160
+n_locations = 180_000
+
+
+# Function to draw zipf-like skewed indexes in [0, n)
+def skewed(rng, n, size, a=1.3):
+    ranks = np.arange(1, n + 1, dtype=np.float64)
+    weights = ranks ** -a
+    return rng.choice(n, size=size, p=weights / weights.sum())
+
+# Function to build the fixed lookup tables (locations, case types) from the seed
+def build_dimensions(rng):
+    type_department = skewed(rng, len(departments), n_types, a=1.0)
+    type_queue = rng.integers(0, n_queues, n_types)
+    loc_neighborhood = skewed(rng, len(neighborhoods), n_locations, a=0.6)
+    loc_street = rng.integers(0, len(streets), n_locations)
+    loc_number = rng.integers(1, 2000, n_locations)
+    return {
+        'location': np.array([f"{num} {streets[s]}  Boston  MA  02{100 + s:03d}" for num, s in zip(loc_number, loc_street)], dtype=object),
+        'location_street_name': np.array([f"{num} {streets[s]}" for num, s in zip(loc_number, loc_street)], dtype=object),
+        'location_zipcode': np.array([f"02{100 + s:03d}" for s in loc_street], dtype=object),
+        'neighborhood_idx': loc_neighborhood,
+        'ward': rng.integers(1, 23, n_locations),
+        'precinct': rng.integers(1, 20, n_locations),
+        'latitude': 42.23 + rng.random(n_locations) * 0.17,
+        'longitude': -71.18 + rng.random(n_locations) * 0.19,
+        'type_subject': rng.integers(0, len(subjects), n_types),
+        'type_department': type_department,
+        'type_queue': np.array([f"{departments[d]}_Queue {q}" for d, q in zip(type_department, type_queue)], dtype=object),
+        'type_sla_hours': rng.choice([24, 48, 72, 120, 240, 720], n_types),
+    }
+
+# Function to generate one chunk of rows as an arrow table
+def generate_chunk(rng, dims, first_id, rows, total_rows):
+    ids = np.arange(first_id, first_id + rows)
+    type_idx = skewed(rng, n_types, rows, a=1.1)
+    loc_idx = skewed(rng, n_locations, rows, a=0.9)
+    nb_idx = dims['neighborhood_idx'][loc_idx]
+
+    # case ids and open times grow with _id, like the real feed
+    lo = (first_id - 1) * span_seconds // total_rows
+    hi = max(lo + 1, (first_id - 1 + rows) * span_seconds // total_rows)
+    open_s = np.sort(rng.integers(lo, hi, rows))
+    open_dt = start_ts + open_s.astype('timedelta64[s]')
+    sla_dt = open_dt + (dims['type_sla_hours'][type_idx] * 3600).astype('timedelta64[s]')
+    closed_mask = rng.random(rows) < 0.86
+    close_hours = rng.lognormal(mean=3.0, sigma=1.6, size=rows)
+    closed_dt = open_dt + (close_hours * 3600).astype('timedelta64[s]')
+
+    def fmt(values, mask=None):
+        text = np.datetime_as_string(values, unit='s')
+        text = np.char.replace(text.astype(str), 'T', ' ')
+        out = text.astype(object)
+        if mask is not None:
+            out[~mask] = None
+        return out
+
+    on_time = np.where(closed_mask, closed_dt <= sla_dt, rng.random(rows) < 0.5)
+    dept = np.array(departments, dtype=object)[dims['type_department'][type_idx]]
+    nbh = np.array(neighborhoods, dtype=object)[nb_idx]
+
+    data = {
+        '_id': ids,
+        'case_enquiry_id': 101000000000 + ids,
+        'open_dt': fmt(open_dt),
+        'sla_target_dt': fmt(sla_dt),
+        'closed_dt': fmt(closed_dt, closed_mask),
+        'on_time': np.where(on_time, 'ONTIME', 'OVERDUE').astype(object),
+        'case_status': np.where(closed_mask, 'Closed', 'Open').astype(object),
+        'closure_reason': np.where(closed_mask, np.array(closure_reasons, dtype=object)[skewed(rng, len(closure_reasons), rows)], ' ').astype(object),
+        'case_title': np.array([f"Case type {t}" for t in range(n_types)], dtype=object)[type_idx],
+        'subject': np.array(subjects, dtype=object)[dims['type_subject'][type_idx]],
+        'reason': np.array([f"Reason {t % 45}" for t in range(n_types)], dtype=object)[type_idx],
+        'type': np.array([f"Type {t}" for t in range(n_types)], dtype=object)[type_idx],
+        'queue': dims['type_queue'][type_idx],
+        'department': dept,
+        'submitted_photo': np.where(rng.random(rows) < 0.25, 'https://spot-boston-res.cloudinary.com/image/upload/photo.jpg', None).astype(object),
+        'closed_photo': np.where(rng.random(rows) < 0.1, 'https://spot-boston-res.cloudinary.com/image/upload/closed.jpg', None).astype(object),
+        'location': dims['location'][loc_idx],
+        'fire_district': (nb_idx % 12 + 1).astype(str).astype(object),
+        'pwd_district': np.array(['1A', '1B', '1C', '02', '03', '04', '05', '06', '07', '08', '09', '10A', '10B'], dtype=object)[nb_idx % 13],
+        'city_council_district': (nb_idx % 9 + 1).astype(str).astype(object),
+        'police_district': np.array(['A1', 'A7', 'B2', 'B3', 'C6', 'C11', 'D4', 'D14', 'E5', 'E13', 'E18'], dtype=object)[nb_idx % 11],
+        'neighborhood': nbh,
+        'neighborhood_services_district': (nb_idx % 15 + 1).astype(str).astype(object),
+        'ward': np.array([f"Ward {w}" for w in range(23)], dtype=object)[dims['ward'][loc_idx]],
+        'precinct': np.array([f"{p:04d}" for p in range(2300)], dtype=object)[dims['ward'][loc_idx] * 100 + dims['precinct'][loc_idx]],
+        'location_street_name': dims['location_street_name'][loc_idx],
+        'location_zipcode': dims['location_zipcode'][loc_idx],
+        'latitude': dims['latitude'][loc_idx],
+        'longitude': dims['longitude'][loc_idx],
+        'geom_4326': np.full(rows, None, dtype=object),
+        'source': np.array(sources, dtype=object)[skewed(rng, len(sources), rows, a=1.2)],
+    }
+    return pa.table({col: data[col] for col in columns})
+
+# Function to write a synthetic 311 CSV with the given number of rows
+def generate(output, rows, seed=882):
+    rng = np.random.default_rng(seed)
+    dims = build_dimensions(rng)
+    writer = None
+    written = 0
+    try:
+        while written < rows:
+            batch = generate_chunk(rng, dims, written + 1, min(chunk_rows, rows - written), rows)
+            if writer is None:
+                writer = pacsv.CSVWriter(output, batch.schema)
+            writer.write_table(batch)
+            written += batch.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic Boston 311 CSV")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=882)
+    parser.add_argument("--output", required=True)
+    args = parser.parse_args()
+    print(f"{generate(args.output, args.rows, args.seed)} rows written to {args.output}")
@@ -0,0 +1,166 @@
+# Local HTTP stand-in for the data portal
+#
+# Serves the files of a directory the way the extract downloader expects from
+# data.boston.gov: ETag / Last-Modified validators with 304 answers, single
+# byte ranges (with If-Range) and gzip for whole-file requests. Ranges and
+# gzip can be switched off, and the ETags made weak, to try the fallbacks,
+# and a per-connection rate limit makes the effect of parallel ranges visible
+# on one machine.
+#
+#   python benchmarks/http_standin.py benchmarks/data --port 8000 --rate-mbps 20
+#   EXTRACT_CSV_URL=http://localhost:8000/311_1000000.csv python flows/etl.py
+
+# imports
+import argparse
+import functools
+import gzip
+import os
+import re
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+# settings
+write_bytes = 64 * 1024     # bytes read from the file per write
+gzip_level = 6
+
+
+# Writer that holds a connection to a bandwidth, on the bytes that go over the wire
+class RateLimitedWriter:
+    def __init__(self, f, rate_bytes):
+        self.f = f
+        self.rate_bytes = rate_bytes
+
+    def write(self, data):
+        self.f.write(data)
+        if self.rate_bytes:
+            time.sleep(len(data) / self.rate_bytes)
+        return len(data)
+
+    def flush(self):
+        self.f.flush()
+
+
+# Request handler serving files with validators, ranges and gzip
+class StandInHandler(SimpleHTTPRequestHandler):
+    ranges = True
+    gzip = True
+    weak_etags = False
+    rate_bytes = None       # bytes per second per connection, None for no limit
+
+    # Function to answer GET and HEAD for a file of the directory
+    def send_file(self, body):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, "File not found")
+            return
+        stat = os.stat(path)
+        etag = f'"{int(stat.st_mtime)}-{stat.st_size}"'
+        if self.weak_etags:
+            etag = "W/" + etag
+        last_modified = formatdate(int(stat.st_mtime), usegmt=True)
+
+        if self.not_modified(etag, stat.st_mtime):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+            self.end_headers()
+            return
+
+        start, end, status = 0, stat.st_size - 1, 200
+        requested = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        # If-Range only matches a strong validator
+        if_range_matches = if_range is None or (not if_range.startswith("W/") and if_range in (etag, last_modified))
+        if self.ranges and requested and if_range_matches:
+            start = int(requested.group(1))
+            end = min(int(requested.group(2) or end), end)
+            if start > end:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{stat.st_size}")
+                self.end_headers()
+                return
+            status = 206
+
+        compress = status == 200 and self.gzip and "gzip" in self.headers.get("Accept-Encoding", "")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/csv")
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{stat.st_size}")
+        if compress:
+            # compressed on the fly, the length is not known up front
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Connection", "close")
+            self.close_connection = True
+        else:
+            self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+
+        with open(path, "rb") as f:
+            f.seek(start)
+            wire = RateLimitedWriter(self.wfile, self.rate_bytes)
+            out = gzip.GzipFile(fileobj=wire, mode="wb", compresslevel=gzip_level) if compress else wire
+            remaining = end - start + 1
+            while remaining > 0:
+                data = f.read(min(write_bytes, remaining))
+                if not data:
+                    break
+                out.write(data)
+                remaining -= len(data)
+            if compress:
+                out.close()
+
+    # Function to check the conditional headers against the file's validators
+    def not_modified(self, etag, mtime):
+        if self.headers.get("If-None-Match"):
+            return self.headers["If-None-Match"] == etag
+        if self.headers.get("If-Modified-Since"):
+            try:
+                return int(mtime) <= parsedate_to_datetime(self.headers["If-Modified-Since"]).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def do_GET(self):
+        try:
+            self.send_file(body=True)
+        except (BrokenPipeError, ConnectionResetError):
+            # the client read what it needed, e.g. the downloader's one-byte probe
+            pass
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+
+# Function to start the stand-in on a port, serving a directory until stopped
+def serve(directory, port=8000, ranges=True, use_gzip=True, rate_mbps=None, weak_etags=False):
+    handler = type("Handler", (StandInHandler,), {
+        'ranges': ranges,
+        'gzip': use_gzip,
+        'weak_etags': weak_etags,
+        'rate_bytes': rate_mbps * 1e6 / 8 if rate_mbps else None,
+    })
+    server = ThreadingHTTPServer(("127.0.0.1", port), functools.partial(handler, directory=directory))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve CSV files with ETags, byte ranges and gzip like the data portal")
+    parser.add_argument("directory")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--no-ranges", action="store_true", help="ignore Range headers, like a server without range support")
+    parser.add_argument("--no-gzip", action="store_true", help="never compress")
+    parser.add_argument("--weak-etags", action="store_true", help="send weak ETags, which If-Range cannot use")
+    parser.add_argument("--rate-mbps", type=float, default=None, help="bandwidth limit per connection")
+    args = parser.parse_args()
+
+    server = serve(args.directory, args.port, not args.no_ranges, not args.no_gzip, args.rate_mbps, args.weak_etags)
+    print(f"Serving {os.path.abspath(args.directory)} on http://127.0.0.1:{args.port}/")
+    server.serve_forever()
@@ -0,0 +1,189 @@
+# Benchmark harness
+#
+# Runs extract, transform and load on synthetic 311 data against the local
+# backend (a local DuckDB file and a local directory, see flows/backends.py)
+# and records wall time, rows/sec and peak RSS for each stage. Every stage
+# runs in its own process so the peak RSS is the stage's own. Results are
+# written to benchmarks/results/<timestamp>.json.
+#
+#   python benchmarks/run_benchmarks.py --rows 100000 1000000
+#   python benchmarks/run_benchmarks.py --compare benchmarks/results/a.json benchmarks/results/b.json
+
+# imports
+import argparse
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, os.path.join(repo_dir, "flows"))
+sys.path.insert(0, bench_dir)
+
+import backends
+import generate_311
+
+# settings
+data_dir = os.path.join(bench_dir, "data")
+results_dir = os.path.join(bench_dir, "results")
+
+# stage -> function source directory, entry point and the payload it is called with
+# (transform and load get the previous stage's response)
+stages = {
+    'extract': ('extract', 'main'),
+    'transform': ('transform', 'main'),
+    'load': ('load', 'main'),
+}
+extract_payload = {'mode': 'stream', 'format': 'parquet'}
+
+
+# Function to read the peak RSS of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+# Function to count the rows a stage worked on, from its response
+def stage_rows(stage, response):
+    if stage == 'extract':
+        return response['total_records']
+    if stage == 'transform':
+        return sum(response['rows'].values())
+    return sum(table['raw_rows'] for table in response['tables'].values())
+
+# Function to run one stage in this process, called in the child process
+def run_stage(stage, workdir, csv_path, max_records):
+    backends.configure_local(os.path.join(workdir, "local"), csv_url=csv_path)
+    source, entry_point = stages[stage]
+    module = backends.load_function(source)
+
+    if stage == 'extract':
+        module.max_records = max_records
+        payload = extract_payload
+    else:
+        previous = list(stages)[list(stages).index(stage) - 1]
+        with open(os.path.join(workdir, f"{previous}.json")) as f:
+            payload = json.load(f)['response']
+
+    if stage == 'load':
+        # the stage tables have to exist, not part of the timing
+        backends.load_function('schema-setup').task(backends.LocalRequest({}))
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    response = getattr(module, entry_point)(backends.LocalRequest(payload))
+    seconds = time.perf_counter() - start
+    response = response[0] if isinstance(response, tuple) else response
+    response = json.loads(json.dumps(response, default=str))
+
+    rows = stage_rows(stage, response)
+    metrics = {
+        'stage': stage,
+        'rows': rows,
+        'seconds': round(seconds, 3),
+        'rows_per_sec': round(rows / seconds) if seconds else None,
+        'peak_rss_mb': peak_rss_mb(),
+        'baseline_rss_mb': baseline,
+    }
+    with open(os.path.join(workdir, f"{stage}.json"), "w") as f:
+        json.dump({'response': response, 'metrics': metrics}, f)
+
+# Function to make (or reuse) the synthetic CSV for a size
+def ensure_csv(rows, seed):
+    os.makedirs(data_dir, exist_ok=True)
+    path = os.path.join(data_dir, f"311_{rows}_{seed}.csv")
+    if not os.path.exists(path):
+        print(f"generating {rows} rows into {path}")
+        generate_311.generate(path, rows, seed)
+    return path
+
+# Function to run every stage for one size, each in a fresh process
+def run_size(rows, seed, max_records):
+    csv_path = ensure_csv(rows, seed)
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for stage in stages:
+            subprocess.run([
+                sys.executable, os.path.abspath(__file__),
+                '--stage', stage, '--workdir', workdir, '--csv', csv_path,
+                '--max-records', str(max_records if max_records is not None else rows),
+            ], check=True, stdout=subprocess.DEVNULL)
+            with open(os.path.join(workdir, f"{stage}.json")) as f:
+                metrics = json.load(f)['metrics']
+            metrics['dataset_rows'] = rows
+            results.append(metrics)
+            print(f"{rows:>10} {stage:<10} {metrics['seconds']:>9.2f}s {metrics['rows_per_sec'] or 0:>12} rows/s {metrics['peak_rss_mb']:>9} MB")
+    return results
+
+# Function to describe the environment the numbers came from
+def environment():
+    import duckdb
+    import pandas
+    import pyarrow
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'git_commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'duckdb': duckdb.__version__,
+        'pandas': pandas.__version__,
+        'pyarrow': pyarrow.__version__,
+    }
+
+# Function to print stage-by-stage changes between two result files
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {(r['dataset_rows'], r['stage']): r for r in json.load(f)['results']}
+    with open(after_path) as f:
+        after = {(r['dataset_rows'], r['stage']): r for r in json.load(f)['results']}
+    print(f"{'rows':>10} {'stage':<10} {'seconds':>18} {'speedup':>8} {'peak MB':>18}")
+    for key in sorted(before.keys() & after.keys()):
+        b, a = before[key], after[key]
+        speedup = b['seconds'] / a['seconds'] if a['seconds'] else float('inf')
+        print(f"{key[0]:>10} {key[1]:<10} {b['seconds']:>8.2f} -> {a['seconds']:>6.2f} {speedup:>7.2f}x "
+              f"{b['peak_rss_mb']:>8} -> {a['peak_rss_mb']:>6}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark extract, transform and load on synthetic 311 data")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--seed", type=int, default=882)
+    parser.add_argument("--max-records", type=int, default=None,
+                        help="rows extract keeps, default is all of them")
+    parser.add_argument("--output", default=None, help="results file, default benchmarks/results/<timestamp>.json")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    # internal: run a single stage in this process
+    parser.add_argument("--stage", choices=list(stages), help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--csv", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.stage:
+        run_stage(args.stage, args.workdir, args.csv, args.max_records)
+    else:
+        results = []
+        for rows in args.rows:
+            results.extend(run_size(rows, args.seed, args.max_records))
+
+        output = args.output or os.path.join(
+            results_dir, datetime.datetime.now().strftime('%Y%m%d-%H%M%S') + ".json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({
+                'created_at': datetime.datetime.now().isoformat(),
+                'seed': args.seed,
+                'environment': environment(),
+                'results': results,
+            }, f, indent=2)
+        print(f"results written to {output}")
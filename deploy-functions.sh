@@ -6,17 +6,33 @@
 # setup the project
 gcloud config set project group2-ba882
 
+# functions that import the shared modules are deployed from a build copy
+# with functions/shared placed next to their main.py
+src_dir=/home/gunjan21/BA882-311_Service_Requests/functions
+build_dir=/tmp/ba882-functions-build
+
+stage_function() {
+    rm -rf $build_dir/$1
+    mkdir -p $build_dir
+    cp -r $src_dir/$1 $build_dir/$1
+    cp -r $src_dir/shared $build_dir/$1/shared
+}
+
+# functions are deployed under the names the flows call (flows/etl.py and friends)
+
 # schema setup
 echo "======================================================"
 echo "deploying the schema setup"
 echo "======================================================"
 
-gcloud functions deploy group2-schema-setup \
+stage_function schema-setup
+
+gcloud functions deploy dev-schema-setupclear \
     --gen2 \
     --runtime python311 \
     --trigger-http \
     --entry-point task \
-    --source /home/gunjan21/BA882-311_Service_Requests/functions/schema-setup \
+    --source $build_dir/schema-setup \
     --stage-bucket group2-ba882-project \
     --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
     --region us-central1 \
@@ -28,12 +44,33 @@ echo "======================================================"
 echo "deploying the rss extractor"
 echo "======================================================"
 
-gcloud functions deploy group2-extract-rss \
+stage_function extract
+
+gcloud functions deploy dev-extract-rss \
     --gen2 \
     --runtime python311 \
     --trigger-http \
-    --entry-point task \
-    --source /home/gunjan21/BA882-311_Service_Requests/functions/extract-rss \
+    --entry-point main \
+    --source $build_dir/extract \
+    --stage-bucket group2-ba882-project \
+    --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 512MB 
+
+# split the extract output into the stage tables
+echo "======================================================"
+echo "deploying the transform"
+echo "======================================================"
+
+stage_function transform
+
+gcloud functions deploy dev-parse-rss \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point main \
+    --source $build_dir/transform \
     --stage-bucket group2-ba882-project \
     --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
     --region us-central1 \
@@ -45,14 +82,75 @@ echo "======================================================"
 echo "deploying the loader"
 echo "======================================================"
 
-gcloud functions deploy group2-load-rss \
+stage_function load
+
+gcloud functions deploy dev-load-rss \
     --gen2 \
     --runtime python311 \
     --trigger-http \
-    --entry-point task \
-    --source /home/gunjan21/BA882-311_Service_Requests/functions/load-rss \
+    --entry-point main \
+    --source $build_dir/load \
+    --stage-bucket group2-ba882-project \
+    --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 512MB 
+
+# merge the small per-run files of the extract partitions
+echo "======================================================"
+echo "deploying the compaction"
+echo "======================================================"
+
+stage_function compact
+
+gcloud functions deploy dev-compact-feed \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point main \
+    --source $build_dir/compact \
+    --stage-bucket group2-ba882-project \
+    --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 1GB 
+
+# keep the dashboard rollups up to date after each load
+echo "======================================================"
+echo "deploying the rollups"
+echo "======================================================"
+
+stage_function rollup
+
+gcloud functions deploy dev-rollup-stage \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point main \
+    --source $build_dir/rollup \
+    --stage-bucket group2-ba882-project \
+    --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
+    --region us-central1 \
+    --allow-unauthenticated \
+    --memory 1GB
+
+# serve the named read queries to the dashboards
+echo "======================================================"
+echo "deploying the query function"
+echo "======================================================"
+
+stage_function query
+
+gcloud functions deploy dev-query-stage \
+    --gen2 \
+    --runtime python311 \
+    --trigger-http \
+    --entry-point main \
+    --source $build_dir/query \
     --stage-bucket group2-ba882-project \
     --service-account group2-ba882@group2-ba882.iam.gserviceaccount.com \
     --region us-central1 \
     --allow-unauthenticated \
-    --memory 512MB 
\ No newline at end of file
+    --concurrency 8 \
+    --cpu 1 \
+    --memory 1GB
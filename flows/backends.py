@@ -0,0 +1,80 @@
+# Execution backends for the ETL flow
+#
+# cloud - POST to the deployed Cloud Functions (the default)
+# local - import each function's main.py and call its entry point in this
+#         process, against a local DuckDB file and a local directory in place
+#         of MotherDuck and the GCS bucket, so a run can be timed and profiled
+#         on one machine
+
+# imports
+import importlib.util
+import json
+import os
+import sys
+
+# settings
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+functions_dir = os.path.join(repo_dir, "functions")
+
+# deployed function name (last part of the URL) -> source directory and entry point
+local_functions = {
+    'dev-schema-setupclear': ('schema-setup', 'task'),
+    'dev-extract-rss': ('extract', 'main'),
+    'dev-parse-rss': ('transform', 'main'),
+    'dev-load-rss': ('load', 'main'),
+    'dev-compact-feed': ('compact', 'main'),
+    'dev-rollup-stage': ('rollup', 'main'),
+    'dev-query-stage': ('query', 'main'),
+}
+
+_modules = {}
+
+
+# Minimal stand-in for the flask request the functions framework passes in
+class LocalRequest:
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_json(self, silent=False):
+        return self.payload
+
+
+# Function to point the functions at local stand-ins, call before the first local invoke
+# the functions read these settings when they are imported
+def configure_local(local_dir, csv_url=None):
+    local_dir = os.path.abspath(local_dir)
+    os.makedirs(local_dir, exist_ok=True)
+    os.environ.setdefault("ETL_LOCAL_DIR", local_dir)
+    os.environ.setdefault("ETL_DUCKDB_PATH", os.path.join(local_dir, "city_services_boston.duckdb"))
+    if csv_url:
+        os.environ["EXTRACT_CSV_URL"] = csv_url
+
+# Function to make functions/shared importable the way it is inside a deployed function
+def add_functions_path():
+    if functions_dir not in sys.path:
+        sys.path.insert(0, functions_dir)
+
+# Function to import a function's main.py under its own module name
+def load_function(source):
+    if source not in _modules:
+        add_functions_path()
+        spec = importlib.util.spec_from_file_location(
+            f"ba882_{source.replace('-', '_')}", os.path.join(functions_dir, source, "main.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        _modules[source] = module
+    return _modules[source]
+
+# Function to call a function's entry point in process, same contract as invoke_gcf
+def invoke_local(url, payload):
+    source, entry_point = local_functions[url.rstrip("/").rsplit("/", 1)[-1]]
+    handler = getattr(load_function(source), entry_point)
+    result = handler(LocalRequest(payload))
+
+    # functions return either a body or a (body, status) tuple
+    body, status = result if isinstance(result, tuple) else (result, 200)
+    if status >= 400:
+        raise Exception(f"{source} failed with status {status}: {body}")
+
+    # round-trip through json like the HTTP response would
+    return json.loads(json.dumps(body, default=str))
@@ -0,0 +1,234 @@
+# The historical backfill
+#
+# Boston publishes the 311 history as one CKAN resource per year. The backfill
+# treats every resource as a shard and works the shards in a process pool.
+# Each shard streams its CSV in chunks through the function code (imported in
+# process, like fused.py): the chunk is written to the partitioned feed layout,
+# split into the stage tables and loaded. After every chunk a checkpoint is
+# saved, so an interrupted backfill restarts at the first chunk that was not
+# loaded. A semaphore shared by the processes caps the loads running at once.
+# The dashboard rollups are rebuilt once at the end.
+#
+#   python flows/backfill.py                         # every yearly resource
+#   python flows/backfill.py --years 2019 2020       # some of them
+#   python flows/backfill.py --csv /data/311_2019.csv /data/311_2020.csv
+
+# imports
+import argparse
+import multiprocessing
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import duckdb
+import requests
+from prefect import flow
+import backends
+from etl import performance_report, publish_report
+
+# "cloud" targets MotherDuck and GCS, "local" the stand-ins from backends.py
+backend = os.environ.get("ETL_BACKEND", "cloud")
+local_dir = os.environ.get("ETL_LOCAL_DIR", os.path.join(backends.repo_dir, ".local"))
+
+# the CKAN dataset the extract csv_url belongs to, its resources are listed through the API
+ckan_api = "https://data.boston.gov/api/3/action/package_show"
+dataset_id = "8048697b-ad64-4bfc-b090-ee00169f2323"
+
+# backfill settings
+workers = 4             # shards streamed at the same time
+max_loads = 2           # loads writing to MotherDuck at the same time (one for a local DuckDB file)
+chunk_rows = 250000     # rows per chunk, the unit of work and of checkpointing
+load_retries = 3        # loads retried on write conflicts between shards
+checkpoint_prefix = "boston_data/_backfill"
+
+# per worker process: the semaphore shared by every worker
+_load_slots = None
+
+
+# Function to list the yearly CSV resources of the dataset, year -> url
+def discover_resources(years=None):
+    response = requests.get(ckan_api, params={'id': dataset_id}, timeout=60)
+    response.raise_for_status()
+    shards = {}
+    for resource in response.json()['result']['resources']:
+        match = re.search(r"\b(20\d\d)\b", resource.get('name', ''))
+        if resource.get('format', '').upper() == 'CSV' and match:
+            shards[match.group(1)] = resource['url']
+    if years:
+        shards = {year: url for year, url in shards.items() if year in years}
+    return dict(sorted(shards.items()))
+
+# Function to name shards after local files, by the year in the file name when there is one
+def shards_from_paths(paths):
+    shards = {}
+    for path in paths:
+        match = re.search(r"(20\d\d)", os.path.basename(path))
+        shards[match.group(1) if match else os.path.splitext(os.path.basename(path))[0]] = path
+    return dict(sorted(shards.items()))
+
+# Function to build the checkpoint path of a shard
+def checkpoint_uri(storage_io, bucket_name, backfill_id, shard):
+    return storage_io.bucket_uri(bucket_name, f"{checkpoint_prefix}/{backfill_id}/{shard}.json")
+
+# Function to set up a worker process
+def init_worker(load_slots):
+    global _load_slots
+    _load_slots = load_slots
+    backends.add_functions_path()
+
+# Function to load one chunk, holding a load slot; retried when shards collide on the same keys
+def load_chunk(load, connections, tables, tm, raw_suffix, job_id):
+    with _load_slots:
+        for attempt in range(load_retries + 1):
+            try:
+                md = connections.get_motherduck()
+                # no key filter: shards do not overlap, and with loads running side by side it would be rebuilt every chunk
+                return load.load_tables(md, tables, tm, raw_suffix=raw_suffix, job_id=job_id, use_key_filter=False)
+            except duckdb.TransactionException as e:
+                if attempt == load_retries:
+                    raise
+                print(f"Write conflict, retrying the load: {str(e)}")
+                time.sleep(2 ** attempt)
+            finally:
+                # a local DuckDB file can only be open in one process at a time
+                if backend == "local":
+                    connections.reset_motherduck()
+
+# Function to stream one shard through extract, transform and load, chunk by chunk, in a worker process
+def run_shard(backfill_id, shard, url, write_feed=True):
+    import pandas as pd
+    extract = backends.load_function("extract")
+    transform = backends.load_function("transform")
+    load = backends.load_function("load")
+    from shared import connections, storage_io, telemetry
+
+    tms = {stage: telemetry.Telemetry(stage) for stage in ('extract', 'transform', 'load')}
+    checkpoint_path = checkpoint_uri(storage_io, extract.bucket_name, backfill_id, shard)
+    checkpoint = extract.read_state(checkpoint_path) or {'shard': shard, 'url': url, 'chunks_done': 0, 'rows_done': 0}
+    if checkpoint.get('status') == 'done':
+        return {'shard': shard, 'status': 'skipped', 'rows': checkpoint['rows_done'], 'telemetry': {}}
+
+    start = time.perf_counter()
+    raw_suffix = "_" + re.sub(r"\W", "_", shard)
+    response = extract.stream_csv(url)
+    try:
+        # every column as text so all chunks of all shards get the same schema, transform types them
+        stream = telemetry.TimedReader(response.raw)
+        reader = pd.read_csv(stream, chunksize=chunk_rows, dtype=str,
+                             skiprows=range(1, checkpoint['rows_done'] + 1))
+        chunk_index = checkpoint['chunks_done']
+        while True:
+            # the parser pulls the bytes, the time inside the stream's reads is the download
+            read_seconds, read_bytes, parse_start = stream.seconds, stream.bytes, time.perf_counter()
+            df = next(reader, None)
+            download_seconds = stream.seconds - read_seconds
+            tms['extract'].record('download', download_seconds, bytes=stream.bytes - read_bytes, chunk=chunk_index)
+            tms['extract'].record('parse', time.perf_counter() - parse_start - download_seconds,
+                                  rows_out=0 if df is None else len(df), chunk=chunk_index)
+            if df is None:
+                break
+
+            job_id = f"backfill-{shard}-{chunk_index:05d}"
+            df = extract.stamp_extracted_at(df)
+            with tms['extract'].phase('serialize', rows_in=len(df), detail='arrow') as phase:
+                feed = extract.to_arrow_table(df)
+                phase['rows_out'] = feed.num_rows
+            if write_feed:
+                extract.write_partitions(df, feed, job_id, 'parquet', tms['extract'])
+
+            con = duckdb.connect()
+            tables = transform.split_arrow(con, feed, tms['transform'])
+            con.close()
+
+            load_chunk(load, connections, tables, tms['load'], raw_suffix, job_id)
+
+            chunk_index += 1
+            checkpoint.update({'chunks_done': chunk_index, 'rows_done': checkpoint['rows_done'] + len(df)})
+            extract.write_state(checkpoint_path, checkpoint)
+            print(f"{shard}: chunk {chunk_index} loaded, {checkpoint['rows_done']} rows so far")
+    finally:
+        response.close()
+
+    # the shard's raw tables are not needed any more
+    with _load_slots:
+        md = connections.get_motherduck()
+        for spec in load.table_specs:
+            if spec['raw_table'] is None:
+                continue
+            load.clear_raw_table(md, f"{load.raw_db_schema}.{spec['raw_table']}{raw_suffix}")
+        if backend == "local":
+            connections.reset_motherduck()
+
+    checkpoint['status'] = 'done'
+    extract.write_state(checkpoint_path, checkpoint)
+    return {
+        'shard': shard,
+        'status': 'done',
+        'rows': checkpoint['rows_done'],
+        'seconds': round(time.perf_counter() - start, 3),
+        'telemetry': {stage: tm.report() for stage, tm in tms.items()},
+    }
+
+# Prefect Flow
+@flow(name="etl-backfill-flow", log_prints=True)
+def backfill_flow(shards: dict, backfill_id: str = "history", workers: int = workers, max_loads: int = max_loads, write_feed: bool = True):
+    """Load the 311 history, one shard per yearly resource, resumable from per-chunk checkpoints"""
+
+    # the stage tables and the raw schema exist before any shard loads
+    backends.add_functions_path()
+    from shared import connections, schema_registry, telemetry
+    load = backends.load_function("load")
+    md = connections.get_motherduck()
+    schema_registry.migrate(md)
+    load.prepare_raw_schema(md)
+    load.fill_existing_rows(md)
+    connections.reset_motherduck()
+
+    if backend == "local":
+        max_loads = 1
+
+    # spawn, not fork: the parent already holds duckdb threads
+    context = multiprocessing.get_context("spawn")
+    load_slots = context.BoundedSemaphore(max_loads)
+    results = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                             initializer=init_worker, initargs=(load_slots,)) as pool:
+        futures = {pool.submit(run_shard, backfill_id, shard, url, write_feed): shard for shard, url in shards.items()}
+        for future in as_completed(futures):
+            result = future.result()
+            results.append(result)
+            print(f"{result['shard']}: {result['status']}, {result['rows']} rows")
+
+    # the rollups are rebuilt once over the whole history rather than after every chunk
+    rollup = backends.load_function("rollup")
+    rollup_tm = telemetry.Telemetry('rollup')
+    md = connections.get_motherduck()
+    rolled_up = rollup.rebuild_rollups(md, rollup_tm)
+    connections.reset_motherduck()
+    print(f"Rollups rebuilt: {rolled_up}")
+
+    # one report over every shard
+    responses = {'rollup': {'telemetry': rollup_tm.report()}}
+    for result in results:
+        for stage, phases in result.pop('telemetry').items():
+            responses.setdefault(stage, {'telemetry': []})['telemetry'].extend(phases)
+    report = performance_report(responses, {})
+    publish_report(report)
+    return {'shards': sorted(results, key=lambda r: r['shard']), 'rollup': rolled_up, 'performance': report}
+
+
+# the job
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Backfill the 311 history, one shard per yearly resource")
+    parser.add_argument("--years", nargs="+", help="only these years of the published resources")
+    parser.add_argument("--csv", nargs="+", help="local CSV files (or URLs) instead of the published resources")
+    parser.add_argument("--backfill-id", default="history", help="checkpoints are kept per backfill id, a new id starts over")
+    parser.add_argument("--workers", type=int, default=workers)
+    parser.add_argument("--max-loads", type=int, default=max_loads)
+    parser.add_argument("--no-feed", action="store_true", help="do not write the chunks to the partitioned feed layout")
+    args = parser.parse_args()
+
+    if backend == "local":
+        backends.configure_local(local_dir)
+    shards = shards_from_paths(args.csv) if args.csv else discover_resources(args.years)
+    backfill_flow(shards, args.backfill_id, args.workers, args.max_loads, not args.no_feed)
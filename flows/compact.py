@@ -0,0 +1,54 @@
+# The compaction job
+#
+# Merges the small per-run files in the partitions of the extract output into
+# larger ones (see functions/compact), then has load rewrite stage.locations
+# in geohash order (a load only sorts the rows of its own batch). Served on a
+# daily schedule: every extract run adds one small file to each month it
+# touches, so an incremental run that reaches back into old months adds files
+# there too.
+
+# imports
+import os
+from prefect import flow, task
+from etl import invoke_gcf, retry_settings, backend, local_dir
+import backends
+
+# every day at 03:00, outside the ETL runs
+compaction_cron = os.environ.get("ETL_COMPACTION_CRON", "0 3 * * *")
+
+
+@task(**retry_settings)
+def compact(partitions=None):
+    """Merge the small files of the extract partitions"""
+    url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-compact-feed"
+    payload = {} if partitions is None else {'partitions': partitions}
+    resp = invoke_gcf(url, payload=payload)
+    return resp
+
+@task(**retry_settings)
+def recluster():
+    """Rewrite stage.locations in geohash order"""
+    url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-load-rss"
+    resp = invoke_gcf(url, payload={'recluster': True})
+    return resp
+
+# Prefect Flow
+@flow(name="feed-compaction-flow", log_prints=True)
+def compaction_flow(partitions: list | None = None):
+    """Compact the partitioned extract output"""
+    result = compact(partitions)
+    print(f"{len(result['compacted'])} merged files written")
+    for merged in result['compacted']:
+        print(f"{merged['partition']}: {len(merged['replaced'])} files, {merged['rows']} rows")
+    reclustered = recluster()
+    print(f"stage.locations rewritten in geohash order: {reclustered['reclustered']['locations']} rows")
+    return {**result, 'reclustered': reclustered['reclustered']}
+
+
+# the job
+if __name__ == "__main__":
+    if backend == "local":
+        backends.configure_local(local_dir)
+        compaction_flow()
+    else:
+        compaction_flow.serve(name="feed-compaction", cron=compaction_cron)
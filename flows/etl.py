@@ -2,64 +2,226 @@
 
 # imports
 import requests
+from requests.adapters import HTTPAdapter
 import json
+import os
+from datetime import timedelta
 from prefect import flow, task
+from prefect.artifacts import create_table_artifact
+from prefect.tasks import exponential_backoff
+import backends
+
+# "cloud" calls the deployed functions, "local" runs them in this process (see backends.py)
+backend = os.environ.get("ETL_BACKEND", "cloud")
+local_dir = os.environ.get("ETL_LOCAL_DIR", os.path.join(backends.repo_dir, ".local"))
+
+# http settings
+connect_timeout = 10    # seconds to open the connection
+read_timeout = 540      # seconds to wait for the function, gen2 functions time out after 9 minutes
+pool_size = 10
+
+# task retries: exponential backoff (10s, 20s, 40s) with jitter so retries do not line up
+retry_settings = {
+    'retries': 3,
+    'retry_delay_seconds': exponential_backoff(backoff_factor=10),
+    'retry_jitter_factor': 0.5,
+}
+
+# caching of transform and load on the content hash of the extract output
+code_version = "1"      # bump when transform or load logic changes, old cache entries stop matching
+cache_expiration = timedelta(hours=float(os.environ.get("ETL_CACHE_EXPIRATION_HOURS", "24")))
+result_storage = os.environ.get("ETL_RESULT_STORAGE")   # storage block slug, e.g. "gcs-bucket/etl-cache"; local storage if unset
+
+cache_settings = {
+    'persist_result': True,
+    'result_storage': result_storage,
+    'cache_expiration': cache_expiration,
+}
+
+# cache key: step + backend + content hash of the extracted data + code version, no caching without a hash
+def content_cache_key(context, parameters):
+    content_hash = parameters['payload'].get('content_hash')
+    if not content_hash:
+        return None
+    return f"{context.task.name}-{backend}-{content_hash}-{code_version}"
+
+# one pooled session shared by every call, connections to the functions are kept alive
+session = requests.Session()
+session.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
 
 # helper function - generic invoker
 def invoke_gcf(url:str, payload:dict):
-    response = requests.post(url, json=payload)
-    response.raise_for_status()
+    if backend == "local":
+        return backends.invoke_local(url, payload)
+    response = session.post(url, json=payload, timeout=(connect_timeout, read_timeout))
+    if response.status_code >= 400:
+        # the body says what failed, e.g. the per-table status of a load
+        raise Exception(f"{url} failed with status {response.status_code}: {response.text[:2000]}")
     return response.json()
 
 
-@task(retries=2)
+# Function to combine the telemetry every function returned into one per-run report
+# one line per stage and phase, phases recorded more than once (per table) are summed,
+# so load phases that ran in parallel can add up to more than the load's wall time
+def performance_report(responses, cache_hits):
+    lines = {}
+    for stage, response in responses.items():
+        for record in (response or {}).get('telemetry', []):
+            line = lines.setdefault((record['stage'], record['phase']), {
+                'stage': record['stage'],
+                'phase': record['phase'],
+                'cached': cache_hits.get(stage, False),
+                'calls': 0,
+                'seconds': 0.0,
+                'rows_in': 0,
+                'rows_out': 0,
+                'bytes': 0,
+                'peak_rss_mb': 0.0,
+            })
+            line['calls'] += 1
+            line['seconds'] = round(line['seconds'] + record['seconds'], 4)
+            for field in ('rows_in', 'rows_out', 'bytes'):
+                line[field] += record.get(field) or 0
+            line['peak_rss_mb'] = max(line['peak_rss_mb'], record.get('peak_rss_mb') or 0.0)
+
+    stages = {}
+    for line in lines.values():
+        total = stages.setdefault(line['stage'], {'seconds': 0.0, 'peak_rss_mb': 0.0, 'cached': line['cached']})
+        total['seconds'] = round(total['seconds'] + line['seconds'], 4)
+        total['peak_rss_mb'] = max(total['peak_rss_mb'], line['peak_rss_mb'])
+    return {'phases': list(lines.values()), 'stages': stages}
+
+# Function to print the report and keep it as a table artifact on the flow run
+def publish_report(report):
+    print(f"{'stage':<14} {'phase':<14} {'calls':>5} {'seconds':>10} {'rows in':>10} {'rows out':>10} {'MB':>9} {'peak MB':>9}")
+    for line in report['phases']:
+        cached = " (cached)" if line['cached'] else ""
+        print(f"{line['stage']:<14} {line['phase']:<14} {line['calls']:>5} {line['seconds']:>10.3f} "
+              f"{line['rows_in']:>10} {line['rows_out']:>10} {line['bytes'] / 1e6:>9.1f} {line['peak_rss_mb']:>9.1f}{cached}")
+    if report['phases']:
+        create_table_artifact(key="etl-performance", table=report['phases'], description="Per-phase performance of this run")
+
+
+# Function to print the status of every table of the load and keep it as a table artifact
+# 'loaded' now, 'skipped' when an earlier attempt of the same job had loaded it already
+def publish_load_status(load_result):
+    rows = [{'table': name, **result} for name, result in load_result.get('tables', {}).items()]
+    for row in rows:
+        print(f"{row['table']:<24} {row.get('status', 'loaded'):<8} {row.get('raw_rows') or 0:>10} raw rows {row.get('inserted_rows') or 0:>10} upserted")
+    if rows:
+        create_table_artifact(key="etl-load-tables", table=rows, description="Per-table status of the load")
+
+
+@task(**retry_settings)
 def schema_setup():
     """Setup the stage schema"""
     url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-schema-setupclear"
     resp = invoke_gcf(url, payload={})
     return resp
 
-@task(retries=2)
+@task(**retry_settings)
 def extract():
     """Extract the RSS feeds into JSON on GCS"""
     url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-extract-rss"
-    resp = invoke_gcf(url, payload={})
+    resp = invoke_gcf(url, payload={"incremental": True, "format": "parquet"})
     return resp
 
-@task(retries=2)
+@task(**retry_settings)
+def save_extract_state(state):
+    """Save the incremental state of the extract run, once its rows are loaded"""
+    url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-extract-rss"
+    resp = invoke_gcf(url, payload={"commit_state": state})
+    return resp
+
+@task(**retry_settings, **cache_settings, cache_key_fn=content_cache_key)
 def transform(payload):
     """Process the RSS feed JSON into parquet on GCS"""
     url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-parse-rss"
     resp = invoke_gcf(url, payload=payload)
     return resp
 
-@task(retries=2)
+@task(**retry_settings, **cache_settings, cache_key_fn=content_cache_key)
 def load(payload):
-    """Load the tables into the raw schema, ingest new records into stage tables"""
+    """Load the tables into the raw schema, ingest new records into stage tables; a retry skips the tables already loaded"""
     url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-load-rss"
     resp = invoke_gcf(url, payload=payload)
     return resp
 
+@task(**retry_settings)
+def rollup(payload):
+    """Update the dashboard rollups from the records the load inserted or changed"""
+    url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-rollup-stage"
+    resp = invoke_gcf(url, payload=payload)
+    return resp
+
 # Prefect Flow
 @flow(name="aws-blogs-etl-flow", log_prints=True)
-def etl_flow():
+def etl_flow(concurrent: bool = True):
     """The ETL flow which orchestrates Cloud Functions"""
 
-    result = schema_setup()
-    print("The schema setup completed")
-    
-    extract_result = extract()
+    # the responses of every function, their telemetry goes into the performance report
+    responses = {}
+    cache_hits = {}
+
+    if concurrent:
+        # the schema setup and the extract do not depend on each other
+        schema_future = schema_setup.submit()
+        extract_result = extract.submit().result()
+    else:
+        schema_future = None
+        responses['schema_setup'] = schema_setup()
+        print("The schema setup completed")
+        extract_result = extract()
+    responses['extract'] = extract_result
+
     print("The RSS feeds were extracted onto GCS")
     print(f"{extract_result}")
-    
-    transform_result = transform(extract_result)
+
+    if extract_result.get("total_records", 0) == 0:
+        if schema_future is not None:
+            responses['schema_setup'] = schema_future.result()
+        print("No new or changed records, skipping transform and load")
+        report = performance_report(responses, cache_hits)
+        publish_report(report)
+        return {'cache_hits': cache_hits, 'performance': report}
+
+    # transform and load are skipped when the same data was already processed
+    transform_state = transform(extract_result, return_state=True)
+    cache_hits['transform'] = transform_state.name == "Cached"
+    transform_result = transform_state.result()
+    responses['transform'] = transform_result
     print("The parsing of the feeds into tables completed")
     print(f"{transform_result}")
 
-    result = load(transform_result)
+    # load needs the stage tables, join on the schema setup here
+    if schema_future is not None:
+        responses['schema_setup'] = schema_future.result()
+        print("The schema setup completed")
+
+    load_state = load(transform_result, return_state=True)
+    cache_hits['load'] = load_state.name == "Cached"
+    responses['load'] = load_state.result()
     print("The data were loaded into the raw schema and changes added to stage")
+    publish_load_status(responses['load'])
+
+    # the watermark only moves once the rows are in stage, a failed run extracts them again
+    if extract_result.get('state'):
+        save_extract_state(extract_result['state'])
+        print("The extract state was saved")
+
+    # a cached load changed nothing, the rollups are still current
+    if not cache_hits['load']:
+        responses['rollup'] = rollup({})
+        print(f"The rollups were updated: {responses['rollup']['update']}")
+
+    print(f"Cache hits: {cache_hits}")
+    report = performance_report(responses, cache_hits)
+    publish_report(report)
+    return {'cache_hits': cache_hits, 'performance': report}
 
 
 # the job
 if __name__ == "__main__":
-    etl_flow()
\ No newline at end of file
+    if backend == "local":
+        backends.configure_local(local_dir)
+    etl_flow()
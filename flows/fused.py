@@ -0,0 +1,109 @@
+# The fused ETL job
+#
+# Extract, transform and load run in this one process and hand the data to
+# each other as Arrow tables. Nothing has to be written to GCS and read back
+# between the steps, and there are no function hops; the bucket only gets
+# audit copies when asked for. Meant for the frequent small incremental runs,
+# where serialization and hop overhead dominate.
+
+# imports
+import os
+import time
+import duckdb
+import pyarrow.parquet as pq
+from prefect import flow
+import backends
+from etl import performance_report, publish_report
+
+# "cloud" targets MotherDuck and GCS, "local" the stand-ins from backends.py
+backend = os.environ.get("ETL_BACKEND", "cloud")
+local_dir = os.environ.get("ETL_LOCAL_DIR", os.path.join(backends.repo_dir, ".local"))
+
+
+# Function to write an arrow table as an audit copy in the bucket
+def write_audit_copy(storage_io, table, uri):
+    with storage_io.open_uri(uri, 'wb', content_type='application/vnd.apache.parquet') as f:
+        pq.write_table(table, f, compression='zstd')
+    return uri
+
+# Prefect Flow
+@flow(name="etl-fused-flow", log_prints=True)
+def fused_etl_flow(incremental: bool = True, audit: bool = False):
+    """Extract, transform and load in one process, passing Arrow tables between the steps"""
+
+    # the function code, imported in process
+    extract = backends.load_function("extract")
+    transform = backends.load_function("transform")
+    load = backends.load_function("load")
+    rollup = backends.load_function("rollup")
+    from shared import connections, schema_registry, storage_io, telemetry
+
+    timings = {}
+    tms = {stage: telemetry.Telemetry(stage) for stage in ('schema_setup', 'extract', 'transform', 'load', 'rollup')}
+
+    start = time.perf_counter()
+    md = connections.get_motherduck()
+    with tms['schema_setup'].phase('ddl'):
+        schema_registry.migrate(md)
+    timings['schema_setup'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    df, state, status = extract.extract_records({'incremental': incremental}, tms['extract'])
+    if status != 'ok':
+        print(f"Nothing to load: {status}")
+        return {'status': status, 'timings': timings}
+    df = extract.stamp_extracted_at(df)
+    with tms['extract'].phase('serialize', rows_in=len(df), detail='arrow') as phase:
+        feed = extract.to_arrow_table(df)
+        phase['rows_out'] = feed.num_rows
+    job_id = extract.new_job_id()
+    timings['extract'] = round(time.perf_counter() - start, 3)
+
+    # the feed audit copy uses the partitioned layout of the extract function, with a manifest
+    audit_paths = {}
+    if audit:
+        start = time.perf_counter()
+        manifest, audit_paths['manifest'] = extract.write_partitions(df, feed, job_id, 'parquet', tms['extract'])
+        timings['audit'] = round(time.perf_counter() - start, 3)
+    del df
+    print(f"Extracted {feed.num_rows} records for job {job_id}")
+
+    start = time.perf_counter()
+    con = duckdb.connect()
+    tables = transform.split_arrow(con, feed, tms['transform'])
+    con.close()
+    timings['transform'] = round(time.perf_counter() - start, 3)
+    print(f"Split into {', '.join(f'{name}: {table.num_rows}' for name, table in tables.items())}")
+
+    if audit:
+        start = time.perf_counter()
+        for name, table in tables.items():
+            audit_paths[name] = write_audit_copy(storage_io, table, storage_io.bucket_uri(extract.bucket_name, f"boston_data/{job_id}/tables/{name}.parquet"))
+        timings['audit'] += round(time.perf_counter() - start, 3)
+    del feed
+
+    start = time.perf_counter()
+    load.prepare_raw_schema(md, tms['load'])
+    load.fill_existing_rows(md, tms['load'])
+    loaded = load.load_tables(md, tables, tms['load'], job_id=job_id)
+    timings['load'] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    rolled_up = rollup.update_rollups(md, tms['rollup'])
+    timings['rollup'] = round(time.perf_counter() - start, 3)
+
+    # the watermark only moves once the rows are in stage
+    if state is not None:
+        extract.write_state(extract.state_path, state)
+
+    print(f"Timings: {timings}")
+    report = performance_report({stage: {'telemetry': tm.report()} for stage, tm in tms.items()}, {})
+    publish_report(report)
+    return {'status': 'ok', 'jobid': job_id, 'tables': loaded, 'rollup': rolled_up, 'timings': timings, 'audit': audit_paths, 'performance': report}
+
+
+# the job
+if __name__ == "__main__":
+    if backend == "local":
+        backends.configure_local(local_dir)
+    fused_etl_flow()
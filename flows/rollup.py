@@ -0,0 +1,46 @@
+# The rollup reconcile job
+#
+# Checks the incrementally maintained dashboard rollups against a full
+# recompute from the stage tables (see functions/rollup) and rebuilds them
+# when they differ. Served on a weekly schedule.
+
+# imports
+import os
+from prefect import flow, task
+from etl import invoke_gcf, retry_settings, backend, local_dir
+import backends
+
+# every Sunday at 04:00, after the compaction
+reconcile_cron = os.environ.get("ETL_RECONCILE_CRON", "0 4 * * 0")
+
+
+@task(**retry_settings)
+def reconcile(repair=True):
+    """Compare the rollups with a full recompute, rebuild them when they differ"""
+    url = "https://us-central1-ba882-group2-project.cloudfunctions.net/dev-rollup-stage"
+    resp = invoke_gcf(url, payload={'reconcile': True, 'repair': repair})
+    return resp
+
+# Prefect Flow
+@flow(name="rollup-reconcile-flow", log_prints=True)
+def reconcile_flow(repair: bool = True):
+    """Reconcile the dashboard rollups"""
+    result = reconcile(repair)
+    checked = result['reconcile']
+    print(f"{checked['mismatched_groups']} of {checked['groups']} rollup groups differ from a full recompute")
+    if checked.get('requests_without_location'):
+        print(f"{checked['requests_without_location']} requests have no location, they are counted in neighborhood 0")
+    for mismatch in checked['mismatches']:
+        print(mismatch)
+    if 'rebuild' in result:
+        print(f"Rollups rebuilt: {result['rebuild']}")
+    return result
+
+
+# the job
+if __name__ == "__main__":
+    if backend == "local":
+        backends.configure_local(local_dir)
+        reconcile_flow()
+    else:
+        reconcile_flow.serve(name="rollup-reconcile", cron=reconcile_cron)
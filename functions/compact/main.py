@@ -0,0 +1,126 @@
+# imports
+import functions_framework
+import datetime
+import json
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from shared import partitions
+from shared import storage_io
+from shared import telemetry
+
+# setup
+bucket_name = "group2-ba882-project"
+
+# compaction settings
+min_files = 4                           # small files a partition needs before it is compacted
+target_file_bytes = 128 * 1024 * 1024   # files at or above this size are left alone, merged files stay below it
+min_age_hours = 24                      # younger files may still be listed in a manifest a transform is about to read
+batch_size = 65536
+parquet_compression = "zstd"
+
+
+# Function to group the small files of a partition into merges of up to target_file_bytes
+def plan_merges(objects, now, age_hours=min_age_hours):
+    small = [
+        obj for obj in objects
+        if obj['uri'].endswith(".parquet")
+        and obj['size'] < target_file_bytes
+        and now - obj['updated'] >= age_hours * 3600
+    ]
+    if len(small) < min_files:
+        return []
+
+    merges, current, current_bytes = [], [], 0
+    for obj in small:
+        if current and current_bytes + obj['size'] > target_file_bytes:
+            merges.append(current)
+            current, current_bytes = [], 0
+        current.append(obj)
+        current_bytes += obj['size']
+    merges.append(current)
+    return [merge for merge in merges if len(merge) > 1]
+
+# Function to bring a record batch to the merged schema, columns it lacks become NULL
+def conform(batch, schema):
+    columns = []
+    for field in schema:
+        if field.name in batch.schema.names:
+            columns.append(batch.column(field.name).cast(field.type))
+        else:
+            columns.append(pa.nulls(batch.num_rows, field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+# Function to merge parquet files into one, streaming batch by batch so memory stays at one batch
+def merge_files(uris, output_uri):
+    files = [pq.ParquetFile(storage_io.open_uri(uri, 'rb')) for uri in uris]
+    schema = pa.unify_schemas([f.schema_arrow for f in files], promote_options="permissive")
+
+    rows = 0
+    with storage_io.open_uri(output_uri, 'wb', content_type='application/vnd.apache.parquet') as out:
+        with pq.ParquetWriter(out, schema, compression=parquet_compression) as writer:
+            for parquet_file in files:
+                for batch in parquet_file.iter_batches(batch_size=batch_size):
+                    writer.write_batch(conform(batch, schema))
+                    rows += batch.num_rows
+    return rows
+
+# Function to compact the given partitions (all of them when None)
+def compact(names=None, age_hours=min_age_hours, tm=None):
+    tm = tm or telemetry.Telemetry('compact')
+    stamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    now = time.time()
+
+    with tm.phase('list') as phase:
+        if names is None:
+            objects = storage_io.list_objects(storage_io.bucket_uri(bucket_name, partitions.feed_prefix + "/"))
+        else:
+            objects = partitions.partition_files(bucket_name, names)
+        by_partition = {}
+        for obj in objects:
+            by_partition.setdefault(partitions.partition_of(obj['uri']), []).append(obj)
+        phase['rows_out'] = len(objects)
+
+    compacted = []
+    for partition, partition_objects in sorted(by_partition.items()):
+        if partition is None:
+            continue
+        for i, merge in enumerate(plan_merges(partition_objects, now, age_hours)):
+            output_uri = storage_io.bucket_uri(bucket_name, partitions.partition_blob(partition, f"compacted-{stamp}-{i:03d}.parquet"))
+            with tm.phase('compact', bytes=sum(obj['size'] for obj in merge), partition=partition) as phase:
+                phase['rows_out'] = merge_files([obj['uri'] for obj in merge], output_uri)
+                # the merged file is complete, the inputs can go
+                for obj in merge:
+                    storage_io.delete(obj['uri'])
+            compacted.append({
+                'partition': partition,
+                'path': output_uri,
+                'rows': phase['rows_out'],
+                'replaced': [obj['uri'] for obj in merge],
+            })
+            print(f"{partition}: {len(merge)} files merged into {output_uri}")
+
+    # record what replaced what next to the run manifests
+    if compacted:
+        manifest_path = storage_io.bucket_uri(bucket_name, partitions.manifest_blob(f"compaction-{stamp}"))
+        partitions.write_manifest(manifest_path, {'compacted_at': stamp, 'files': compacted})
+    return compacted
+
+
+############################################################### main task
+
+@functions_framework.http
+def main(request):
+
+    # Parse the request data
+    request_json = request.get_json(silent=True) or {}
+    print(f"request: {json.dumps(request_json)}")
+
+    tm = telemetry.Telemetry('compact')
+    compacted = compact(
+        names=request_json.get('partitions'),
+        age_hours=float(request_json.get('min_age_hours', min_age_hours)),
+        tm=tm,
+    )
+
+    return {'compacted': compacted, 'telemetry': tm.report()}, 200
@@ -1,71 +1,484 @@
-import requests
 import pandas as pd
-from google.cloud import storage
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 import datetime
 import uuid
+import json
+import os
+import hashlib
+import time
 from io import BytesIO
+from email.utils import formatdate
 import functions_framework
+from shared import downloader
+from shared import partitions
+from shared import storage_io
+from shared import telemetry
 
 # Google Cloud Storage bucket name
 bucket_name = "group2-ba882-project"
 
-# CSV download URL
-csv_url = "https://data.boston.gov/dataset/8048697b-ad64-4bfc-b090-ee00169f2323/resource/dff4d804-5031-443a-8409-8344efd0e5c8/download/tmpisupwu40.csv"
+# CSV download URL (EXTRACT_CSV_URL can point at a local file or a local HTTP stand-in)
+csv_url = os.environ.get("EXTRACT_CSV_URL", "https://data.boston.gov/dataset/8048697b-ad64-4bfc-b090-ee00169f2323/resource/dff4d804-5031-443a-8409-8344efd0e5c8/download/tmpisupwu40.csv")
 
-# Function to download CSV data
+# extract settings
+default_mode = "stream"     # "stream" keeps memory bounded, "full" loads the whole file
+max_records = 100000        # number of latest rows kept per run
+chunk_size = 50000          # rows parsed per chunk in stream mode
+default_format = "json"     # "json" (JSON lines) or "parquet"
+parquet_compression = "zstd"
+parquet_row_group_size = 25000
+
+# incremental state: HTTP validators and the high-water mark of the last successful run
+# (a local file path can stand in for GCS, e.g. when running outside the cloud)
+state_path = os.environ.get("EXTRACT_STATE_PATH", storage_io.bucket_uri(bucket_name, "boston_data/_state/extract_state.json"))
+
+# columns whose min/max per file go into the manifest
+manifest_key_columns = ['open_dt', 'closed_dt', '_id', 'case_enquiry_id']
+
+# explicit parquet types for the columns downstream steps key and filter on
+parquet_types = {
+    'case_enquiry_id': pa.string(),
+    'open_dt': pa.timestamp('us'),
+    'sla_target_dt': pa.timestamp('us'),
+    'closed_dt': pa.timestamp('us'),
+    'latitude': pa.float64(),
+    'longitude': pa.float64(),
+    'extracted_at': pa.timestamp('us'),
+}
+
+# Stand-in for a streamed HTTP response when csv_url is a local file
+# the file's mtime and size act as ETag / Last-Modified so incremental runs behave the same
+class LocalCsvResponse:
+    def __init__(self, path, headers=None):
+        stat = os.stat(path)
+        etag = f'"{int(stat.st_mtime)}-{stat.st_size}"'
+        self.headers = {
+            'ETag': etag,
+            'Last-Modified': formatdate(int(stat.st_mtime), usegmt=True),
+        }
+        self.status_code = 304 if (headers or {}).get('If-None-Match') == etag else 200
+        self.raw = open(path, 'rb') if self.status_code == 200 else None
+
+    def close(self):
+        if self.raw is not None:
+            self.raw.close()
+
+# Function to tell a local csv_url from an http(s) one
+def is_local(url):
+    return not url.startswith(("http://", "https://"))
+
+# Function to download CSV data, in parallel ranges when the server allows it (see shared/downloader.py)
 def download_csv(url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        return response.content
-    else:
-        raise Exception(f"Failed to download CSV. Status code: {response.status_code}")
+    if is_local(url):
+        with open(url, 'rb') as f:
+            return f.read()
+    download = downloader.open_url(url)
+    try:
+        return download.raw.read()
+    finally:
+        download.close()
+
+# Function to open the CSV as a stream, bytes are pulled as the parser asks for them
+# (over http the later ranges download while the parser works on the earlier ones)
+def stream_csv(url, headers=None):
+    if is_local(url):
+        return LocalCsvResponse(url, headers)
+    return downloader.open_url(url, headers)
+
+# Function to widen dtypes the same way a single read_csv over the whole file would
+def promote_dtypes(seen, chunk):
+    for col, dtype in chunk.dtypes.items():
+        if col not in seen:
+            seen[col] = dtype
+        elif seen[col] != dtype:
+            if pd.api.types.is_numeric_dtype(seen[col]) and pd.api.types.is_numeric_dtype(dtype) \
+                    and not pd.api.types.is_bool_dtype(seen[col]) and not pd.api.types.is_bool_dtype(dtype):
+                seen[col] = np.promote_types(seen[col], dtype)
+            elif isinstance(seen[col], pd.StringDtype) or isinstance(dtype, pd.StringDtype):
+                # text in any chunk makes it a text column (the str dtype of pandas 3, object before)
+                seen[col] = seen[col] if isinstance(seen[col], pd.StringDtype) else dtype
+            else:
+                seen[col] = np.dtype(object)
+    return seen
+
+# Function to keep the newest n rows of some chunks, the same rule as the full read:
+# newest rows by date (earlier rows first on ties), otherwise the last rows of the file
+def latest_rows(chunks, n):
+    df = pd.concat(chunks, ignore_index=True)
+    if n is None:
+        return df
+    if 'date' in df.columns:
+        return df.sort_values('date', ascending=False, kind='stable').head(n)
+    return df.tail(n)
+
+# Function to keep the latest n rows of a chunked CSV, memory depends on n and chunksize only
+# (n=None keeps every row that passes row_filter)
+# the chunks are collected and trimmed to n once they hold 2n rows, so each row is copied a bounded number of times
+# stats, when given, gets the seconds spent parsing and sorting/trimming and the rows read
+def read_latest_records(csv_stream, n=max_records, chunksize=chunk_size, row_filter=None, stats=None):
+    stats = stats if stats is not None else {}
+    stats.update({'parse_seconds': 0.0, 'trim_seconds': 0.0, 'rows_read': 0})
+    kept, kept_rows = [], 0
+    seen = {}
+    start = time.perf_counter()
+    for chunk in pd.read_csv(csv_stream, chunksize=chunksize):
+        parsed = time.perf_counter()
+        stats['parse_seconds'] += parsed - start
+        stats['rows_read'] += len(chunk)
+
+        seen = promote_dtypes(seen, chunk)
+        if row_filter is not None:
+            chunk = row_filter(chunk)
+        if n is not None and 'date' in chunk.columns:
+            chunk = chunk.assign(date=pd.to_datetime(chunk['date']))
+        kept.append(chunk)
+        kept_rows += len(chunk)
+        if n is not None and kept_rows >= 2 * n:
+            kept = [latest_rows(kept, n)]
+            kept_rows = len(kept[0])
+
+        start = time.perf_counter()
+        stats['trim_seconds'] += start - parsed
+    stats['parse_seconds'] += time.perf_counter() - start
+
+    if not kept:
+        return pd.DataFrame()
+    start = time.perf_counter()
+    buffer = latest_rows(kept, n)
+
+    # cast back to the dtypes the whole file would have produced
+    casts = {col: dtype for col, dtype in seen.items()
+             if col != 'date' and buffer[col].dtype != dtype}
+    if casts:
+        buffer = buffer.astype(casts)
+    stats['trim_seconds'] += time.perf_counter() - start
+    return buffer.reset_index(drop=True)
+
+# Function to split a streamed read into download, parse and sort/trim phases
+# (the parser pulls the bytes, so download is the time spent inside the stream's reads)
+def record_stream_read(tm, stream, stats, rows_out):
+    tm.record('download', stream.seconds, bytes=stream.bytes)
+    tm.record('parse', stats['parse_seconds'] - stream.seconds, rows_out=stats['rows_read'], bytes=stream.bytes)
+    tm.record('sort_trim', stats['trim_seconds'], rows_in=stats['rows_read'], rows_out=rows_out)
+
+# Function to read the incremental state, empty on the first run
+def read_state(path):
+    if not storage_io.exists(path):
+        return {}
+    return json.loads(storage_io.read_text(path))
+
+# Function to persist the incremental state
+def write_state(path, state):
+    storage_io.write_text(path, json.dumps(state))
+
+# Function to build the conditional request headers from the saved validators
+def conditional_headers(state):
+    headers = {}
+    if state.get('etag'):
+        headers['If-None-Match'] = state['etag']
+    if state.get('last_modified'):
+        headers['If-Modified-Since'] = state['last_modified']
+    return headers
+
+# Function to keep only rows that are new or changed since the watermark
+# new: opened after the last open_dt or with a higher _id, changed: closed after the last closed_dt
+def filter_new_records(chunk, watermark):
+    if not watermark:
+        return chunk
+    keep = pd.Series(False, index=chunk.index)
+    for col in ('open_dt', 'closed_dt'):
+        if col not in chunk.columns:
+            continue
+        values = pd.to_datetime(chunk[col], errors='coerce')
+        if watermark.get(col):
+            keep |= values > pd.Timestamp(watermark[col])
+        else:
+            # no mark for this column yet, e.g. nothing had been closed on the last run
+            keep |= values.notna()
+    if watermark.get('_id') is not None and '_id' in chunk.columns:
+        keep |= pd.to_numeric(chunk['_id'], errors='coerce') > watermark['_id']
+    return chunk[keep]
+
+# Function to move the watermark forward over the emitted rows
+def advance_watermark(watermark, df):
+    watermark = dict(watermark)
+    for col in ('open_dt', 'closed_dt'):
+        if col in df.columns:
+            latest = pd.to_datetime(df[col], errors='coerce').max()
+            if pd.notna(latest) and (not watermark.get(col) or latest > pd.Timestamp(watermark[col])):
+                watermark[col] = latest.isoformat()
+    if '_id' in df.columns:
+        latest = pd.to_numeric(df['_id'], errors='coerce').max()
+        if pd.notna(latest) and (watermark.get('_id') is None or latest > watermark['_id']):
+            watermark['_id'] = int(latest)
+    return watermark
 
 # Function to upload data to GCS as JSON
-def upload_to_gcs(data, bucket_name, blob_name):
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(bucket_name)
-    blob = bucket.blob(blob_name)
-    blob.upload_from_file(BytesIO(data), content_type='application/json')
+def upload_to_gcs(data, uri):
+    with storage_io.open_uri(uri, 'wb', content_type='application/json') as f:
+        f.write(data)
 
-# Main function to execute the process as a Cloud Function
-@functions_framework.http
-def main(request):
-    try:
-        # Generate job ID
-        job_id = datetime.datetime.now().strftime('%Y%m%d%H%M') + '-' + str(uuid.uuid4())
+# Function to stamp the rows with the time they were pulled
+# (transform keeps the most recently extracted copy of a key when several files hold it)
+def stamp_extracted_at(df):
+    return df.assign(extracted_at=datetime.datetime.now().isoformat(timespec='microseconds'))
+
+# Function to build the typed arrow table that is written as parquet
+def to_arrow_table(df):
+    df = df.copy()
+    for col, col_type in parquet_types.items():
+        if col not in df.columns:
+            continue
+        if pa.types.is_timestamp(col_type):
+            df[col] = pd.to_datetime(df[col], errors='coerce')
+        elif pa.types.is_floating(col_type):
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+        else:
+            # ids parsed as floats (because of blanks) would otherwise print as 1.01e+11
+            if pd.api.types.is_float_dtype(df[col]):
+                df[col] = df[col].astype('Int64')
+            df[col] = df[col].astype('string')
 
-        # Download CSV data
+    inferred = pa.Schema.from_pandas(df, preserve_index=False)
+    schema = pa.schema([
+        pa.field(field.name, parquet_types.get(field.name, field.type))
+        for field in inferred
+    ])
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+# File wrapper that hashes and counts the bytes passing through it, and times the writes
+class HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.seconds = 0.0
+
+    @property
+    def closed(self):
+        return self.f.closed
+
+    def write(self, data):
+        self.sha.update(data)
+        self.size += len(data)
+        start = time.perf_counter()
+        written = self.f.write(data)
+        self.seconds += time.perf_counter() - start
+        return written
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+# Function to write parquet straight into the GCS blob, returns the bytes written and their sha256
+# encoding and upload overlap, tm gets the time spent in the blob writes (and the final flush) as upload
+def write_parquet_to_gcs(table, uri, tm=None):
+    start = time.perf_counter()
+    with storage_io.open_uri(uri, 'wb', content_type='application/vnd.apache.parquet') as f:
+        out = HashingWriter(f)
+        with pq.ParquetWriter(out, table.schema, compression=parquet_compression) as writer:
+            writer.write_table(table, row_group_size=parquet_row_group_size)
+        closing = time.perf_counter()
+    if tm is not None:
+        upload_seconds = out.seconds + time.perf_counter() - closing
+        tm.record('serialize', time.perf_counter() - start - upload_seconds,
+                  bytes=out.size, detail='parquet')
+        tm.record('upload', upload_seconds, bytes=out.size)
+    return out.size, out.sha.hexdigest()
+
+# Function to group the rows by open_dt year/month partition, returns partition -> row positions
+def group_rows(df):
+    if 'open_dt' in df.columns:
+        open_dt = pd.to_datetime(df['open_dt'], errors='coerce')
+    else:
+        open_dt = pd.Series(pd.NaT, index=df.index)
+    names = pd.Series(partitions.default_partition, index=df.index)
+    dated = open_dt.notna()
+    names[dated] = ("open_year=" + open_dt[dated].dt.year.astype(str)
+                    + "/open_month=" + open_dt[dated].dt.month.astype(str).str.zfill(2))
+    positions = pd.Series(np.arange(len(df))).groupby(names.to_numpy()).indices
+    return dict(sorted(positions.items()))
+
+# Function to get the min/max of the key columns of a file's rows
+def key_ranges(table):
+    ranges = {'min': {}, 'max': {}}
+    for col in manifest_key_columns:
+        if col in table.column_names:
+            min_max = pc.min_max(table.column(col))
+            ranges['min'][col] = min_max['min'].as_py()
+            ranges['max'][col] = min_max['max'].as_py()
+    return ranges
+
+# Function to write one file per partition the rows fall in and the run's manifest
+# returns the manifest and its path
+def write_partitions(df, table, job_id, output_format, tm):
+    files = []
+    for partition, rows in group_rows(df).items():
+        part = table.take(rows)
+        filepath = storage_io.bucket_uri(bucket_name, partitions.partition_blob(partition, f"{job_id}.{output_format}"))
+
+        if output_format == "parquet":
+            # Write typed, compressed parquet without an intermediate copy
+            bytes_written, content_hash = write_parquet_to_gcs(part, filepath, tm)
+        else:
+            with tm.phase('serialize', rows_in=len(rows), detail='json') as phase:
+                json_buffer = BytesIO()
+                df.iloc[rows].to_json(json_buffer, orient='records', lines=True)
+                data = json_buffer.getvalue()
+                phase['rows_out'] = len(rows)
+                phase['bytes'] = len(data)
+            bytes_written = len(data)
+            content_hash = hashlib.sha256(data).hexdigest()
+            with tm.phase('upload', bytes=bytes_written):
+                upload_to_gcs(data, filepath)
+
+        files.append({
+            'path': filepath,
+            'partition': partition,
+            'rows': part.num_rows,
+            'bytes': bytes_written,
+            'sha256': content_hash,
+            **key_ranges(part),
+        })
+
+    manifest = partitions.build_manifest(job_id, output_format, files)
+    manifest_path = storage_io.bucket_uri(bucket_name, partitions.manifest_blob(job_id))
+    partitions.write_manifest(manifest_path, manifest)
+    return manifest, manifest_path
+
+# Function to generate a job ID
+def new_job_id():
+    return datetime.datetime.now().strftime('%Y%m%d%H%M') + '-' + str(uuid.uuid4())
+
+# Function to pull the rows for this run
+# returns the rows, the incremental state to save once they are stored (None when not incremental) and a status
+def extract_records(request_json, tm=None):
+    tm = tm or telemetry.Telemetry('extract')
+    mode = request_json.get('mode', default_mode)
+    incremental = request_json.get('incremental', False)
+
+    if incremental:
+        # Conditional download, nothing to do when the file has not changed
+        state = read_state(state_path)
+        watermark = state.get('watermark', {})
+        response = stream_csv(csv_url, headers=conditional_headers(state))
+        try:
+            if response.status_code == 304:
+                print("Source file not modified since the last run")
+                return None, None, 'not_modified'
+
+            # the first run has no watermark and keeps the usual latest rows
+            stream, stats = telemetry.TimedReader(response.raw), {}
+            df = read_latest_records(
+                stream,
+                n=None if watermark else max_records,
+                chunksize=chunk_size,
+                row_filter=lambda chunk: filter_new_records(chunk, watermark),
+                stats=stats,
+            )
+            record_stream_read(tm, stream, stats, len(df))
+        finally:
+            response.close()
+
+        state = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'watermark': advance_watermark(watermark, df),
+        }
+        if len(df) == 0:
+            write_state(state_path, state)
+            print("No new or changed records since the last run")
+            return df, None, 'no_new_records'
+        return df, state, 'ok'
+
+    if mode == "stream":
+        # Download and parse in chunks, keeping only the latest rows in memory
+        response = stream_csv(csv_url)
+        try:
+            stream, stats = telemetry.TimedReader(response.raw), {}
+            df = read_latest_records(stream, n=max_records, chunksize=chunk_size, stats=stats)
+            record_stream_read(tm, stream, stats, len(df))
+        finally:
+            response.close()
+        return df, None, 'ok'
+
+    # Download CSV data
+    with tm.phase('download') as phase:
         csv_data = download_csv(csv_url)
+        phase['bytes'] = len(csv_data)
 
-        # Convert CSV to DataFrame and then to JSON lines format
+    # Convert CSV to DataFrame and then to JSON lines format
+    with tm.phase('parse', bytes=len(csv_data)) as phase:
         df = pd.read_csv(BytesIO(csv_data))
-        
-        # Attempt to sort by date and get the latest 100,000 rows
+        phase['rows_out'] = len(df)
+
+    # Attempt to sort by date and get the latest 100,000 rows
+    with tm.phase('sort_trim', rows_in=len(df)) as phase:
         if 'date' in df.columns:
             df['date'] = pd.to_datetime(df['date'])
-            df = df.sort_values('date', ascending=False).head(100000)
+            df = df.sort_values('date', ascending=False).head(max_records)
         else:
             # If no date column, just take the last 100,000 rows
-            df = df.tail(100000)
+            df = df.tail(max_records)
+        phase['rows_out'] = len(df)
+    return df, None, 'ok'
 
-        json_buffer = BytesIO()
-        df.to_json(json_buffer, orient='records', lines=True)
-        json_buffer.seek(0)
+# Main function to execute the process as a Cloud Function
+@functions_framework.http
+def main(request):
+    try:
+        # Parse the request data
+        request_json = request.get_json(silent=True) or {}
+        tm = telemetry.Telemetry('extract')
+
+        # the flow sends back the state of a run once that run's rows are loaded
+        if request_json.get('commit_state'):
+            write_state(state_path, request_json['commit_state'])
+            print("Saved the extract state of the loaded run")
+            return {'status': 'state_saved'}
+
+        df, state, status = extract_records(request_json, tm)
+        if status != 'ok':
+            return {'status': status, 'total_records': 0, 'telemetry': tm.report()}
+
+        # Generate job ID
+        job_id = new_job_id()
 
-        # Define the blob name with job ID
-        blob_name = f"boston_data/{job_id}/data.json"
+        output_format = request_json.get('format', default_format)
 
-        # Upload JSON data to GCS
-        upload_to_gcs(json_buffer.getvalue(), bucket_name, blob_name)
+        # one typed copy of the rows, the partitions are cut from it
+        df = stamp_extracted_at(df)
+        with tm.phase('serialize', rows_in=len(df), detail='arrow') as phase:
+            table = to_arrow_table(df)
+            phase['rows_out'] = table.num_rows
 
-        print(f"Data successfully uploaded to gs://{bucket_name}/{blob_name}")
+        # one file per open_dt year/month partition plus the run's manifest
+        manifest, manifest_path = write_partitions(df, table, job_id, output_format, tm)
+        print(f"Data successfully uploaded to {len(manifest['files'])} partitions, manifest at {manifest_path}")
 
         return {
-            'filepath': f"gs://{bucket_name}/{blob_name}",
+            'status': 'ok',
+            'manifest': manifest_path,
+            'filepath': manifest_path,
+            'partitions': manifest['partitions'],
             'jobid': job_id,
             'bucket_id': bucket_name,
-            'blob_name': blob_name,
-            'total_records': len(df)
+            'blob_name': partitions.manifest_blob(job_id),
+            'total_records': len(df),
+            'bytes_written': manifest['bytes'],
+            'format': output_format,
+            'content_hash': manifest['content_hash'],
+            # the watermark only moves once the rows are loaded, the flow saves it then (commit_state)
+            'state': state,
+            'telemetry': tm.report()
         }
 
     except Exception as e:
@@ -1,217 +1,791 @@
 # imports
 import functions_framework
-from google.cloud import secretmanager
-from google.cloud import storage
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import json
 import duckdb
-import pandas as pd
+import time
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as pj
+import pyarrow.parquet as pq
+from shared import connections
+from shared import geo
+from shared import key_index
+from shared import partitions
+from shared import schema_registry
+from shared import storage_io
+from shared import telemetry
 
 # setup
-project_id = 'group2-ba882'
-secret_id = 'project_key'   #<---------- this is the name of the secret you created
-version_id = 'latest'
-
+bucket_name = "group2-ba882-project"
 
 # db setup
-db = 'city_services_boston'
+db = schema_registry.db
 schema = "raw"
 raw_db_schema = f"{db}.{schema}"
-stage_db_schema = f"{db}.stage"
-
-
-
-############################################################### main task
-
-@functions_framework.http
-def main(request):
-
-    # Parse the request data
-    request_json = request.get_json(silent=True)
-    print(f"request: {json.dumps(request_json)}")
-
-    # instantiate the services 
-    sm = secretmanager.SecretManagerServiceClient()
-    storage_client = storage.Client()
-
-    # Build the resource name of the secret version
-    name = f"projects/{project_id}/secrets/{secret_id}/versions/{version_id}"
-
-    # Access the secret version
-    response = sm.access_secret_version(request={"name": name})
-    md_token = response.payload.data.decode("UTF-8")
-
-    # initiate the MotherDuck connection through an access token through
-    md = duckdb.connect(f'md:?motherduck_token={md_token}') 
-
-    # drop if exists and create the raw schema for 
-    create_schema = f"DROP SCHEMA IF EXISTS {raw_db_schema} CASCADE; CREATE SCHEMA IF NOT EXISTS {raw_db_schema};"
-    md.sql(create_schema)
-
-    print(md.sql("SHOW DATABASES;").show())
-
-
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ tbl: requests
-
-    # read in from gcs
-    requests_path = request_json.get('requests')
-    requests_df = pd.read_parquet(requests_path)
-
-    # table logic
-    raw_tbl_name = f"{raw_db_schema}.requests"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name} ;
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_db_schema}.requests WHERE FALSE;
+stage_db_schema = schema_registry.db_schema
+
+# rows per arrow record batch when streaming parquet, and rows per chunk committed to a raw table
+# (a parquet chunk is made of whole row groups, so it can be larger)
+batch_size = 65536
+chunk_rows = 500000
+
+# chunks of each job already in the raw tables and tables each job finished, so a retried load resumes
+progress_tbl_name = f"{raw_db_schema}._ingest_progress"
+markers_tbl_name = f"{raw_db_schema}._load_markers"
+marker_retention_days = 30
+
+# tables loaded at the same time, each on its own cursor
+max_workers = 5
+
+# rows whose key is already in stage are dropped before they are sent, for the tables that only insert new keys
+# (see shared/key_index.py; a backfill turns it off, its shards do not overlap)
+key_filter = True
+
+# dictionary-encoded columns: new rows get the key next to the text; with this off they keep only the key
+# and the text is read through the stage.<table>_decoded views -- a breaking change for anything reading
+# the text columns of stage.* directly, only turn it off once those readers use the views
+# (primary key columns always keep their text; while it is on the keys add to the table size, see README)
+keep_dimension_text = True
+
+# one entry per stage table:
+#   source_key    - key of the parquet path in the request (the transform output)
+#   raw_table     - table in the raw schema the batch lands in
+#   stage_table   - table in the stage schema new records are inserted into
+#   conflict_keys - primary key of the stage table (from the schema registry)
+#   depends_on    - stage tables that have to be loaded first
+#   order_by      - new records are inserted in this order, so row group min/max stats prune range filters
+#   update_on_conflict - existing records whose values changed are updated, otherwise they are left alone
+#   fill_on_conflict - columns added after records were loaded: an existing record where they are NULL gets
+#                      them from the batch (the key filter keeps sending those records until they are filled,
+#                      see fill_request_locations for the records no batch brings again)
+#   derived_from  - stage table the records are computed from instead of a transform output (see derivations)
+table_specs = [
+    {
+        'source_key': 'requests',
+        'raw_table': 'requests',
+        'stage_table': 'requests',
+        'conflict_keys': schema_registry.tables['requests']['primary_key'],
+        'depends_on': [],
+        'order_by': [],
+        'update_on_conflict': False,
+        'fill_on_conflict': ['location'],
+        'derived_from': None,
+    },
+    {
+        'source_key': 'location',
+        'raw_table': 'locations',
+        'stage_table': 'locations',
+        'conflict_keys': schema_registry.tables['locations']['primary_key'],
+        'depends_on': [],
+        'order_by': [f"geohash_{max(schema_registry.geohash_precisions)}"],
+        'update_on_conflict': False,
+        'fill_on_conflict': [],
+        'derived_from': None,
+    },
+    {
+        'source_key': 'department_assignment',
+        'raw_table': 'department_assignment',
+        'stage_table': 'department_assignment',
+        'conflict_keys': schema_registry.tables['department_assignment']['primary_key'],
+        'depends_on': [],
+        'order_by': [],
+        'update_on_conflict': False,
+        'fill_on_conflict': [],
+        'derived_from': None,
+    },
+    {
+        'source_key': 'status_history',
+        'raw_table': 'status_history',
+        'stage_table': 'status_history',
+        'conflict_keys': schema_registry.tables['status_history']['primary_key'],
+        'depends_on': [],
+        'order_by': [],
+        'update_on_conflict': True,
+        'fill_on_conflict': [],
+        'derived_from': None,
+    },
+    {
+        'source_key': None,
+        'raw_table': None,
+        'stage_table': 'response_time',
+        'conflict_keys': schema_registry.tables['response_time']['primary_key'],
+        'depends_on': ['status_history'],
+        'order_by': [],
+        'update_on_conflict': True,
+        'fill_on_conflict': [],
+        'derived_from': 'status_history',
+    },
+]
+
+
+# Function to build the query for the SLA metrics of the cases in the batch, from their latest status
+# open cases (no closed_dt) get NULL, they are recomputed once a later batch closes them
+def response_time_sql(batch_tbl_name):
+    return f"""
+    SELECT
+        case_enquiry_id,
+        closed_dt <= sla_target_dt AS on_time,
+        date_diff('second', open_dt, closed_dt) / 3600.0 AS time_to_close_hours,
+        date_diff('second', closed_dt, sla_target_dt) / 3600.0 AS sla_slack_hours
+    FROM {stage_db_schema}.status_history
+    WHERE case_enquiry_id IN (SELECT case_enquiry_id FROM {batch_tbl_name})
+    QUALIFY row_number() OVER (PARTITION BY case_enquiry_id ORDER BY open_dt DESC NULLS LAST) = 1
     """
-    print(f"{raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
-
-    # ingest into raw schema
-    ingest_sql = f"INSERT INTO {raw_tbl_name} SELECT * FROM requests_df"
-    print(f"Import statement: {ingest_sql}")
-    md.sql(ingest_sql)
-    del requests_df
 
-    # upsert like operation -- will only insert new records, not update
-    upsert_sql = f"""
-    INSERT INTO {stage_db_schema}.requests AS stage
-    SELECT *
-    FROM {raw_tbl_name} AS raw
-    ON CONFLICT (_id)
-    DO NOTHING;
-    """
-    print(upsert_sql)
-    md.sql(upsert_sql)
-    
-    
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ tbl: location
-
-    # read in from gcs
-    location_path = location_json.get('location')
-    location_df = pd.read_parquet(location_path)
-
-    # table logic
-    raw_tbl_name = f"{raw_db_schema}.tags"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name} ;
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_db_schema}.location WHERE FALSE;
+# derived stage table -> query computing its records for the batch, the keys the upsert of the table it is derived from inserted or changed
+derivations = {
+    'response_time': response_time_sql,
+}
+
+
+# Function to split a source into chunks of about chunk_rows rows, each read as a stream of record batches only when it is inserted
+# a parquet chunk is a run of whole row groups, so a chunk that is already in the raw table is never read
+def source_chunks(source, columns, rows_per_chunk):
+    if isinstance(source, pa.Table):
+        table = source.select([col for col in columns if col in source.schema.names])
+        for offset in range(0, table.num_rows, rows_per_chunk):
+            part = table.slice(offset, rows_per_chunk)
+            yield part.schema.names, (lambda part=part: part.to_reader(max_chunksize=batch_size))
+        return
+
+    parquet_file = pq.ParquetFile(source)
+    present = [col for col in columns if col in parquet_file.schema_arrow.names]
+    schema = pa.schema([parquet_file.schema_arrow.field(col) for col in present])
+    groups, rows = [], 0
+    for index in range(parquet_file.num_row_groups):
+        groups.append(index)
+        rows += parquet_file.metadata.row_group(index).num_rows
+        if rows >= rows_per_chunk or index == parquet_file.num_row_groups - 1:
+            batches = (lambda groups=groups: pa.RecordBatchReader.from_batches(
+                schema, parquet_file.iter_batches(batch_size=batch_size, row_groups=groups, columns=present)))
+            yield present, batches
+            groups, rows = [], 0
+
+# Function to list the chunks of a raw table a job already committed, chunk -> rows
+def committed_chunks(md, job_id, raw_tbl_name):
+    return dict(md.execute(f"""
+    SELECT chunk, rows FROM {progress_tbl_name} WHERE job_id = ? AND raw_table = ?
+    """, [job_id, raw_tbl_name]).fetchall())
+
+# Function to name the table of the keys a table's upsert inserted or changed, the batch its derived tables are computed for
+def changed_tbl_name(raw_tbl_name):
+    return f"{raw_tbl_name}_changed"
+
+# Function to drop a raw table together with its ingest progress and changed keys
+def clear_raw_table(md, raw_tbl_name):
+    md.execute(f"DROP TABLE IF EXISTS {raw_tbl_name};")
+    md.execute(f"DROP TABLE IF EXISTS {changed_tbl_name(raw_tbl_name)};")
+    md.execute(f"DELETE FROM {progress_tbl_name} WHERE raw_table = ?;", [raw_tbl_name])
+
+# Function to insert parquet or arrow data into a raw table chunk by chunk, projecting and casting to the stage columns in the scan
+# source is a parquet path (gs:// or local) or an arrow table already in memory; memory stays at one record batch
+# each chunk commits with its progress row, so a retry of the same job only sends the chunks that did not commit
+# reading from GCS overlaps the insert, tm gets the time spent inside the blob reads as read_parquet
+# index is the key filter of the table, the rows it drops are never sent
+def ingest(md, source, raw_tbl_name, stage_tbl_name, tm=None, job_id=None, index=None):
+    tm = tm or telemetry.Telemetry('load')
+    stage_columns = [(row[0], row[1]) for row in md.sql(f"DESCRIBE {stage_tbl_name}").fetchall()]
+    names = [name for name, _ in stage_columns]
+    done = committed_chunks(md, job_id, raw_tbl_name) if job_id else {}
+
+    stream = None
+    if isinstance(source, str):
+        stream = telemetry.TimedReader(storage_io.open_uri(source, 'rb'))
+        source = stream
+
+    rows = 0
+    try:
+        for chunk, (present, reader) in enumerate(source_chunks(source, names, chunk_rows)):
+            if chunk in done:
+                rows += done[chunk]
+                if index is not None:
+                    # the keys of this chunk are not in the filter, it is not saved after this load
+                    index.complete = False
+                continue
+
+            select = []
+            for name, col_type in stage_columns:
+                if name not in present:
+                    select.append(f"CAST(NULL AS {col_type}) AS {name}")
+                elif col_type == "GEOMETRY":
+                    select.append(f"ST_GeomFromWKB({name}) AS {name}")
+                else:
+                    select.append(f"CAST({name} AS {col_type}) AS {name}")
+
+            read_seconds, read_bytes = stream.seconds if stream else 0.0, stream.bytes if stream else 0
+            filter_stats = dict(index.stats) if index is not None else None
+            start = time.perf_counter()
+            batches = reader()
+            if index is not None:
+                batches = index.filter_reader(batches)
+            md.register("chunk_batches", batches)
+            md.execute("BEGIN TRANSACTION;")
+            try:
+                inserted = md.execute(f"INSERT INTO {raw_tbl_name} SELECT {', '.join(select)} FROM chunk_batches").fetchone()[0]
+                if job_id:
+                    md.execute(f"INSERT INTO {progress_tbl_name} VALUES (?, ?, ?, ?, now());", [job_id, raw_tbl_name, chunk, inserted])
+                md.execute("COMMIT;")
+            except Exception:
+                md.execute("ROLLBACK;")
+                raise
+            finally:
+                md.unregister("chunk_batches")
+            seconds = time.perf_counter() - start
+            rows += inserted
+
+            if stream is not None:
+                tm.record('read_parquet', stream.seconds - read_seconds, rows_out=inserted, bytes=stream.bytes - read_bytes,
+                          table=raw_tbl_name, chunk=chunk)
+                seconds -= stream.seconds - read_seconds
+            if index is not None:
+                filter_rows = index.stats['rows_in'] - filter_stats['rows_in']
+                filter_seconds = index.stats['seconds'] - filter_stats['seconds']
+                tm.record('key_filter', filter_seconds, rows_in=filter_rows, rows_out=inserted, table=raw_tbl_name, chunk=chunk)
+                seconds -= filter_seconds
+            tm.record('raw_insert', seconds, rows_in=inserted, rows_out=inserted, table=raw_tbl_name, chunk=chunk)
+    finally:
+        if stream is not None:
+            stream.close()
+
+    return rows
+
+# Function to give the values of the encoded columns that are not in their dimension tables yet the next keys
+# one INSERT per column, the new values are found with an anti join
+def assign_keys(md, encoded, source_tbl_name):
+    new_values = 0
+    for col in encoded:
+        dim_tbl_name = f"{stage_db_schema}.dim_{col}"
+        new_values += md.execute(f"""
+        INSERT INTO {dim_tbl_name}
+        SELECT (SELECT coalesce(max({col}_key), 0) FROM {dim_tbl_name}) + row_number() OVER (ORDER BY incoming.value), incoming.value
+        FROM (SELECT DISTINCT {col} AS value FROM {source_tbl_name} WHERE {col} IS NOT NULL) AS incoming
+        ANTI JOIN {dim_tbl_name} AS dim ON dim.{col} = incoming.value
+        ON CONFLICT DO NOTHING;
+        """).fetchone()[0]
+
+    # a load running next to this one can take the same new key for another value, that value is left out above
+    missing = md.execute(" UNION ALL ".join(
+        f"SELECT count(*) FROM (SELECT DISTINCT {col} AS value FROM {source_tbl_name} WHERE {col} IS NOT NULL) AS incoming "
+        f"ANTI JOIN {stage_db_schema}.dim_{col} AS dim ON dim.{col} = incoming.value"
+        for col in encoded
+    )).fetchall()
+    if any(count for count, in missing):
+        raise duckdb.TransactionException(f"Dimension keys for {source_tbl_name} collided with another load, retry")
+    return new_values
+
+# Function to replace the dimension columns of a raw table by their keys, in one pass joining all keys in
+def encode_dimensions(md, spec, raw_tbl_name, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    encoded = schema_registry.dimensions.get(spec['stage_table'], [])
+    if not encoded:
+        return 0
+
+    with tm.phase('dimensions', table=raw_tbl_name) as phase:
+        new_values = assign_keys(md, encoded, raw_tbl_name)
+
+        # one pass over the raw table: keys from the dimensions, text dropped
+        select, joins = [], []
+        for col in [row[0] for row in md.execute(f"DESCRIBE {raw_tbl_name}").fetchall()]:
+            value_col = col[:-len("_key")]
+            if col in schema_registry.dimension_keys and value_col in encoded:
+                # rows encoded before a retry have the key and no text any more
+                select.append(f"coalesce(dim_{value_col}.{col}, raw.{col}) AS {col}")
+                joins.append(f"LEFT JOIN {stage_db_schema}.dim_{value_col} AS dim_{value_col} ON dim_{value_col}.{value_col} = raw.{value_col}")
+            elif col in encoded and not keep_dimension_text and col not in spec['conflict_keys']:
+                select.append(f"CAST(NULL AS VARCHAR) AS {col}")
+            else:
+                select.append(f"raw.{col}")
+        md.execute(f"""
+        CREATE OR REPLACE TABLE {raw_tbl_name} AS
+        SELECT {', '.join(select)}
+        FROM {raw_tbl_name} AS raw
+        {' '.join(joins)};
+        """)
+        phase['rows_out'] = new_values
+    return new_values
+
+# Function to encode the stage rows loaded before the dimension keys existed, run once after the migration
+# with keep_dimension_text on it also puts back the text of rows that only kept the key
+def encode_existing_rows(md, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    results = {}
+    for spec in table_specs:
+        encoded = schema_registry.dimensions.get(spec['stage_table'], [])
+        stage_tbl_name = f"{stage_db_schema}.{spec['stage_table']}"
+        if not encoded:
+            continue
+        with tm.phase('dimensions', table=stage_tbl_name, detail='existing rows') as phase:
+            new_values = assign_keys(md, encoded, stage_tbl_name)
+            updated = 0
+            for col in encoded:
+                clear = f", {col} = NULL" if not keep_dimension_text and col not in spec['conflict_keys'] else ""
+                updated += md.execute(f"""
+                UPDATE {stage_tbl_name} AS t
+                SET {col}_key = dim.{col}_key{clear}
+                FROM {stage_db_schema}.dim_{col} AS dim
+                WHERE dim.{col} = t.{col} AND t.{col}_key IS NULL;
+                """).fetchone()[0]
+                if keep_dimension_text:
+                    # text cleared by a load that ran with keep_dimension_text off
+                    updated += md.execute(f"""
+                    UPDATE {stage_tbl_name} AS t
+                    SET {col} = dim.{col}
+                    FROM {stage_db_schema}.dim_{col} AS dim
+                    WHERE dim.{col}_key = t.{col}_key AND t.{col} IS NULL;
+                    """).fetchone()[0]
+            phase['rows_out'] = updated
+        results[spec['stage_table']] = {'new_dimension_values': new_values, 'updated_values': updated}
+    return results
+
+# Function to fill in the geometry and geohash cells of the locations loaded before transform computed them
+# (locations is DO NOTHING and key filtered, a location already in stage is never loaded again)
+def fill_location_geo(md, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    stage_tbl_name = f"{stage_db_schema}.locations"
+    with tm.phase('fill', table=stage_tbl_name, detail='geometry and geohash') as phase:
+        missing = md.execute(f"""
+        SELECT location, longitude, latitude, CAST(NULL AS BLOB) AS geom_4326,
+            {', '.join(f"CAST(NULL AS VARCHAR) AS {col}" for col in geo.geohash_columns)}
+        FROM {stage_tbl_name}
+        WHERE {geo.finest_geohash} IS NULL AND longitude IS NOT NULL AND latitude IS NOT NULL
+        """).fetch_arrow_table()
+        phase['rows_in'] = missing.num_rows
+        if missing.num_rows == 0:
+            phase['rows_out'] = 0
+            return 0
+
+        geom = "ST_GeomFromWKB(g.geom_4326)" if dict(schema_registry.tables['locations']['columns'])['geom_4326'] == "GEOMETRY" else "g.geom_4326"
+        updates = ", ".join([f"geom_4326 = {geom}"] + [f"{col} = g.{col}" for col in geo.geohash_columns])
+        md.register("geo_fill", geo.add_geo_columns(missing))
+        try:
+            phase['rows_out'] = md.execute(f"""
+            UPDATE {stage_tbl_name} AS t SET {updates}
+            FROM geo_fill AS g
+            WHERE t.location = g.location;
+            """).fetchone()[0]
+        finally:
+            md.unregister("geo_fill")
+    print(f"{stage_tbl_name}: geometry and geohash cells filled in for {phase['rows_out']} existing locations")
+    return phase['rows_out']
+
+# Function to fill in the location of the requests loaded before the column existed, from the cases in the extract feed
+# run once after the migration; requests the feed does not have (history from before it) need a backfill run
+def fill_request_locations(md, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    stage_tbl_name = f"{stage_db_schema}.requests"
+    with tm.phase('fill', table=stage_tbl_name, detail='location') as phase:
+        phase['rows_in'] = md.execute(f"SELECT count(*) FROM {stage_tbl_name} WHERE location IS NULL").fetchone()[0]
+        phase['rows_out'] = 0
+        if phase['rows_in'] == 0:
+            return 0
+
+        prefix = storage_io.bucket_uri(bucket_name, f"{partitions.feed_prefix}/")
+        for obj in storage_io.list_objects(prefix):
+            with storage_io.open_uri(obj['uri'], 'rb') as f:
+                if obj['uri'].endswith(".parquet"):
+                    cases = pq.read_table(f, columns=['case_enquiry_id', 'location'])
+                elif obj['uri'].endswith(".json"):
+                    cases = pj.read_json(f).select(['case_enquiry_id', 'location'])
+                else:
+                    continue
+            # one location per case, the stage key is text
+            cases = cases.filter(pc.is_valid(cases.column('location')))
+            cases = cases.set_column(0, 'case_enquiry_id', pc.cast(cases.column('case_enquiry_id'), pa.string()))
+            cases = cases.group_by('case_enquiry_id').aggregate([('location', 'max')]).rename_columns(['case_enquiry_id', 'location'])
+            md.register("location_fill", cases)
+            try:
+                phase['rows_out'] += md.execute(f"""
+                UPDATE {stage_tbl_name} AS t SET location = f.location
+                FROM location_fill AS f
+                WHERE t.case_enquiry_id = f.case_enquiry_id AND t.location IS NULL;
+                """).fetchone()[0]
+            finally:
+                md.unregister("location_fill")
+    print(f"{stage_tbl_name}: location filled in for {phase['rows_out']} of {phase['rows_in']} requests without one")
+    if phase['rows_out']:
+        # the rollups follow at the next reconcile, the key filters are rebuilt with the filled requests
+        schema_registry.bump_data_version(md)
+        key_index.bump_version(md)
+    return phase['rows_out']
+
+# Function to fill in the columns of stage rows loaded before the columns existed, a no-op once they are filled
+def fill_existing_rows(md, tm=None):
+    filled = {
+        'locations_geo': fill_location_geo(md, tm),
+    }
+    if any(filled.values()):
+        schema_registry.bump_data_version(md)
+    return filled
+
+# Function to rewrite the locations in order of their finest geohash cell, so nearby locations share row groups
+# inserts only sort within each batch; a copy is written in order and swapped in, with its constraints
+def recluster_locations(md, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    stage_tbl_name = f"{stage_db_schema}.locations"
+    sorted_name = "locations__sorted"
+    with tm.phase('recluster', table=stage_tbl_name) as phase:
+        md.execute("BEGIN TRANSACTION;")
+        try:
+            md.execute(f"DROP TABLE IF EXISTS {stage_db_schema}.{sorted_name};")
+            md.execute(schema_registry.create_table_sql('locations', sorted_name))
+            phase['rows_out'] = md.execute(f"""
+            INSERT INTO {stage_db_schema}.{sorted_name}
+            SELECT * FROM {stage_tbl_name}
+            ORDER BY {geo.finest_geohash} NULLS LAST, location;
+            """).fetchone()[0]
+            md.execute(f"DROP TABLE {stage_tbl_name};")
+            md.execute(f"ALTER TABLE {stage_db_schema}.{sorted_name} RENAME TO locations;")
+            md.execute("COMMIT;")
+        except Exception:
+            md.execute("ROLLBACK;")
+            raise
+    print(f"{stage_tbl_name}: {phase['rows_out']} rows rewritten in {geo.finest_geohash} order")
+    return phase['rows_out']
+
+# Function to create the raw schema and the ingest progress table, the raw tables of earlier loads stay until a table is loaded again
+def prepare_raw_schema(md, tm=None):
+    tm = tm or telemetry.Telemetry('load')
+    create_schema = f"""
+    CREATE SCHEMA IF NOT EXISTS {raw_db_schema};
+    CREATE TABLE IF NOT EXISTS {progress_tbl_name} (
+        job_id VARCHAR
+        ,raw_table VARCHAR
+        ,chunk INTEGER
+        ,rows BIGINT
+        ,committed_at TIMESTAMP
+        ,PRIMARY KEY (job_id, raw_table, chunk)
+    );
+    CREATE TABLE IF NOT EXISTS {markers_tbl_name} (
+        job_id VARCHAR
+        ,stage_table VARCHAR
+        ,status VARCHAR
+        ,raw_rows BIGINT
+        ,inserted_rows BIGINT
+        ,new_dimension_values INTEGER
+        ,seconds DOUBLE
+        ,error VARCHAR
+        ,updated_at TIMESTAMP
+        ,PRIMARY KEY (job_id, stage_table)
+    );
+    DELETE FROM {markers_tbl_name} WHERE updated_at < now() - INTERVAL {marker_retention_days} DAY;
     """
-    print(f"{raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
-
-    # ingest into raw schema
-    ingest_sql = f"INSERT INTO {raw_tbl_name} SELECT * FROM location_df"
-    print(f"Import statement: {ingest_sql}")
-    md.sql(ingest_sql)
-    del location_df
-
-    # upsert like operation -- will only insert new records, not update
-    upsert_sql = f"""
-    INSERT INTO {stage_db_schema}.location AS stage
-    SELECT *
+    with tm.phase('ddl', detail='raw schema'):
+        md.sql(create_schema)
+
+# Function to record how the load of a table ended for a job, 'done' or 'failed'
+def mark_table(md, job_id, stage_table, status, result=None, error=None):
+    result = result or {}
+    md.execute(f"""
+    INSERT INTO {markers_tbl_name} VALUES (?, ?, ?, ?, ?, ?, ?, ?, now())
+    ON CONFLICT (job_id, stage_table) DO UPDATE SET
+        status = EXCLUDED.status, raw_rows = EXCLUDED.raw_rows, inserted_rows = EXCLUDED.inserted_rows,
+        new_dimension_values = EXCLUDED.new_dimension_values, seconds = EXCLUDED.seconds,
+        error = EXCLUDED.error, updated_at = EXCLUDED.updated_at;
+    """, [job_id, stage_table, status, result.get('raw_rows'), result.get('inserted_rows'),
+          result.get('new_dimension_values'), result.get('seconds'), error])
+
+# Function to read the markers of a job, stage table -> status and result
+def table_status(md, job_id):
+    rows = md.execute(f"""
+    SELECT stage_table, status, raw_rows, inserted_rows, new_dimension_values, seconds, error
+    FROM {markers_tbl_name} WHERE job_id = ?
+    """, [job_id]).fetchall()
+    fields = ['status', 'raw_rows', 'inserted_rows', 'new_dimension_values', 'seconds', 'error']
+    return {row[0]: dict(zip(fields, row[1:])) for row in rows}
+
+# Function to run a table's upsert, committed together with the table's marker so a finished table is never loaded twice
+def commit_upsert(cur, upsert_sql, spec, job_id, result):
+    cur.execute("BEGIN TRANSACTION;")
+    try:
+        result['inserted_rows'] = cur.execute(upsert_sql).fetchone()[0]
+        if job_id:
+            mark_table(cur, job_id, spec['stage_table'], 'done', result)
+        cur.execute("COMMIT;")
+    except Exception:
+        cur.execute("ROLLBACK;")
+        raise
+    return result['inserted_rows']
+
+# Function to build the ON CONFLICT action of a table's upsert
+# records that changed are updated in place, unchanged ones are not touched
+def conflict_action(md, spec, stage_tbl_name):
+    if not spec['update_on_conflict'] and spec['fill_on_conflict']:
+        # only the columns the record does not have yet
+        fills = ", ".join(f"{col} = coalesce(stage.{col}, EXCLUDED.{col})" for col in spec['fill_on_conflict'])
+        missing = " OR ".join(f"(stage.{col} IS NULL AND EXCLUDED.{col} IS NOT NULL)" for col in spec['fill_on_conflict'])
+        return f"DO UPDATE SET {fills} WHERE {missing}"
+    if not spec['update_on_conflict']:
+        return "DO NOTHING"
+    columns = [row[0] for row in md.execute(f"DESCRIBE {stage_tbl_name}").fetchall() if row[0] not in spec['conflict_keys']]
+    updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns)
+    changed = " OR ".join(f"stage.{col} IS DISTINCT FROM EXCLUDED.{col}" for col in columns)
+    return f"DO UPDATE SET {updates} WHERE {changed}"
+
+# Function to record the keys of the raw rows the upsert is about to insert or change, returns how many
+# (new keys, and for a table that updates, keys whose values differ from stage -- the same rule as conflict_action)
+def record_changed_keys(cur, spec, raw_tbl_name, stage_tbl_name):
+    keys = spec['conflict_keys']
+    columns = [row[0] for row in cur.execute(f"DESCRIBE {stage_tbl_name}").fetchall() if row[0] not in keys] if spec['update_on_conflict'] else []
+    join = " AND ".join(f"stage.{col} = raw.{col}" for col in keys)
+    changed = " OR ".join([f"stage.{keys[0]} IS NULL"] + [f"stage.{col} IS DISTINCT FROM raw.{col}" for col in columns])
+    return cur.execute(f"""
+    CREATE OR REPLACE TABLE {changed_tbl_name(raw_tbl_name)} AS
+    SELECT DISTINCT {', '.join(f'raw.{col}' for col in keys)}
     FROM {raw_tbl_name} AS raw
-    ON CONFLICT (_id, location)
-    DO NOTHING;
-    """
-    print(upsert_sql)
-    md.sql(upsert_sql)
-
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ tbl: department_assignment
-
-    # read in from gcs
-    department_assignment_path = request_json.get('department_assignment')
-    department_assignment_df = pd.read_parquet(department_assignment_path)
-
-    # table logic
-    raw_tbl_name = f"{raw_db_schema}.department_assignment"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name} ;
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_db_schema}.department_assignment WHERE FALSE;
+    LEFT JOIN {stage_tbl_name} AS stage ON {join}
+    WHERE {changed};
+    """).fetchone()[0]
+
+# Function to recompute a derived table for the records the upsert of its source table inserted or changed
+def derive_table(cur, spec, tm, raw_suffix="", job_id=None):
+    start = time.perf_counter()
+    stage_tbl_name = f"{stage_db_schema}.{spec['stage_table']}"
+    source = next(s for s in table_specs if s['stage_table'] == spec['derived_from'])
+    batch_tbl_name = changed_tbl_name(f"{raw_db_schema}.{source['raw_table']}{raw_suffix}")
+
+    query = derivations[spec['stage_table']](batch_tbl_name)
+    columns = [row[0] for row in cur.execute(f"DESCRIBE {query}").fetchall()]
+    upsert_sql = f"""
+    INSERT INTO {stage_tbl_name} AS stage ({', '.join(columns)})
+    {query}
+    ON CONFLICT ({', '.join(spec['conflict_keys'])})
+    {conflict_action(cur, spec, stage_tbl_name)};
     """
-    print(f"{raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
-
-    # ingest into raw schema
-    ingest_sql = f"INSERT INTO {raw_tbl_name} SELECT * FROM department_assignment_df"
-    print(f"Import statement: {ingest_sql}")
-    md.sql(ingest_sql)
-    del department_assignment_df
-
-    # upsert like operation -- will only insert new records, not update
+    with tm.phase('upsert', table=stage_tbl_name, detail=f"derived from {spec['derived_from']}") as phase:
+        phase['rows_in'] = cur.execute(f"SELECT count(*) FROM (SELECT DISTINCT {', '.join(spec['conflict_keys'])} FROM {batch_tbl_name})").fetchone()[0]
+        result = {'raw_rows': phase['rows_in'], 'new_dimension_values': 0, 'seconds': round(time.perf_counter() - start, 3)}
+        phase['rows_out'] = commit_upsert(cur, upsert_sql, spec, job_id, result)
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    return {**result, 'status': 'loaded'}
+
+# Function to run the raw + upsert pipeline for one table on its own cursor
+# raw_suffix keeps the raw tables of loads running side by side apart (backfill shards)
+# job_id lets a retried load resume the ingest at the first chunk that did not commit, and marks the table done
+# index is the table's key filter, or None to send every row
+def load_table(md, spec, source, tm=None, raw_suffix="", job_id=None, index=None):
+    tm = tm or telemetry.Telemetry('load')
+    cur = md.cursor()
+    if spec['derived_from']:
+        result = derive_table(cur, spec, tm, raw_suffix, job_id)
+        cur.close()
+        return result
+
+    start = time.perf_counter()
+    raw_tbl_name = f"{raw_db_schema}.{spec['raw_table']}{raw_suffix}"
+    stage_tbl_name = f"{stage_db_schema}.{spec['stage_table']}"
+
+    # table logic -- a retry of the same job keeps the chunks it committed, otherwise the raw table starts empty
+    with tm.phase('ddl', table=raw_tbl_name):
+        done = committed_chunks(cur, job_id, raw_tbl_name) if job_id else {}
+        if done:
+            try:
+                raw_count = cur.execute(f"SELECT count(*) FROM {raw_tbl_name}").fetchone()[0]
+            except duckdb.CatalogException:
+                raw_count = None
+            if raw_count != sum(done.values()):
+                print(f"{raw_tbl_name} does not hold the chunks recorded for {job_id}, starting over")
+                done = {}
+        if done:
+            print(f"{raw_tbl_name}: resuming {job_id} after {len(done)} committed chunks")
+        else:
+            clear_raw_table(cur, raw_tbl_name)
+            cur.execute(f"CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_tbl_name} WHERE FALSE;")
+
+    # ingest into raw schema straight from parquet (or arrow in fused mode), chunk by chunk
+    raw_rows = ingest(cur, source, raw_tbl_name, stage_tbl_name, tm, job_id, index)
+
+    # small integer keys in place of the repeated text
+    new_dimension_values = encode_dimensions(cur, spec, raw_tbl_name, tm)
+
+    # the tables derived from this one are recomputed for the records the upsert inserts or changes only
+    if any(s['derived_from'] == spec['stage_table'] for s in table_specs):
+        with tm.phase('changed_keys', rows_in=raw_rows, table=raw_tbl_name) as phase:
+            phase['rows_out'] = record_changed_keys(cur, spec, raw_tbl_name, stage_tbl_name)
+
+    # upsert -- new records are inserted, changed ones updated where the table allows it
+    order_by = f"ORDER BY {', '.join(spec['order_by'])}" if spec['order_by'] else ""
     upsert_sql = f"""
-    INSERT INTO {stage_db_schema}.department_assignment AS stage
+    INSERT INTO {stage_tbl_name} AS stage
     SELECT *
     FROM {raw_tbl_name} AS raw
-    ON CONFLICT (_id, case_enquiry_id, department)
-    DO NOTHING;
+    {order_by}
+    ON CONFLICT ({', '.join(spec['conflict_keys'])})
+    {conflict_action(cur, spec, stage_tbl_name)};
     """
-    print(upsert_sql)
-    md.sql(upsert_sql)
+    with tm.phase('upsert', rows_in=raw_rows, table=stage_tbl_name) as phase:
+        result = {'raw_rows': raw_rows, 'new_dimension_values': new_dimension_values, 'seconds': round(time.perf_counter() - start, 3)}
+        phase['rows_out'] = commit_upsert(cur, upsert_sql, spec, job_id, result)
+    cur.close()
+
+    result['seconds'] = round(time.perf_counter() - start, 3)
+    if index is not None:
+        result['filtered_rows'] = index.stats['known'] + index.stats['duplicates']
+    return {**result, 'status': 'loaded'}
+
+# Function to get the key filters of the tables in the batch that only insert new keys, stage table -> index
+# a filter that cannot be read or rebuilt is left out, its table sends every row as before
+def key_indexes(md, specs, tm, version):
+    indexes = {}
+    for spec in specs:
+        if spec['update_on_conflict'] or spec['derived_from']:
+            continue
+        stage_table = spec['stage_table']
+        types = dict(schema_registry.tables[stage_table]['columns'])
+        with tm.phase('key_index', table=f"{stage_db_schema}.{stage_table}") as phase:
+            try:
+                indexes[stage_table], phase['detail'] = key_index.get_index(
+                    md, bucket_name, stage_table, {col: types[col] for col in spec['conflict_keys']}, version,
+                    spec['fill_on_conflict'])
+                phase['rows_out'] = len(indexes[stage_table].hashes)
+            except Exception as e:
+                print(f"{stage_table}: no key filter, sending every row: {str(e)}")
+    return indexes
+
+# Function to bump the key version after rows went into the key filtered tables, and save the deltas of the filters that are still exact
+# a filter is exact when no other load bumped the version since it was read and it saw every row of its table;
+# the tables this load did not insert into get an empty delta, the others without an exact filter none and are rebuilt
+def update_key_indexes(md, results, indexes, version, in_batch=()):
+    keyed = [spec['stage_table'] for spec in table_specs if not spec['update_on_conflict'] and not spec['derived_from']]
+    if not any(results[name]['inserted_rows'] for name in keyed if results.get(name, {}).get('status') == 'loaded'):
+        return
+    new_version = key_index.bump_version(md)
+    if new_version != version + 1:
+        return
+    for name in keyed:
+        status = results.get(name, {}).get('status')
+        try:
+            if status == 'loaded' and name in indexes and indexes[name].complete:
+                key_index.save_index(bucket_name, indexes[name], new_version)
+            elif status == 'skipped' or name not in in_batch:
+                key_index.save_delta(bucket_name, name, new_version)
+        except Exception as e:
+            print(f"{name}: key filter not saved, the next load rebuilds it: {str(e)}")
+
+# Function to load every table in the request, a table starts once the tables it depends on are done
+# sources maps each source_key to a parquet path, or to an arrow table in fused mode
+# with a job_id, tables the job already finished are skipped and a table that fails is marked so;
+# the other tables still finish, then the first failure is raised for the caller to retry
+# use_key_filter drops the rows whose key is already in stage before they are sent (key_filter by default)
+def load_tables(md, sources, tm=None, raw_suffix="", job_id=None, use_key_filter=None):
+    tm = tm or telemetry.Telemetry('load')
+    use_key_filter = key_filter if use_key_filter is None else use_key_filter
+
+    # tables with a transform output in the request, and the tables derived from them
+    in_batch = {spec['stage_table'] for spec in table_specs if spec['source_key'] and sources.get(spec['source_key']) is not None}
+    in_batch |= {spec['stage_table'] for spec in table_specs if spec['derived_from'] in in_batch}
+
+    # the raw schema holds this batch only, the raw tables of other tables are from an earlier load
+    for spec in table_specs:
+        if spec['raw_table'] and spec['stage_table'] not in in_batch:
+            clear_raw_table(md, f"{raw_db_schema}.{spec['raw_table']}{raw_suffix}")
+    pending = {spec['stage_table']: spec for spec in table_specs if spec['stage_table'] in in_batch}
+    results = {}
+    running = {}
+    failed = {}
+
+    # tables finished by an earlier attempt of this job
+    finished = table_status(md, job_id) if job_id else {}
+    for name in list(pending):
+        if finished.get(name, {}).get('status') == 'done':
+            results[name] = {**finished[name], 'status': 'skipped'}
+            del results[name]['error']
+            del pending[name]
+            print(f"{name}: already loaded by {job_id}, skipped")
+
+    # the key version is read before the filters, a load bumping it in the meantime makes them stale
+    keys_version = key_index.current_version(md)
+    indexes = key_indexes(md, pending.values(), tm, keys_version) if use_key_filter else {}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            for name, spec in list(pending.items()):
+                if any(dep in failed for dep in spec['depends_on']):
+                    # left for the retry, after the table it depends on
+                    del pending[name]
+                elif all(dep in results or dep not in in_batch for dep in spec['depends_on']):
+                    source = sources.get(spec['source_key'])
+                    running[pool.submit(load_table, md, spec, source, tm, raw_suffix, job_id, indexes.get(name))] = name
+                    del pending[name]
+
+            if not running:
+                if pending:
+                    raise Exception(f"Circular table dependencies: {sorted(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    failed[name] = e
+                    print(f"{name}: failed, {str(e)}")
+                    if job_id:
+                        mark_table(md, job_id, name, 'failed', error=str(e))
+                    continue
+                print(f"{name}: {results[name]}")
+
+    for index in indexes.values():
+        index.close()
+
+    # bumped for the tables that did load, even when another one failed, so no filter misses their keys
+    update_key_indexes(md, results, indexes, keys_version, in_batch)
+
+    if failed:
+        raise next(iter(failed.values()))
+
+    # readers drop their cached results once new or changed records are in (skipped tables went in on an earlier attempt)
+    if any(result['inserted_rows'] for result in results.values() if result['status'] == 'loaded'):
+        schema_registry.bump_data_version(md)
+
+    return results
 
 
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ tbl: response_time
 
-    # read in from gcs
-    response_time_path = request_json.get('response_time')
-    response_time_df = pd.read_parquet(response_time_path)
-    
-    # table logic
-    raw_tbl_name = f"{raw_db_schema}.response_time"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name} ;
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_db_schema}.response_time WHERE FALSE;
-    """
-    print(f"{raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
+############################################################### main task
 
-    # ingest into raw schema
-    ingest_sql = f"INSERT INTO {raw_tbl_name} SELECT * FROM response_time_df"
-    print(f"Import statement: {ingest_sql}")
-    md.sql(ingest_sql)
-    del response_time_df
+@functions_framework.http
+def main(request):
 
-    # upsert like operation -- will only insert new records, not update
-    upsert_sql = f"""
-    INSERT INTO {stage_db_schema}.response_time AS stage
-    SELECT *
-    FROM {raw_tbl_name} AS raw
-    ON CONFLICT (_id, case_enquiry_id)
-    DO NOTHING;
-    """
-    print(upsert_sql)
-    md.sql(upsert_sql)
+    # Parse the request data
+    request_json = request.get_json(silent=True)
+    print(f"request: {json.dumps(request_json)}")
 
+    tm = telemetry.Telemetry('load')
 
-    #~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~ tbl: status_history
+    # reuse the MotherDuck connection of a warm instance
+    md = connections.get_motherduck()
 
-    # read in from gcs
-    status_history_path = request_json.get('status_history')
-    status_history_df = pd.read_parquet(status_history_path)
+    # one-off: encode the rows that were loaded before the dimension tables existed
+    if request_json.get('encode_existing'):
+        encoded = encode_existing_rows(md, tm)
+        return {'encoded': encoded, 'connections': connections.cache_stats(), 'telemetry': tm.report()}, 200
 
-    # table logic
-    raw_tbl_name = f"{raw_db_schema}.status_history"
-    raw_tbl_sql = f"""
-    DROP TABLE IF EXISTS {raw_tbl_name} ;
-    CREATE TABLE {raw_tbl_name} AS SELECT * FROM {stage_db_schema}.status_history WHERE FALSE;
-    """
-    print(f"{raw_tbl_sql}")
-    md.sql(raw_tbl_sql)
+    # one-off: fill in the location of the requests that were loaded before requests had one
+    if request_json.get('fill_locations'):
+        filled = fill_request_locations(md, tm)
+        return {'filled': {'requests_location': filled}, 'connections': connections.cache_stats(), 'telemetry': tm.report()}, 200
 
-    # ingest into raw schema
-    ingest_sql = f"INSERT INTO {raw_tbl_name} SELECT * FROM status_history_df"
-    print(f"Import statement: {ingest_sql}")
-    md.sql(ingest_sql)
-    del status_history_df
+    # scheduled (flows/compact.py): rewrite the locations in geohash order
+    if request_json.get('recluster'):
+        rows = recluster_locations(md, tm)
+        return {'reclustered': {'locations': rows}, 'connections': connections.cache_stats(), 'telemetry': tm.report()}, 200
 
-    # upsert like operation -- will only insert new records, not update
-    upsert_sql = f"""
-    INSERT INTO {stage_db_schema}.status_history AS stage
-    SELECT *
-    FROM {raw_tbl_name} AS raw
-    ON CONFLICT (_id, case_enquiry_id, open_dt)
-    DO NOTHING;
-    """
-    print(upsert_sql)
-    md.sql(upsert_sql)
+    # create the raw schema and the ingest progress and load marker tables if they are not there
+    prepare_raw_schema(md, tm)
+
+    # columns added to stage after rows were loaded are filled in once for those rows
+    fill_existing_rows(md, tm)
 
+    # load the tables in parallel, a retry of the same job skips the finished tables and resumes where the ingest stopped
+    job_id = request_json.get('jobid')
+    try:
+        tables = load_tables(md, request_json, tm, job_id=job_id)
+    except Exception as e:
+        print(f"The load failed: {str(e)}")
+        tables = table_status(md, job_id) if job_id else {}
+        return {'error': str(e), 'jobid': job_id, 'tables': tables, 'telemetry': tm.report()}, 500
 
-    return {}, 200
\ No newline at end of file
+    return {'tables': tables, 'connections': connections.cache_stats(), 'telemetry': tm.report()}, 200
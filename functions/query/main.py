@@ -0,0 +1,259 @@
+# imports
+import functions_framework
+import collections
+import contextlib
+import datetime
+import json
+import queue
+import threading
+from shared import connections
+from shared import schema_registry
+from shared import telemetry
+
+# db setup
+stage_db_schema = schema_registry.db_schema
+
+# serving settings
+pool_size = 4           # cursors on the read-only MotherDuck connection, also the queries running at once
+cache_entries = 256     # results kept in memory, the least recently used is dropped first
+max_rows = 5000         # rows one query returns at most
+
+# location columns the counts can be grouped by, and the rollup columns the SLA summary can be grouped by
+district_columns = schema_registry.dimensions['locations'] + ['ward', 'location_zipcode']
+sla_groups = ['neighborhood', 'department']
+
+# module state, lives as long as the instance
+_lock = threading.Lock()
+_slots = threading.BoundedSemaphore(pool_size)
+_pool = {'connection': None, 'cursors': queue.LifoQueue()}
+_cache = collections.OrderedDict()      # (query, params, data version) -> result
+_cache_state = {'version': None}
+
+stats = {
+    'cursors_created': 0,
+    'cache_hits': 0,
+    'cache_misses': 0,
+    'cache_evictions': 0,
+    'cache_invalidations': 0,
+}
+
+
+# Function to read a required parameter
+def param(params, name):
+    if params.get(name) in (None, ""):
+        raise ValueError(f"missing parameter: {name}")
+    return params[name]
+
+# Function to read a date parameter, YYYY-MM-DD
+def date_param(params, name):
+    value = param(params, name)
+    try:
+        return datetime.date.fromisoformat(str(value))
+    except ValueError:
+        raise ValueError(f"{name} must be a date (YYYY-MM-DD), got {value!r}")
+
+# Function to read a parameter that names a column, only the allowed ones (identifiers cannot be bound)
+def column_param(params, name, allowed, default):
+    value = params.get(name) or default
+    if value not in allowed:
+        raise ValueError(f"{name} must be one of {', '.join(allowed)}, got {value!r}")
+    return value
+
+# Function to build the case lookup: one row per status of the case, with its location and departments
+def case_sql(params):
+    case_id = str(param(params, 'case_enquiry_id'))
+    return f"""
+    SELECT
+        r.case_enquiry_id,
+        r.case_title,
+        r.subject,
+        r.reason,
+        r.type,
+        r.queue,
+        r.source,
+        (SELECT list(d.department ORDER BY d.department) FROM {stage_db_schema}.department_assignment_decoded AS d
+         WHERE d.case_enquiry_id = r.case_enquiry_id) AS departments,
+        s.open_dt,
+        s.sla_target_dt,
+        s.closed_dt,
+        s.case_status,
+        s.closure_reason,
+        rt.on_time,
+        rt.time_to_close_hours,
+        rt.sla_slack_hours,
+        r.location,
+        l.neighborhood,
+        l.location_street_name,
+        l.location_zipcode,
+        l.latitude,
+        l.longitude
+    FROM {stage_db_schema}.requests_decoded AS r
+    LEFT JOIN {stage_db_schema}.status_history_decoded AS s ON s.case_enquiry_id = r.case_enquiry_id
+    LEFT JOIN {stage_db_schema}.response_time AS rt ON rt.case_enquiry_id = r.case_enquiry_id
+    LEFT JOIN {stage_db_schema}.locations_decoded AS l ON l.location = r.location
+    WHERE r.case_enquiry_id = ?
+    ORDER BY s.open_dt
+    """, [case_id]
+
+# Function to build the counts by district for cases opened in a date range (inclusive), by the latest status in the range
+def district_counts_sql(params):
+    district = column_param(params, 'district', district_columns, 'neighborhood')
+    open_from, open_to = date_param(params, 'open_from'), date_param(params, 'open_to')
+    return f"""
+    WITH latest AS (
+        SELECT case_enquiry_id, closed_dt
+        FROM {stage_db_schema}.status_history
+        WHERE open_dt >= ? AND open_dt < ? + INTERVAL 1 DAY
+        QUALIFY row_number() OVER (PARTITION BY case_enquiry_id ORDER BY open_dt DESC) = 1
+    )
+    SELECT
+        l.{district} AS district,
+        count(*) AS requests,
+        count(*) FILTER (WHERE latest.closed_dt IS NULL) AS open_requests,
+        count(*) FILTER (WHERE latest.closed_dt IS NOT NULL) AS closed_requests
+    FROM latest
+    LEFT JOIN {stage_db_schema}.requests AS r ON r.case_enquiry_id = latest.case_enquiry_id
+    LEFT JOIN {stage_db_schema}.locations_decoded AS l ON l.location = r.location
+    GROUP BY 1
+    ORDER BY requests DESC, district
+    """, [open_from, open_to]
+
+# Function to build the SLA summary by neighborhood or department for a date range (inclusive), from the daily rollup
+def sla_summary_sql(params):
+    group_by = column_param(params, 'group_by', sla_groups, 'department')
+    open_from, open_to = date_param(params, 'open_from'), date_param(params, 'open_to')
+    return f"""
+    SELECT
+        dim.{group_by},
+        sum(r.requests) AS requests,
+        sum(r.open_requests) AS open_requests,
+        sum(r.closed_requests) AS closed_requests,
+        sum(r.on_time_requests) / nullif(sum(r.sla_requests), 0) AS on_time_rate,
+        sum(r.time_to_close_hours_sum) / nullif(sum(r.closed_requests), 0) AS avg_time_to_close_hours
+    FROM {stage_db_schema}.rollup_daily AS r
+    LEFT JOIN {stage_db_schema}.dim_{group_by} AS dim ON dim.{group_by}_key = r.{group_by}_key
+    WHERE r.open_date BETWEEN ? AND ?
+    GROUP BY 1
+    ORDER BY requests DESC, 1
+    """, [open_from, open_to]
+
+# the queries served, by name -> function building the SQL and its bound parameters
+queries = {
+    'case': case_sql,
+    'district_counts': district_counts_sql,
+    'sla_summary': sla_summary_sql,
+}
+
+
+# Function to borrow a cursor of the pool, waits while pool_size queries are running
+# the cursors are on the read-only connection; the pool starts over when it was reopened, the old cursors died with it
+@contextlib.contextmanager
+def pooled_cursor():
+    with _slots:
+        md = connections.get_motherduck_readonly()
+        with _lock:
+            if _pool['connection'] is not md:
+                _pool['connection'] = md
+                _pool['cursors'] = queue.LifoQueue()
+            cursors = _pool['cursors']
+        try:
+            cur = cursors.get_nowait()
+        except queue.Empty:
+            cur = md.cursor()
+            with _lock:
+                stats['cursors_created'] += 1
+        try:
+            yield cur
+        except Exception:
+            # a cursor that failed is not handed out again
+            cur.close()
+            raise
+        cursors.put(cur)
+
+# Function to look up a cached result, every entry is dropped once the data version moved on
+def cache_get(key, version):
+    with _lock:
+        if _cache_state['version'] != version:
+            if _cache:
+                stats['cache_invalidations'] += 1
+            _cache.clear()
+            _cache_state['version'] = version
+        if key in _cache:
+            _cache.move_to_end(key)
+            stats['cache_hits'] += 1
+            return _cache[key]
+        stats['cache_misses'] += 1
+        return None
+
+# Function to keep a result, the least recently used one goes when the cache is full
+def cache_put(key, version, result):
+    with _lock:
+        if _cache_state['version'] != version:
+            return
+        _cache[key] = result
+        _cache.move_to_end(key)
+        while len(_cache) > cache_entries:
+            _cache.popitem(last=False)
+            stats['cache_evictions'] += 1
+
+# Function to run a named query, from the cache when the data did not change since it last ran
+def run_query(name, params, tm=None):
+    tm = tm or telemetry.Telemetry('query')
+    if name not in queries:
+        raise ValueError(f"unknown query {name!r}, one of {', '.join(queries)}")
+    sql, args = queries[name](params)
+
+    with pooled_cursor() as cur:
+        with tm.phase('version'):
+            version = schema_registry.read_data_version(cur)
+
+        # the SQL carries the column parameters, the arguments the bound ones
+        key = (sql, json.dumps(args, default=str), version)
+        result = cache_get(key, version)
+        if result is not None:
+            tm.record('cache', 0.0, rows_out=len(result['rows']), query=name)
+            return {**result, 'cached': True}
+
+        with tm.phase('query', query=name) as phase:
+            cursor = cur.execute(sql, args)
+            columns = [col[0] for col in cursor.description]
+            rows = cursor.fetchmany(max_rows + 1)
+            phase['rows_out'] = len(rows)
+
+    # dates, timestamps and decimals as text, like the JSON response will carry them
+    result = json.loads(json.dumps({
+        'query': name,
+        'data_version': version,
+        'columns': columns,
+        'rows': [list(row) for row in rows[:max_rows]],
+        'truncated': len(rows) > max_rows,
+    }, default=str))
+    cache_put(key, version, result)
+    return {**result, 'cached': False}
+
+# Function to report the pool and cache counters
+def serving_stats():
+    with _lock:
+        return {**stats, 'cache_size': len(_cache)}
+
+
+############################################################### main task
+
+@functions_framework.http
+def main(request):
+
+    # Parse the request data, e.g. {"query": "sla_summary", "params": {"open_from": "2024-01-01", "open_to": "2024-03-31"}}
+    request_json = request.get_json(silent=True) or {}
+    print(f"request: {json.dumps(request_json)}")
+
+    tm = telemetry.Telemetry('query')
+
+    # only the named queries run, with bound parameters, nothing else reaches the database
+    try:
+        result = run_query(request_json.get('query'), request_json.get('params') or {}, tm)
+    except ValueError as e:
+        return {'error': str(e), 'queries': list(queries)}, 400
+
+    result['serving'] = serving_stats()
+    result['telemetry'] = tm.report()
+    return result, 200
@@ -0,0 +1,249 @@
+# imports
+import functions_framework
+import json
+from shared import connections
+from shared import schema_registry
+from shared import telemetry
+
+# db setup
+db = schema_registry.db
+raw_db_schema = f"{db}.raw"
+stage_db_schema = schema_registry.db_schema
+
+# raw tables of a load whose cases can move to another group or change status
+# (locations is left out: a location row is only inserted once, its cases come in through requests)
+batch_tables = ['requests', 'status_history', 'department_assignment']
+
+# the columns identifying a rollup group, and the measures summed per group
+group_columns = ['open_date', 'neighborhood_key', 'department_key']
+measures = {
+    'requests': "count(*)",
+    'open_requests': "count(*) FILTER (WHERE NOT is_closed)",
+    'closed_requests': "count(*) FILTER (WHERE is_closed)",
+    'on_time_requests': "count(*) FILTER (WHERE on_time)",
+    'sla_requests': "count(*) FILTER (WHERE on_time IS NOT NULL)",
+    'time_to_close_hours_sum': "coalesce(sum(time_to_close_hours), 0)",
+}
+
+# reconcile settings
+max_reported_groups = 20    # groups listed when a reconcile finds differences
+float_tolerance = 1e-6      # hours a summed duration may be off by
+
+
+# Function to build the query for the rollup rows of some cases (all cases when cases_tbl_name is None)
+# a case is counted on the day of its latest status row, in the neighborhood of its location and once per department
+def case_facts_sql(cases_tbl_name=None):
+    where = f"WHERE case_enquiry_id IN (SELECT case_enquiry_id FROM {cases_tbl_name})" if cases_tbl_name else ""
+    return f"""
+    WITH latest AS (
+        SELECT case_enquiry_id, open_dt, closed_dt
+        FROM {stage_db_schema}.status_history
+        {where}
+        QUALIFY row_number() OVER (PARTITION BY case_enquiry_id ORDER BY open_dt DESC NULLS LAST) = 1
+    )
+    SELECT
+        latest.case_enquiry_id,
+        coalesce(da.department_key, 0) AS department_key,
+        CAST(latest.open_dt AS DATE) AS open_date,
+        coalesce(loc.neighborhood_key, 0) AS neighborhood_key,
+        latest.closed_dt IS NOT NULL AS is_closed,
+        rt.on_time,
+        rt.time_to_close_hours
+    FROM latest
+    LEFT JOIN {stage_db_schema}.requests AS r ON r.case_enquiry_id = latest.case_enquiry_id
+    LEFT JOIN {stage_db_schema}.locations AS loc ON loc.location = r.location
+    LEFT JOIN {stage_db_schema}.department_assignment AS da ON da.case_enquiry_id = latest.case_enquiry_id
+    LEFT JOIN {stage_db_schema}.response_time AS rt ON rt.case_enquiry_id = latest.case_enquiry_id
+    """
+
+# Function to build the query summing case rows into groups
+def group_totals_sql(facts):
+    select = ",\n        ".join(f"{expr} AS {name}" for name, expr in measures.items())
+    return f"""
+    SELECT
+        {', '.join(group_columns)},
+        {select}
+    FROM {facts}
+    GROUP BY {', '.join(group_columns)}
+    """
+
+# Function to list the raw tables the last load left, with the given suffix
+def batch_sources(cur, raw_suffix=""):
+    present = {row[0] for row in cur.execute(f"""
+    SELECT table_name FROM information_schema.tables
+    WHERE table_catalog = '{db}' AND table_schema = 'raw'
+    """).fetchall()}
+    return [f"{raw_db_schema}.{name}{raw_suffix}" for name in batch_tables if f"{name}{raw_suffix}" in present]
+
+# Function to bring the rollups of some cases up to date, only the groups they were or are now counted in are recomputed
+# cases_tbl_name is a temp table of case ids; full also recomputes the groups no case is counted in any more
+def refresh(cur, cases_tbl_name, tm, full=False):
+    group_match = " AND ".join(f"g.{col} = t.{col}" for col in group_columns)
+    group_list = ", ".join(group_columns)
+    result = {}
+
+    cur.execute("BEGIN TRANSACTION;")
+    try:
+        with tm.phase('facts', table=f"{stage_db_schema}.rollup_cases") as phase:
+            cur.execute(f"CREATE OR REPLACE TEMP TABLE new_facts AS {case_facts_sql(cases_tbl_name)};")
+
+            # the groups the cases were counted in before this batch, and the ones they are counted in now
+            daily_groups = f"UNION SELECT {group_list} FROM {stage_db_schema}.rollup_daily" if full else ""
+            cur.execute(f"""
+            CREATE OR REPLACE TEMP TABLE affected_groups AS
+            SELECT {group_list} FROM {stage_db_schema}.rollup_cases
+            WHERE case_enquiry_id IN (SELECT case_enquiry_id FROM {cases_tbl_name})
+            UNION
+            SELECT {group_list} FROM new_facts
+            {daily_groups};
+            """)
+
+            # upsert then delete what is gone, so no key is deleted and inserted again in one transaction
+            columns = [col for col, _ in schema_registry.tables['rollup_cases']['columns']]
+            updates = ", ".join(f"{col} = EXCLUDED.{col}" for col in columns if col not in ('case_enquiry_id', 'department_key'))
+            cur.execute(f"""
+            INSERT INTO {stage_db_schema}.rollup_cases ({', '.join(columns)})
+            SELECT {', '.join(columns)} FROM new_facts
+            ON CONFLICT (case_enquiry_id, department_key) DO UPDATE SET {updates};
+            """)
+            cur.execute(f"""
+            DELETE FROM {stage_db_schema}.rollup_cases AS t
+            WHERE t.case_enquiry_id IN (SELECT case_enquiry_id FROM {cases_tbl_name})
+            AND NOT EXISTS (
+                SELECT 1 FROM new_facts AS g
+                WHERE g.case_enquiry_id = t.case_enquiry_id AND g.department_key = t.department_key
+            );
+            """)
+            phase['rows_out'] = result['cases'] = cur.execute("SELECT count(*) FROM new_facts").fetchone()[0]
+
+        with tm.phase('aggregate', table=f"{stage_db_schema}.rollup_daily") as phase:
+            facts = f"""(
+            SELECT t.* FROM {stage_db_schema}.rollup_cases AS t
+            SEMI JOIN affected_groups AS g ON {group_match}
+            )"""
+            updates = ", ".join(f"{name} = EXCLUDED.{name}" for name in measures)
+            cur.execute(f"""
+            INSERT INTO {stage_db_schema}.rollup_daily ({group_list}, {', '.join(measures)})
+            {group_totals_sql(facts)}
+            ON CONFLICT ({group_list}) DO UPDATE SET {updates};
+            """)
+            cur.execute(f"""
+            DELETE FROM {stage_db_schema}.rollup_daily AS t
+            WHERE EXISTS (SELECT 1 FROM affected_groups AS g WHERE {group_match})
+            AND NOT EXISTS (SELECT 1 FROM {stage_db_schema}.rollup_cases AS g WHERE {group_match});
+            """)
+            phase['rows_out'] = result['groups'] = cur.execute("SELECT count(*) FROM affected_groups").fetchone()[0]
+
+        cur.execute("COMMIT;")
+    except Exception:
+        cur.execute("ROLLBACK;")
+        raise
+
+    # cached dashboard results read the rollups too
+    if result['cases']:
+        schema_registry.bump_data_version(cur)
+    return result
+
+# Function to update the rollups from the rows the last load inserted or changed (the raw schema it left)
+def update_rollups(md, tm=None, raw_suffix=""):
+    tm = tm or telemetry.Telemetry('rollup')
+    cur = md.cursor()
+    sources = batch_sources(cur, raw_suffix)
+    if not sources:
+        cur.close()
+        return {'cases': 0, 'groups': 0}
+
+    with tm.phase('read', detail='batch cases') as phase:
+        union = " UNION ".join(f"SELECT case_enquiry_id FROM {name}" for name in sources)
+        cur.execute(f"CREATE OR REPLACE TEMP TABLE batch_cases AS {union};")
+        phase['rows_out'] = cur.execute("SELECT count(*) FROM batch_cases").fetchone()[0]
+
+    result = refresh(cur, "batch_cases", tm)
+    cur.close()
+    return result
+
+# Function to recompute the rollups of every case, e.g. after a backfill or when a reconcile finds differences
+def rebuild_rollups(md, tm=None):
+    tm = tm or telemetry.Telemetry('rollup')
+    cur = md.cursor()
+    with tm.phase('read', detail='all cases') as phase:
+        cur.execute(f"""
+        CREATE OR REPLACE TEMP TABLE all_cases AS
+        SELECT case_enquiry_id FROM {stage_db_schema}.status_history
+        UNION
+        SELECT case_enquiry_id FROM {stage_db_schema}.rollup_cases;
+        """)
+        phase['rows_out'] = cur.execute("SELECT count(*) FROM all_cases").fetchone()[0]
+    result = refresh(cur, "all_cases", tm, full=True)
+    cur.close()
+    return result
+
+# Function to compare the daily rollup with a full recompute from the stage tables, the groups that differ are returned
+def reconcile(md, tm=None):
+    tm = tm or telemetry.Telemetry('rollup')
+    group_match = " AND ".join(f"e.{col} = r.{col}" for col in group_columns)
+    # sums of doubles may differ in the last digits depending on the order they were added in
+    types = dict(schema_registry.tables['rollup_daily']['columns'])
+    differs = " OR ".join(
+        f"abs(coalesce(e.{name}, 0) - coalesce(r.{name}, 0)) > {float_tolerance}" if types[name] == 'DOUBLE'
+        else f"e.{name} IS DISTINCT FROM r.{name}"
+        for name in measures
+    )
+    keys = ", ".join(f"coalesce(e.{col}, r.{col}) AS {col}" for col in group_columns)
+    compared = ", ".join(f"e.{name} AS expected_{name}, r.{name} AS stored_{name}" for name in measures)
+
+    with tm.phase('reconcile', table=f"{stage_db_schema}.rollup_daily") as phase:
+        mismatches = md.sql(f"""
+        WITH expected AS ({group_totals_sql(f"({case_facts_sql()})")})
+        SELECT {keys}, {compared}
+        FROM expected AS e
+        FULL OUTER JOIN {stage_db_schema}.rollup_daily AS r ON {group_match}
+        WHERE {differs}
+        ORDER BY ALL
+        """).fetchall()
+        phase['rows_out'] = len(mismatches)
+        phase['rows_in'] = md.sql(f"SELECT count(*) FROM {stage_db_schema}.rollup_daily").fetchone()[0]
+        # the recompute counts these in neighborhood 0 as well, so they never show up as mismatches
+        without_location = md.sql(f"SELECT count(*) FROM {stage_db_schema}.requests WHERE location IS NULL").fetchone()[0]
+
+    columns = group_columns + [f"{kind}_{name}" for name in measures for kind in ('expected', 'stored')]
+    return {
+        'groups': phase['rows_in'],
+        'mismatched_groups': len(mismatches),
+        'requests_without_location': without_location,
+        'mismatches': [dict(zip(columns, row)) for row in mismatches[:max_reported_groups]],
+    }
+
+
+############################################################### main task
+
+@functions_framework.http
+def main(request):
+
+    # Parse the request data
+    request_json = request.get_json(silent=True) or {}
+    print(f"request: {json.dumps(request_json)}")
+
+    tm = telemetry.Telemetry('rollup')
+
+    # reuse the MotherDuck connection of a warm instance
+    md = connections.get_motherduck()
+
+    # check the rollups against a full recompute, and rebuild them when asked to and they differ
+    if request_json.get('reconcile'):
+        result = {'reconcile': reconcile(md, tm)}
+        print(f"{result['reconcile']['mismatched_groups']} of {result['reconcile']['groups']} rollup groups differ")
+        if result['reconcile']['requests_without_location']:
+            print(f"{result['reconcile']['requests_without_location']} requests have no location and are counted in "
+                  "neighborhood 0, {\"fill_locations\": true} to load fills in those in the extract feed")
+        if request_json.get('repair') and result['reconcile']['mismatched_groups']:
+            result['rebuild'] = rebuild_rollups(md, tm)
+    elif request_json.get('rebuild'):
+        result = {'rebuild': rebuild_rollups(md, tm)}
+    else:
+        result = {'update': update_rollups(md, tm)}
+        print(f"Rollups updated: {result['update']}")
+
+    result['connections'] = connections.cache_stats()
+    result['telemetry'] = tm.report()
+    return result, 200
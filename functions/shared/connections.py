@@ -0,0 +1,185 @@
+# Connections shared by the Cloud Functions
+#
+# Cloud Functions keep module state alive between invocations on a warm
+# instance, so the secret, the MotherDuck connection and the storage client
+# are created once and handed out again on later calls. Functions that only
+# read (query) use a separate read-only MotherDuck connection, through a read
+# scaling token, so they can neither write nor slow down the loads.
+
+# imports
+import os
+import threading
+import time
+import duckdb
+from shared import schema_registry
+
+# settings
+project_id = 'group2-ba882'
+secret_id = 'project_key'   #<---------- this is the name of the secret you created
+readonly_secret_id = 'project_read_key'   # a MotherDuck read scaling token, for the read-only connection
+version_id = 'latest'
+
+secret_ttl = 3600             # seconds a cached secret is used before it is fetched again
+health_check_interval = 60    # seconds an idle MotherDuck connection is trusted without a ping
+
+# local DuckDB file attached under the MotherDuck database name, for runs without cloud services
+local_duckdb_path = os.environ.get("ETL_DUCKDB_PATH")
+
+# module state, lives as long as the instance
+_lock = threading.RLock()
+_secrets = {}                 # secret resource name -> (value, fetched at)
+_motherduck = {'connection': None, 'last_used': 0.0}
+_motherduck_readonly = {'connection': None, 'last_used': 0.0}
+_clients = {}
+
+stats = {
+    'secret_hits': 0,
+    'secret_misses': 0,
+    'motherduck_hits': 0,
+    'motherduck_misses': 0,
+    'motherduck_reconnects': 0,
+    'motherduck_readonly_hits': 0,
+    'motherduck_readonly_misses': 0,
+    'motherduck_readonly_reconnects': 0,
+    'storage_hits': 0,
+    'storage_misses': 0,
+}
+
+
+# Function to read a secret, cached for secret_ttl seconds
+# (imported on first use, functions that only touch storage, e.g. transform, do not install secret manager)
+def get_secret(secret=secret_id, version=version_id):
+    from google.cloud import secretmanager
+
+    name = f"projects/{project_id}/secrets/{secret}/versions/{version}"
+    with _lock:
+        cached = _secrets.get(name)
+        if cached and time.monotonic() - cached[1] < secret_ttl:
+            stats['secret_hits'] += 1
+            return cached[0]
+
+        stats['secret_misses'] += 1
+        if 'secretmanager' not in _clients:
+            _clients['secretmanager'] = secretmanager.SecretManagerServiceClient()
+        response = _clients['secretmanager'].access_secret_version(request={"name": name})
+        value = response.payload.data.decode("UTF-8")
+        _secrets[name] = (value, time.monotonic())
+        return value
+
+# Function to make the GEOMETRY type and the ST_ functions available on a connection
+# (locations.geom_4326; DuckDB 1.1 only has them through the spatial extension, newer versions have them built in)
+def _load_spatial(md):
+    try:
+        md.execute("SELECT ST_GeomFromWKB(CAST(NULL AS BLOB))::GEOMETRY").fetchone()
+        return
+    except duckdb.Error:
+        pass
+    md.execute("INSTALL spatial; LOAD spatial;")
+
+# Function to open a new MotherDuck connection through an access token
+def _connect_motherduck():
+    if local_duckdb_path:
+        # a DuckDB file is attached once per process, a read-only connection holding it gives it up
+        _close(_motherduck_readonly)
+        md = duckdb.connect()
+        _load_spatial(md)
+        md.execute(f"ATTACH '{local_duckdb_path}' AS {schema_registry.db}")
+        return md
+    md_token = get_secret()
+    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+    _load_spatial(md)
+    return md
+
+# Function to open a new read-only MotherDuck connection through a read scaling token
+# locally the file is attached READ_ONLY; while this process has it open for writing
+# (the local backend runs every function in one process) the read-write connection is shared
+def _connect_motherduck_readonly():
+    if local_duckdb_path:
+        if _motherduck['connection'] is not None:
+            return _motherduck['connection'].cursor()
+        md = duckdb.connect()
+        _load_spatial(md)
+        md.execute(f"ATTACH '{local_duckdb_path}' AS {schema_registry.db} (READ_ONLY)")
+        return md
+    md_token = get_secret(readonly_secret_id)
+    md = duckdb.connect(f'md:?motherduck_token={md_token}')
+    _load_spatial(md)
+    return md
+
+# Function to close the connection of a cache entry
+def _close(state):
+    md = state['connection']
+    state['connection'] = None
+    if md is not None:
+        try:
+            md.close()
+        except Exception:
+            pass
+
+# Function to check that a connection still answers
+def _is_healthy(md):
+    try:
+        md.execute("SELECT 1").fetchone()
+        return True
+    except Exception as e:
+        print(f"MotherDuck connection failed the health check: {str(e)}")
+        return False
+
+# Function to get a cached connection, created on first use and reopened when it goes bad
+# counted in stats under <name>_hits, <name>_misses and <name>_reconnects
+def _get_connection(state, connect, name):
+    with _lock:
+        md = state['connection']
+        now = time.monotonic()
+
+        if md is not None:
+            if now - state['last_used'] < health_check_interval or _is_healthy(md):
+                stats[f'{name}_hits'] += 1
+                state['last_used'] = now
+                return md
+
+            # drop the broken connection and open a new one below
+            stats[f'{name}_reconnects'] += 1
+            _close(state)
+
+        stats[f'{name}_misses'] += 1
+        md = connect()
+        state['connection'] = md
+        state['last_used'] = now
+        return md
+
+# Function to get the MotherDuck connection, created on first use and reopened when it goes bad
+def get_motherduck():
+    return _get_connection(_motherduck, _connect_motherduck, 'motherduck')
+
+# Function to get the read-only MotherDuck connection of the functions that only read
+# a read scaling replica can trail the writes by a little, readers should key caches on what they read from it
+def get_motherduck_readonly():
+    return _get_connection(_motherduck_readonly, _connect_motherduck_readonly, 'motherduck_readonly')
+
+# Function to force a new MotherDuck connection on the next call, e.g. after a query failed on a dead connection
+def reset_motherduck():
+    with _lock:
+        _close(_motherduck)
+
+# Function to force a new read-only MotherDuck connection on the next call
+def reset_motherduck_readonly():
+    with _lock:
+        _close(_motherduck_readonly)
+
+# Function to get the storage client, created on first use
+def get_storage_client():
+    from google.cloud import storage
+
+    with _lock:
+        if 'storage' in _clients:
+            stats['storage_hits'] += 1
+        else:
+            stats['storage_misses'] += 1
+            _clients['storage'] = storage.Client()
+        return _clients['storage']
+
+# Function to report the cache counters, returned by the functions so the effect can be checked
+def cache_stats():
+    with _lock:
+        return dict(stats)
@@ -0,0 +1,189 @@
+# Parallel HTTP download of the source CSV
+#
+# A one-byte range request (with the conditional headers of an incremental
+# run) tells whether the server accepts byte ranges and how large the file
+# is. When it does, the file is fetched in parallel ranges over one pooled
+# session and handed to the parser in file order while later ranges are
+# still downloading; only parts_in_flight ranges are held at a time, so
+# memory does not grow with the file. Otherwise, or for small files, the file
+# is read as one stream, gzip compressed when the server offers it (ranges
+# are requested uncompressed, a range of a gzip encoding is not usable on its
+# own). The ranges carry the file's validator in If-Range, so a file replaced
+# mid-download cannot be stitched together from two versions; If-Range only
+# takes a strong validator, so a file with just a weak ETag (W/"...") and no
+# usable Last-Modified is read as one stream too.
+
+# imports
+import io
+import re
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+# settings
+workers = 4                         # ranges downloaded at the same time
+part_bytes = 8 * 1024 * 1024        # bytes per range
+parts_in_flight = 8                 # ranges downloading or waiting for the parser, bounds the memory used
+min_parallel_bytes = 2 * part_bytes # smaller files are read as one stream
+part_retries = 3                    # a failed range is requested again, with backoff
+connect_timeout = 10
+read_timeout = 120
+buffer_bytes = 1024 * 1024          # read buffer in front of the parser
+
+# module state, one pooled session for every download of the instance
+_lock = threading.Lock()
+_session = {'session': None}
+
+
+# Function to get the pooled session, created on first use
+def get_session():
+    with _lock:
+        if _session['session'] is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers + 1)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _session['session'] = session
+        return _session['session']
+
+# Function to split a file into the ranges fetched in parallel, inclusive (start, end) byte offsets
+def plan_parts(size, part_size=None):
+    part_size = part_size or part_bytes
+    return [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+
+# Function to read the total size from a Content-Range header, "bytes 0-0/12345"
+def total_size(content_range):
+    match = re.match(r"bytes \d+-\d+/(\d+)", content_range or "")
+    return int(match.group(1)) if match else None
+
+
+# File-like view of the ranges of one file, read in order while the later ranges download
+class RangeReader(io.RawIOBase):
+    def __init__(self, url, parts, validator=None):
+        super().__init__()
+        self.url = url
+        self.validator = validator
+        self.pending = deque(parts)
+        self.futures = deque()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.current = memoryview(b"")
+        self.stats = {'parts': len(parts), 'retries': 0}
+        for _ in range(parts_in_flight):
+            self._schedule()
+
+    # Function to start the download of the next range, if there is one left
+    def _schedule(self):
+        if self.pending:
+            self.futures.append(self.pool.submit(self._fetch, *self.pending.popleft()))
+
+    # Function to download one range, If-Range makes a file that changed in the meantime an error instead of mixed bytes
+    # (streamed, so a 200 with the whole file is closed unread rather than pulled into memory)
+    def _fetch(self, start, end):
+        headers = {'Range': f"bytes={start}-{end}", 'Accept-Encoding': 'identity'}
+        if self.validator:
+            headers['If-Range'] = self.validator
+        for attempt in range(part_retries + 1):
+            try:
+                response = get_session().get(self.url, headers=headers, stream=True, timeout=(connect_timeout, read_timeout))
+                if response.status_code != 206:
+                    response.close()
+                    raise Exception(f"Range {start}-{end} of {self.url} answered with status {response.status_code}, the file may have changed")
+                content = response.content
+                if len(content) != end - start + 1:
+                    raise requests.exceptions.RequestException(f"Range {start}-{end} of {self.url} came back short")
+                return content
+            except requests.exceptions.RequestException:
+                if attempt == part_retries:
+                    raise
+                self.stats['retries'] += 1
+                time.sleep(2 ** attempt)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.current:
+            if not self.futures:
+                return 0
+            self.current = memoryview(self.futures.popleft().result())
+            self._schedule()
+        size = min(len(buffer), len(self.current))
+        buffer[:size] = self.current[:size]
+        self.current = self.current[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.futures.clear()
+        super().close()
+
+
+# The downloaded file, same contract as a streamed requests response: status_code, headers, raw and close()
+class Download:
+    def __init__(self, status_code, headers, raw=None, response=None, mode=None):
+        self.status_code = status_code
+        self.headers = headers
+        self.raw = raw
+        self.response = response
+        self.mode = mode
+
+    def close(self):
+        if self.raw is not None:
+            self.raw.close()
+        if self.response is not None:
+            self.response.close()
+
+
+# Function to pick the If-Range validator of a response: a strong ETag, else a Last-Modified that is strong
+# (at least a second older than the response's Date), else None and the file is not downloaded in ranges
+def range_validator(headers):
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    last_modified = headers.get('Last-Modified')
+    if not last_modified:
+        return None
+    try:
+        modified = parsedate_to_datetime(last_modified)
+        date = parsedate_to_datetime(headers['Date']) if headers.get('Date') else None
+    except (TypeError, ValueError):
+        return None
+    if date is None or (date - modified).total_seconds() < 1:
+        return None
+    return last_modified
+
+# Function to open a URL for reading, in parallel ranges when the server allows it, as one gzip stream otherwise
+# headers are the conditional headers of an incremental run, a 304 comes back without a body
+def open_url(url, headers=None):
+    session = get_session()
+    probe_headers = {**(headers or {}), 'Range': "bytes=0-0", 'Accept-Encoding': 'identity'}
+    probe = session.get(url, headers=probe_headers, stream=True, timeout=(connect_timeout, read_timeout))
+    probe.close()
+    if probe.status_code == 304:
+        return Download(304, probe.headers)
+    if probe.status_code not in (200, 206):
+        raise Exception(f"Failed to download CSV. Status code: {probe.status_code}")
+
+    size = total_size(probe.headers.get('Content-Range')) if probe.status_code == 206 else None
+    validator = range_validator(probe.headers)
+    if size is not None and size >= min_parallel_bytes and validator is None:
+        print(f"No strong validator for If-Range (ETag {probe.headers.get('ETag')}), reading as one stream")
+    elif size is not None and size >= min_parallel_bytes:
+        reader = RangeReader(url, plan_parts(size), validator)
+        print(f"Downloading {size} bytes in {reader.stats['parts']} ranges, {workers} at a time")
+        return Download(200, probe.headers, io.BufferedReader(reader, buffer_size=buffer_bytes), mode='ranges')
+
+    # one stream, compressed on the wire when the server can
+    response = session.get(url, headers={**(headers or {}), 'Accept-Encoding': 'gzip'}, stream=True,
+                           timeout=(connect_timeout, read_timeout))
+    if response.status_code not in (200, 304):
+        response.close()
+        raise Exception(f"Failed to download CSV. Status code: {response.status_code}")
+    response.raw.decode_content = True
+    print(f"Downloading as one stream, Content-Encoding: {response.headers.get('Content-Encoding', 'identity')}")
+    return Download(response.status_code, response.headers, response.raw, response=response, mode='stream')
@@ -0,0 +1,64 @@
+# Geometry and geohash cells of the locations
+#
+# Transform computes them for the locations of each batch, load for the
+# locations already in stage that were loaded before the columns existed.
+# Both go through these functions, so a location gets the same cells either
+# way.
+
+# imports
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from shared import schema_registry
+
+# geohash columns of the locations table -> precision, and the finest one, the order locations are stored in
+geohash_columns = {f"geohash_{precision}": precision for precision in schema_registry.geohash_precisions}
+finest_geohash = max(geohash_columns, key=geohash_columns.get)
+geohash_alphabet = np.frombuffer(b"0123456789bcdefghjkmnpqrstuvwxyz", dtype=np.uint8)
+
+
+# Function to encode points as WKB (little endian, type 1: byte order, type, x, y), NULL where a coordinate is missing
+def point_wkb(lon, lat):
+    packed = np.zeros(len(lon), dtype=[('order', 'u1'), ('type', '<u4'), ('x', '<f8'), ('y', '<f8')])
+    packed['order'] = 1
+    packed['type'] = 1
+    packed['x'] = lon
+    packed['y'] = lat
+    wkb = pa.FixedSizeBinaryArray.from_buffers(pa.binary(packed.itemsize), len(lon), [None, pa.py_buffer(packed.tobytes())])
+    valid = pa.array(~(np.isnan(lon) | np.isnan(lat)))
+    return pc.if_else(valid, wkb, pa.scalar(None, wkb.type)).cast(pa.binary())
+
+# Function to compute the geohash of points at a precision, NULL where a coordinate is missing
+# quantize each coordinate, interleave the bits (longitude first), 5 bits per base32 character
+def geohash(lon, lat, precision):
+    missing = np.isnan(lon) | np.isnan(lat)
+    bits = 5 * precision
+    lon_bits, lat_bits = (bits + 1) // 2, bits // 2
+    lon_q = np.clip(np.nan_to_num((lon + 180) / 360) * (1 << lon_bits), 0, (1 << lon_bits) - 1).astype(np.uint64)
+    lat_q = np.clip(np.nan_to_num((lat + 90) / 180) * (1 << lat_bits), 0, (1 << lat_bits) - 1).astype(np.uint64)
+
+    code = np.zeros(len(lon), dtype=np.uint64)
+    for i in range(bits):
+        if i % 2 == 0:
+            bit = (lon_q >> np.uint64(lon_bits - 1 - i // 2)) & np.uint64(1)
+        else:
+            bit = (lat_q >> np.uint64(lat_bits - 1 - i // 2)) & np.uint64(1)
+        code = (code << np.uint64(1)) | bit
+
+    chars = np.empty((len(lon), precision), dtype=np.uint8)
+    for c in range(precision):
+        chars[:, c] = geohash_alphabet[(code >> np.uint64(5 * (precision - 1 - c))) & np.uint64(31)]
+    hashes = pa.array(chars.view(f"S{precision}").ravel(), type=pa.binary()).cast(pa.string())
+    return pc.if_else(pa.array(missing), pa.scalar(None, pa.string()), hashes)
+
+# Function to fill in the geometry and geohash columns of a table with longitude and latitude columns
+def add_geo_columns(table):
+    lon = table.column('longitude').to_numpy(zero_copy_only=False).astype(np.float64)
+    lat = table.column('latitude').to_numpy(zero_copy_only=False).astype(np.float64)
+    table = table.set_column(table.schema.get_field_index('geom_4326'), 'geom_4326', point_wkb(lon, lat))
+
+    # geohashes nest, the coarser cells are prefixes of the finest one
+    hashes = geohash(lon, lat, geohash_columns[finest_geohash])
+    for col, precision in geohash_columns.items():
+        table = table.set_column(table.schema.get_field_index(col), col, pc.utf8_slice_codeunits(hashes, 0, precision))
+    return table
@@ -0,0 +1,219 @@
+# Client-side index of the keys already in a stage table
+#
+# For the tables whose upsert is ON CONFLICT DO NOTHING, a row whose key is
+# already in stage is thrown away by the database after it was sent. The
+# index holds a sorted array of 64-bit hashes of every key in the table (the
+# low half of the key's md5, computed by DuckDB on both sides), so load can
+# drop those rows, and duplicates within the batch, before they are sent.
+#
+# The index is tagged with the 'keys' data version that load bumps whenever
+# rows went into one of these tables. It is kept in memory on a warm instance
+# and persisted in the bucket as a snapshot of the whole array plus one small
+# delta per later version, the keys the load that bumped to it let through
+# (empty when it added none to the table). Reading the index applies the
+# deltas on top of the memory copy or the snapshot; only when one is missing,
+# because another load ran at the same time or the version was bumped by
+# hand, is it rebuilt from the stage table. The snapshot is rewritten after a
+# rebuild and every compact_every deltas. Rows deleted from a stage table by
+# hand need a bump of the 'keys' version, or they are not loaded again.
+#
+# A table can name fill columns, added after its rows were loaded (see
+# fill_on_conflict in load): rows where they are still NULL stay out of the
+# index, so they keep being sent until a batch fills them in.
+#
+# Every miss of the index only sends a row the upsert skips, as before. A
+# hash collision would drop a new row; with 64-bit hashes and millions of
+# keys the chance is around one in a trillion per row.
+
+# imports
+import io
+import time
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from shared import schema_registry
+from shared import storage_io
+
+# settings
+index_prefix = "boston_data/_key_index"
+version_scope = "keys"
+compact_every = 24          # deltas after which a load rewrites the snapshot
+separator = "chr(31)"       # between the columns of a composite key
+
+# module state, stage table -> (version, sorted hashes, snapshot version) of a warm instance
+_indexes = {}
+
+
+# Function to build the hash expression of a table's key, the same on MotherDuck and in the local DuckDB
+# key_types casts the batch columns to the stage types first, so both sides hash the same text
+def key_hash_sql(key_columns, key_types=None):
+    key_types = key_types or {}
+    columns = ", ".join(
+        f"CAST(CAST({col} AS {key_types[col]}) AS VARCHAR)" if col in key_types else f"CAST({col} AS VARCHAR)"
+        for col in key_columns
+    )
+    return f"md5_number_lower(concat_ws({separator}, {columns}))"
+
+# Function to build the path of a table's persisted snapshot
+def index_uri(bucket_name, stage_table):
+    return storage_io.bucket_uri(bucket_name, f"{index_prefix}/{stage_table}.npz")
+
+# Function to build the path of a table's delta at a version, or the folder of its deltas
+def delta_uri(bucket_name, stage_table, version=None):
+    folder = f"{index_prefix}/{stage_table}/"
+    return storage_io.bucket_uri(bucket_name, folder if version is None else f"{folder}{version}.npz")
+
+# Function to read an npz file of the bucket
+def _read_npz(uri):
+    with storage_io.open_uri(uri, 'rb') as f:
+        return np.load(io.BytesIO(f.read()))
+
+# Function to write arrays to an npz file of the bucket
+def _write_npz(uri, **arrays):
+    buffer = io.BytesIO()
+    np.savez(buffer, **arrays)
+    with storage_io.open_uri(uri, 'wb', content_type='application/octet-stream') as f:
+        f.write(buffer.getvalue())
+
+
+# The key filter of one load of one stage table: the sorted key hashes at one version, and the keys the load let through
+class KeyIndex:
+    def __init__(self, stage_table, key_columns, key_types, hashes, version, fill_columns=None, snapshot_version=None):
+        self.stage_table = stage_table
+        self.key_columns = key_columns
+        self.key_types = key_types
+        self.hashes = hashes
+        self.version = version
+        self.fill_columns = fill_columns or []
+        self.snapshot_version = snapshot_version          # None when the bucket has no snapshot to add deltas to
+        self.seen = np.empty(0, dtype=np.uint64)      # hashes let through by this load, sorted
+        self.added = np.empty(0, dtype=np.uint64)     # the ones with their fill columns, they go into the index
+        self.complete = True                          # False once the load skipped chunks committed by an earlier attempt
+        self.stats = {'rows_in': 0, 'known': 0, 'duplicates': 0, 'seconds': 0.0}
+        self._con = duckdb.connect()
+
+    # Function to hash the keys of a record batch in the local DuckDB
+    def batch_hashes(self, batch):
+        self._con.register("key_batch", batch)
+        try:
+            hashes = self._con.execute(f"SELECT {key_hash_sql(self.key_columns, self.key_types)} AS h FROM key_batch").fetchnumpy()['h']
+        finally:
+            self._con.unregister("key_batch")
+        return np.asarray(hashes, dtype=np.uint64)
+
+    # Function to drop the rows of a record batch whose key is in the table, or came earlier in this load
+    def filter(self, batch):
+        if batch.num_rows == 0:
+            return batch
+        start = time.perf_counter()
+        hashes = self.batch_hashes(batch)
+        known = contains(self.hashes, hashes)
+
+        # the first row of each key in the batch, unless an earlier batch had it
+        first = np.zeros(len(hashes), dtype=bool)
+        first[np.unique(hashes, return_index=True)[1]] = True
+        duplicate = ~first | contains(self.seen, hashes)
+
+        keep = ~known & ~duplicate
+        self.stats['rows_in'] += len(hashes)
+        self.stats['known'] += int(known.sum())
+        self.stats['duplicates'] += int((duplicate & ~known).sum())
+        self.seen = np.union1d(self.seen, hashes[keep])
+        filled = keep.copy()
+        for col in self.fill_columns:
+            if col in batch.schema.names:
+                filled &= pc.is_valid(batch.column(col)).to_numpy(zero_copy_only=False)
+            else:
+                filled[:] = False
+        self.added = np.union1d(self.added, hashes[filled])
+        self.stats['seconds'] += time.perf_counter() - start
+        return batch.filter(pa.array(keep))
+
+    # Function to wrap a record batch reader so only the rows to send come out of it
+    def filter_reader(self, reader):
+        return pa.RecordBatchReader.from_batches(reader.schema, (self.filter(batch) for batch in reader))
+
+    def close(self):
+        self._con.close()
+
+
+# Function to tell which hashes are in a sorted array
+def contains(sorted_hashes, hashes):
+    if len(sorted_hashes) == 0:
+        return np.zeros(len(hashes), dtype=bool)
+    positions = np.searchsorted(sorted_hashes, hashes)
+    positions[positions == len(sorted_hashes)] = 0
+    return sorted_hashes[positions] == hashes
+
+# Function to read the current key version
+def current_version(md):
+    return schema_registry.read_data_version(md, version_scope)
+
+# Function to add the deltas of the versions after from_version up to version to sorted hashes, None when one is missing
+def apply_deltas(bucket_name, stage_table, hashes, from_version, version):
+    if from_version == version:
+        return hashes
+    deltas = {obj['uri'] for obj in storage_io.list_objects(delta_uri(bucket_name, stage_table))}
+    uris = [delta_uri(bucket_name, stage_table, v) for v in range(from_version + 1, version + 1)]
+    if any(uri not in deltas for uri in uris):
+        return None
+    added = [_read_npz(uri)['hashes'] for uri in uris]
+    return np.union1d(hashes, np.concatenate(added))
+
+# Function to get the key filter of a stage table at a version, from memory or the bucket snapshot plus the later deltas,
+# or rebuilt from the table; key_types maps the key columns to their stage types, rows whose fill_columns are NULL are left out
+def get_index(md, bucket_name, stage_table, key_types, version, fill_columns=None):
+    key_columns = list(key_types)
+    fill_columns = list(fill_columns or [])
+    cached = _indexes.get(stage_table)
+    if cached is not None and cached[0] == version:
+        return KeyIndex(stage_table, key_columns, key_types, cached[1], version, fill_columns, cached[2]), 'memory'
+
+    if cached is not None and cached[0] < version:
+        hashes = apply_deltas(bucket_name, stage_table, cached[1], cached[0], version)
+        if hashes is not None:
+            _indexes[stage_table] = (version, hashes, cached[2])
+            return KeyIndex(stage_table, key_columns, key_types, hashes, version, fill_columns, cached[2]), 'memory+deltas'
+
+    uri = index_uri(bucket_name, stage_table)
+    if storage_io.exists(uri):
+        saved = _read_npz(uri)
+        saved_version = int(saved['version'])
+        if (saved_version <= version and list(saved['key_columns']) == key_columns
+                and list(saved.get('fill_columns', [])) == fill_columns):
+            hashes = apply_deltas(bucket_name, stage_table, saved['hashes'], saved_version, version)
+            if hashes is not None:
+                _indexes[stage_table] = (version, hashes, saved_version)
+                source = 'bucket' if saved_version == version else 'bucket+deltas'
+                return KeyIndex(stage_table, key_columns, key_types, hashes, version, fill_columns, saved_version), source
+
+    where = f"WHERE {' AND '.join(f'{col} IS NOT NULL' for col in fill_columns)}" if fill_columns else ""
+    hashes = md.execute(f"SELECT {key_hash_sql(key_columns)} AS h FROM {schema_registry.db_schema}.{stage_table} {where}").fetchnumpy()['h']
+    hashes = np.unique(np.asarray(hashes, dtype=np.uint64))
+    _indexes[stage_table] = (version, hashes, None)
+    return KeyIndex(stage_table, key_columns, key_types, hashes, version, fill_columns), 'rebuilt'
+
+# Function to record the keys a load let through under the version the load bumped to, returns the keys in the index
+# as a delta, or as a new snapshot after a rebuild or compact_every deltas (the older deltas are deleted then)
+def save_index(bucket_name, index, version):
+    hashes = np.union1d(index.hashes, index.added)
+    if index.snapshot_version is None or version - index.snapshot_version >= compact_every:
+        _write_npz(index_uri(bucket_name, index.stage_table), hashes=hashes, version=np.int64(version),
+                   key_columns=np.array(index.key_columns), fill_columns=np.array(index.fill_columns, dtype=str))
+        for obj in storage_io.list_objects(delta_uri(bucket_name, index.stage_table)):
+            storage_io.delete(obj['uri'])
+        _indexes[index.stage_table] = (version, hashes, version)
+    else:
+        save_delta(bucket_name, index.stage_table, version, index.added)
+        _indexes[index.stage_table] = (version, hashes, index.snapshot_version)
+    return len(hashes)
+
+# Function to write the delta of a table at a version, e.g. an empty one for a table a load did not add keys to
+def save_delta(bucket_name, stage_table, version, added=None):
+    added = np.empty(0, dtype=np.uint64) if added is None else added
+    _write_npz(delta_uri(bucket_name, stage_table, version), hashes=added, version=np.int64(version))
+
+# Function to bump the key version after rows went into a key filtered table, returns the new version
+def bump_version(md):
+    return schema_registry.bump_data_version(md, version_scope)
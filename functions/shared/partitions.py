@@ -0,0 +1,88 @@
+# Hive-style partitions of the extract output
+#
+# Extract writes one file per run into every open_dt year/month partition the
+# run touches, e.g.
+#   boston_data/feed/open_year=2024/open_month=03/<job_id>.parquet
+# and one manifest per run listing those files with their row counts and
+# min/max keys. Transform reads the manifest and only the partitions the run
+# changed; a time range can be reprocessed by listing its partitions. Rows
+# without an open_dt go to the Hive default partition. The compact function
+# merges the small per-run files of a partition into larger ones.
+
+# imports
+import datetime
+import hashlib
+import json
+from shared import storage_io
+
+# layout
+feed_prefix = "boston_data/feed"
+manifest_prefix = "boston_data/_manifests"
+default_partition = "open_year=__HIVE_DEFAULT_PARTITION__/open_month=__HIVE_DEFAULT_PARTITION__"
+
+
+# Function to name the partition of a year and month, the default partition when there is no open_dt
+def partition_name(year=None, month=None):
+    if year is None or month is None:
+        return default_partition
+    return f"open_year={int(year)}/open_month={int(month):02d}"
+
+# Function to build the blob name of a file in a partition
+def partition_blob(partition, filename):
+    return f"{feed_prefix}/{partition}/{filename}"
+
+# Function to read the partition back out of a file path
+def partition_of(uri):
+    parts = uri.replace("\\", "/").split("/")
+    keys = [part for part in parts if part.startswith(("open_year=", "open_month="))]
+    return "/".join(keys) if len(keys) == 2 else None
+
+# Function to list the partitions of the months from start to end, both 'YYYY-MM' and inclusive
+def partitions_between(start, end):
+    year, month = (int(value) for value in start.split("-"))
+    end_year, end_month = (int(value) for value in end.split("-"))
+    names = []
+    while (year, month) <= (end_year, end_month):
+        names.append(partition_name(year, month))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return names
+
+# Function to list the data files currently in the given partitions
+def partition_files(bucket_name, names):
+    files = []
+    for name in names:
+        prefix = storage_io.bucket_uri(bucket_name, f"{feed_prefix}/{name}/")
+        files.extend(obj for obj in storage_io.list_objects(prefix) if obj['uri'].endswith((".parquet", ".json")))
+    return files
+
+# Function to build the blob name of a run's manifest
+def manifest_blob(job_id):
+    return f"{manifest_prefix}/{job_id}.json"
+
+# Function to tell whether a path is a run manifest rather than a data file
+def is_manifest(uri):
+    return f"/{manifest_prefix}/" in uri.replace("\\", "/")
+
+# Function to build a run's manifest from the files it wrote
+# the content hash covers every file, the same rows give the same hash
+def build_manifest(job_id, output_format, files):
+    files = sorted(files, key=lambda f: f['partition'])
+    content_hash = hashlib.sha256("".join(f['sha256'] for f in files).encode()).hexdigest()
+    return {
+        'jobid': job_id,
+        'created_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'format': output_format,
+        'total_records': sum(f['rows'] for f in files),
+        'bytes': sum(f['bytes'] for f in files),
+        'content_hash': content_hash,
+        'partitions': [f['partition'] for f in files],
+        'files': files,
+    }
+
+# Function to write a manifest
+def write_manifest(uri, manifest):
+    storage_io.write_text(uri, json.dumps(manifest, default=str))
+
+# Function to read a manifest
+def read_manifest(uri):
+    return json.loads(storage_io.read_text(uri))
@@ -0,0 +1,343 @@
+# The stage schema, defined once
+#
+# Every stage table is described here and nowhere else. migrate() compares a
+# fingerprint of each table definition with the one recorded in the catalog
+# table and only sends DDL when they differ. Only added columns are applied
+# in place; a changed column type, a dropped column or a changed primary key
+# is refused and has to be migrated by hand.
+#
+# Low-cardinality text columns are dictionary encoded: each value is stored
+# once in a dimension table stage.dim_<column> under a SMALLINT key, the
+# stage table carries <column>_key, and a view stage.<table>_decoded gives
+# the text back (see load for how keys are assigned).
+
+# imports
+import hashlib
+import json
+import duckdb
+
+# db setup
+db = 'city_services_boston'
+schema = "stage"
+db_schema = f"{db}.{schema}"
+catalog_table = f"{db_schema}._schema_catalog"
+
+# stage tables: ordered columns as (name, type) and the primary key
+tables = {
+    'requests': {
+        'columns': [
+            ('_id', 'INTEGER'),
+            ('case_enquiry_id', 'VARCHAR'),
+            ('case_title', 'VARCHAR'),
+            ('subject', 'VARCHAR'),
+            ('reason', 'VARCHAR'),
+            ('type', 'VARCHAR'),
+            ('queue', 'VARCHAR'),
+            ('source', 'VARCHAR'),
+            ('submitted_photo', 'VARCHAR'),
+            ('closed_photo', 'VARCHAR'),
+            ('location', 'VARCHAR'),
+        ],
+        'primary_key': ['case_enquiry_id'],
+    },
+    'locations': {
+        'columns': [
+            ('location', 'VARCHAR'),
+            ('fire_district', 'VARCHAR'),
+            ('pwd_district', 'VARCHAR'),
+            ('city_council_district', 'VARCHAR'),
+            ('police_district', 'VARCHAR'),
+            ('neighborhood', 'VARCHAR'),
+            ('neighborhood_services_district', 'VARCHAR'),
+            ('ward', 'VARCHAR'),
+            ('precinct', 'VARCHAR'),
+            ('location_street_name', 'VARCHAR'),
+            ('location_zipcode', 'VARCHAR'),
+            ('latitude', 'FLOAT'),
+            ('longitude', 'FLOAT'),
+            ('geom_4326', 'GEOMETRY'),
+        ],
+        'primary_key': ['location'],
+    },
+    'department_assignment': {
+        'columns': [
+            ('case_enquiry_id', 'VARCHAR'),
+            ('department', 'VARCHAR'),
+        ],
+        'primary_key': ['case_enquiry_id', 'department'],
+    },
+    'status_history': {
+        'columns': [
+            ('case_enquiry_id', 'VARCHAR'),
+            ('open_dt', 'TIMESTAMP'),
+            ('sla_target_dt', 'TIMESTAMP'),
+            ('closed_dt', 'TIMESTAMP'),
+            ('case_status', 'VARCHAR'),
+            ('closure_reason', 'VARCHAR'),
+        ],
+        'primary_key': ['case_enquiry_id', 'open_dt'],
+    },
+    'response_time': {
+        'columns': [
+            ('case_enquiry_id', 'VARCHAR'),
+            ('on_time', 'BOOLEAN'),
+            ('time_to_close_hours', 'DOUBLE'),
+            ('sla_slack_hours', 'DOUBLE'),
+        ],
+        'primary_key': ['case_enquiry_id'],
+    },
+    # dashboard rollups, maintained by the rollup function after each load
+    # the group each case is counted in (once per department it is assigned to), unknown keys are 0
+    'rollup_cases': {
+        'columns': [
+            ('case_enquiry_id', 'VARCHAR'),
+            ('department_key', 'SMALLINT'),
+            ('open_date', 'DATE'),
+            ('neighborhood_key', 'SMALLINT'),
+            ('is_closed', 'BOOLEAN'),
+            ('on_time', 'BOOLEAN'),
+            ('time_to_close_hours', 'DOUBLE'),
+        ],
+        'primary_key': ['case_enquiry_id', 'department_key'],
+    },
+    # daily x neighborhood x department totals, sums only so a group can be recomputed on its own
+    'rollup_daily': {
+        'columns': [
+            ('open_date', 'DATE'),
+            ('neighborhood_key', 'SMALLINT'),
+            ('department_key', 'SMALLINT'),
+            ('requests', 'INTEGER'),
+            ('open_requests', 'INTEGER'),
+            ('closed_requests', 'INTEGER'),
+            ('on_time_requests', 'INTEGER'),
+            ('sla_requests', 'INTEGER'),
+            ('time_to_close_hours_sum', 'DOUBLE'),
+        ],
+        'primary_key': ['open_date', 'neighborhood_key', 'department_key'],
+    },
+    # bumped whenever stage data changes, readers cache results per version
+    'data_version': {
+        'columns': [
+            ('scope', 'VARCHAR'),
+            ('version', 'BIGINT'),
+            ('updated_at', 'TIMESTAMP'),
+        ],
+        'primary_key': ['scope'],
+    },
+}
+
+# dictionary-encoded columns of each stage table
+dimensions = {
+    'requests': ['subject', 'reason', 'type', 'queue', 'source'],
+    'locations': ['fire_district', 'pwd_district', 'city_council_district', 'police_district',
+                  'neighborhood', 'neighborhood_services_district'],
+    'department_assignment': ['department'],
+    'status_history': ['case_status'],
+}
+
+# the key column on the stage table and one dimension table per encoded column
+for table_name, dimension_columns in dimensions.items():
+    for col in dimension_columns:
+        tables[table_name]['columns'].append((f"{col}_key", 'SMALLINT'))
+        tables[f"dim_{col}"] = {
+            'columns': [(f"{col}_key", 'SMALLINT'), (col, 'VARCHAR')],
+            'primary_key': [f"{col}_key"],
+            'unique': [col],
+        }
+
+# key columns filled in by load, not by transform
+dimension_keys = {f"{col}_key" for cols in dimensions.values() for col in cols}
+
+# geohash cells of each location at these precisions (5: ~4.9 km, 7: ~150 m), computed by transform;
+# locations are stored in order of the finest one, so nearby rows share row groups
+geohash_precisions = [5, 7]
+for precision in geohash_precisions:
+    tables['locations']['columns'].append((f"geohash_{precision}", 'VARCHAR'))
+
+
+# Function to fingerprint the definition of one table
+def fingerprint(name):
+    spec = tables[name]
+    definition = {'columns': spec['columns'], 'primary_key': spec['primary_key']}
+    if spec.get('unique'):
+        definition['unique'] = spec['unique']
+    canonical = json.dumps(definition)
+    return hashlib.sha256(canonical.encode("UTF-8")).hexdigest()
+
+# Function to build the CREATE TABLE statement for one table, under another name when table_name is given
+def create_table_sql(name, table_name=None):
+    spec = tables[name]
+    columns = "\n        ,".join(f"{col} {col_type}" for col, col_type in spec['columns'])
+    unique = "".join(f"\n        ,UNIQUE ({col})" for col in spec.get('unique', []))
+    return f"""
+    CREATE TABLE IF NOT EXISTS {db_schema}.{table_name or name} (
+        {columns}
+        ,PRIMARY KEY ({', '.join(spec['primary_key'])}){unique}
+    );
+    """
+
+# Function to list the given tables together with their dimension tables
+def with_dimensions(names):
+    return [t for name in names for t in [name] + [f"dim_{col}" for col in dimensions.get(name, [])]]
+
+# Function to build the view that decodes the dimension keys of a stage table back to text
+# rows loaded before the encoding still have their text, coalesce covers both
+def decoded_view_sql(name):
+    encoded = dimensions[name]
+    select, joins = [], []
+    for col, _ in tables[name]['columns']:
+        if col in dimension_keys:
+            continue
+        if col in encoded:
+            select.append(f"coalesce(dim_{col}.{col}, t.{col}) AS {col}")
+            joins.append(f"LEFT JOIN {db_schema}.dim_{col} AS dim_{col} ON dim_{col}.{col}_key = t.{col}_key")
+        else:
+            select.append(f"t.{col}")
+    select = "\n        ,".join(select)
+    joins = "\n    ".join(joins)
+    return f"""
+    CREATE OR REPLACE VIEW {db_schema}.{name}_decoded AS
+    SELECT
+        {select}
+    FROM {db_schema}.{name} AS t
+    {joins};
+    """
+
+# Function to build the view of the daily rollup the dashboards read: text in place of keys, rates computed
+def rollup_view_sql():
+    return f"""
+    CREATE OR REPLACE VIEW {db_schema}.rollup_daily_decoded AS
+    SELECT
+        r.open_date
+        ,dim_neighborhood.neighborhood
+        ,dim_department.department
+        ,r.requests
+        ,r.open_requests
+        ,r.closed_requests
+        ,r.on_time_requests
+        ,r.on_time_requests / nullif(r.sla_requests, 0) AS on_time_rate
+        ,r.time_to_close_hours_sum / nullif(r.closed_requests, 0) AS avg_time_to_close_hours
+    FROM {db_schema}.rollup_daily AS r
+    LEFT JOIN {db_schema}.dim_neighborhood AS dim_neighborhood ON dim_neighborhood.neighborhood_key = r.neighborhood_key
+    LEFT JOIN {db_schema}.dim_department AS dim_department ON dim_department.department_key = r.department_key;
+    """
+
+# views over a stage table besides the decoded ones, recreated when the table changes
+views = {
+    'rollup_daily': rollup_view_sql,
+}
+
+# Function to bump the data version after stage data changed, the query function drops its cached results on it
+def bump_data_version(md, scope="stage"):
+    return md.execute(f"""
+    INSERT INTO {db_schema}.data_version AS v VALUES ('{scope}', 1, now())
+    ON CONFLICT (scope) DO UPDATE SET version = v.version + 1, updated_at = EXCLUDED.updated_at
+    RETURNING version;
+    """).fetchone()[0]
+
+# Function to read the data version, 0 before the first load (or before the table was created)
+def read_data_version(md, scope="stage"):
+    try:
+        row = md.execute(f"SELECT version FROM {db_schema}.data_version WHERE scope = ?", [scope]).fetchone()
+    except duckdb.CatalogException:
+        return 0
+    return row[0] if row else 0
+
+# Function to read the recorded fingerprints, empty when the database or catalog is not there yet
+def read_catalog(md):
+    try:
+        return dict(md.execute(f"SELECT table_name, fingerprint FROM {catalog_table}").fetchall())
+    except duckdb.CatalogException:
+        return None
+
+# Function to build the DDL that takes the existing tables to the registry definition
+def plan_changes(md, names):
+    rows = md.execute(f"""
+    SELECT table_name, column_name, data_type
+    FROM information_schema.columns
+    WHERE table_catalog = '{db}' AND table_schema = '{schema}'
+    """).fetchall()
+    existing = {}
+    for table_name, column_name, data_type in rows:
+        existing.setdefault(table_name, {})[column_name] = data_type.upper()
+    primary_keys = dict(md.execute(f"""
+    SELECT table_name, constraint_column_names
+    FROM duckdb_constraints()
+    WHERE database_name = '{db}' AND schema_name = '{schema}' AND constraint_type = 'PRIMARY KEY'
+    """).fetchall())
+
+    statements = []
+    for name in names:
+        if name not in existing:
+            statements.append(create_table_sql(name))
+            continue
+
+        # a primary key cannot be changed in place, the upserts and key filters depend on it
+        if set(primary_keys.get(name, [])) != set(tables[name]['primary_key']):
+            raise Exception(f"{db_schema}.{name} has primary key ({', '.join(primary_keys.get(name, []))}), "
+                            f"the registry says ({', '.join(tables[name]['primary_key'])}); migrate it by hand")
+
+        # only additive changes are applied in place
+        wanted = dict(tables[name]['columns'])
+        for col, col_type in tables[name]['columns']:
+            if col not in existing[name]:
+                statements.append(f"ALTER TABLE {db_schema}.{name} ADD COLUMN {col} {col_type};")
+            elif existing[name][col] != col_type:
+                raise Exception(f"{db_schema}.{name}.{col} is {existing[name][col]}, the registry says {col_type}; migrate it by hand")
+        for col in existing[name]:
+            if col not in wanted:
+                raise Exception(f"{db_schema}.{name}.{col} is not in the registry; migrate it by hand")
+    return statements
+
+# Function to bring the given stage tables (default: all) in line with the registry
+def migrate(md, names=None):
+    names = list(names or tables)
+    wanted = {name: fingerprint(name) for name in names}
+
+    # a single round-trip when nothing changed
+    stored = read_catalog(md)
+    changed = [name for name in names if (stored or {}).get(name) != wanted[name]]
+    if not changed:
+        print(f"Schema unchanged for {', '.join(names)}")
+        return {'status': 'unchanged', 'tables': []}
+
+    if stored is None:
+        # a local duckdb file is attached under the database name already
+        attached = md.execute(f"SELECT count(*) FROM duckdb_databases() WHERE database_name = '{db}'").fetchone()[0]
+        if not attached:
+            md.execute(f"CREATE DATABASE IF NOT EXISTS {db};")
+        md.execute(f"CREATE SCHEMA IF NOT EXISTS {db_schema};")
+
+    statements = plan_changes(md, changed)
+    for name in changed:
+        if name in dimensions:
+            statements.append(decoded_view_sql(name))
+        if name in views:
+            statements.append(views[name]())
+    statements.append(f"""
+    CREATE TABLE IF NOT EXISTS {catalog_table} (
+        table_name VARCHAR
+        ,fingerprint VARCHAR
+        ,applied_at TIMESTAMP
+        ,PRIMARY KEY (table_name)
+    );
+    """)
+    for name in changed:
+        statements.append(f"""
+    INSERT INTO {catalog_table} VALUES ('{name}', '{wanted[name]}', now())
+    ON CONFLICT (table_name) DO UPDATE SET fingerprint = EXCLUDED.fingerprint, applied_at = EXCLUDED.applied_at;
+    """)
+
+    # apply everything in one transaction
+    ddl = "BEGIN TRANSACTION;\n" + "\n".join(statements) + "\nCOMMIT;"
+    print(ddl)
+    try:
+        md.execute(ddl)
+    except Exception:
+        try:
+            md.execute("ROLLBACK;")
+        except Exception:
+            pass
+        raise
+
+    return {'status': 'migrated', 'tables': changed}
@@ -0,0 +1,101 @@
+# File access shared by the Cloud Functions
+#
+# Paths are gs:// URIs in the cloud. When ETL_LOCAL_DIR is set the bucket
+# layout is mirrored under that directory instead, so the whole pipeline can
+# run on one machine without GCS.
+
+# imports
+import os
+import shutil
+from shared import connections
+
+# settings
+local_dir = os.environ.get("ETL_LOCAL_DIR")
+
+
+# Function to build the path of an object in a bucket, local when ETL_LOCAL_DIR is set
+def bucket_uri(bucket_name, blob_name):
+    if local_dir:
+        return os.path.join(local_dir, bucket_name, blob_name)
+    return f"gs://{bucket_name}/{blob_name}"
+
+# Function to split a gs:// path into bucket and blob name
+def split_gcs_uri(uri):
+    bucket_name, blob_name = uri[len("gs://"):].split("/", 1)
+    return bucket_name, blob_name
+
+# Function to get the blob behind a gs:// path
+def _blob(uri):
+    bucket_name, blob_name = split_gcs_uri(uri)
+    return connections.get_storage_client().bucket(bucket_name).blob(blob_name)
+
+# Function to open a path for streaming reads or writes
+def open_uri(uri, mode='rb', content_type=None):
+    if uri.startswith("gs://"):
+        if 'w' in mode and content_type:
+            return _blob(uri).open(mode, content_type=content_type)
+        return _blob(uri).open(mode)
+    if 'w' in mode:
+        os.makedirs(os.path.dirname(uri) or ".", exist_ok=True)
+    return open(uri, mode)
+
+# Function to check a path exists
+def exists(uri):
+    if uri.startswith("gs://"):
+        return _blob(uri).exists()
+    return os.path.exists(uri)
+
+# Function to read a small text object
+def read_text(uri):
+    if uri.startswith("gs://"):
+        return _blob(uri).download_as_text()
+    with open(uri) as f:
+        return f.read()
+
+# Function to write a small text object
+def write_text(uri, text, content_type='application/json'):
+    if uri.startswith("gs://"):
+        _blob(uri).upload_from_string(text, content_type=content_type)
+        return
+    os.makedirs(os.path.dirname(uri) or ".", exist_ok=True)
+    with open(uri, "w") as f:
+        f.write(text)
+
+# Function to copy a path to a local file
+def download_to_file(uri, local_file):
+    if uri.startswith("gs://"):
+        _blob(uri).download_to_filename(local_file)
+    else:
+        shutil.copyfile(uri, local_file)
+
+# Function to copy a local file to a path
+def upload_file(local_file, uri):
+    if uri.startswith("gs://"):
+        _blob(uri).upload_from_filename(local_file)
+        return
+    os.makedirs(os.path.dirname(uri) or ".", exist_ok=True)
+    shutil.copyfile(local_file, uri)
+
+# Function to list the objects under a prefix with their size and last update time (epoch seconds)
+def list_objects(prefix):
+    if prefix.startswith("gs://"):
+        bucket_name, blob_prefix = split_gcs_uri(prefix)
+        blobs = connections.get_storage_client().list_blobs(bucket_name, prefix=blob_prefix)
+        return [
+            {'uri': f"gs://{bucket_name}/{blob.name}", 'size': blob.size, 'updated': blob.updated.timestamp()}
+            for blob in blobs
+        ]
+    objects = []
+    for root, _, files in os.walk(prefix):
+        for name in files:
+            path = os.path.join(root, name)
+            stat = os.stat(path)
+            objects.append({'uri': path, 'size': stat.st_size, 'updated': stat.st_mtime})
+    return sorted(objects, key=lambda obj: obj['uri'])
+
+# Function to delete a path
+def delete(uri):
+    if uri.startswith("gs://"):
+        _blob(uri).delete()
+    elif os.path.exists(uri):
+        os.remove(uri)
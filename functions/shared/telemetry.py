@@ -0,0 +1,98 @@
+# Per-phase performance telemetry
+#
+# Each function wraps its phases (download, parse, serialize, upload, raw
+# insert, upsert, ...) in telemetry.phase(). A phase records its duration,
+# rows in/out, bytes and the peak RSS of the process when it ended, prints
+# itself as one JSON log line (Cloud Logging reads these as structured
+# entries) and is returned in the function's response for the flow to
+# aggregate.
+
+# imports
+import contextlib
+import json
+import resource
+import sys
+import threading
+import time
+
+
+# Function to read the peak RSS of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+# The phases recorded during one function call
+class Telemetry:
+    def __init__(self, stage):
+        self.stage = stage
+        self.phases = []
+        self._lock = threading.Lock()
+
+    # Function to time a block as a phase, the block fills in rows_out / bytes on the yielded record
+    @contextlib.contextmanager
+    def phase(self, name, rows_in=None, **fields):
+        record = {'stage': self.stage, 'phase': name, 'rows_in': rows_in, 'rows_out': None, 'bytes': None, **fields}
+        start = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = str(e)
+            raise
+        finally:
+            self._add(record, time.perf_counter() - start)
+
+    # Function to add a phase measured elsewhere, e.g. the time spent inside a stream's reads
+    def record(self, name, seconds, rows_in=None, rows_out=None, bytes=None, **fields):
+        record = {'stage': self.stage, 'phase': name, 'rows_in': rows_in, 'rows_out': rows_out, 'bytes': bytes, **fields}
+        self._add(record, seconds)
+
+    def _add(self, record, seconds):
+        record['seconds'] = round(seconds, 4)
+        record['peak_rss_mb'] = peak_rss_mb()
+        with self._lock:
+            self.phases.append(record)
+        print(json.dumps({'severity': 'INFO', 'message': f"{record['stage']} {record['phase']}", 'telemetry': record}, default=str))
+
+    # Function to return the phases for the response
+    def report(self):
+        with self._lock:
+            return list(self.phases)
+
+
+# File wrapper that counts the bytes read through it and the time spent reading them
+# (separates download or storage time from the parsing that pulls the bytes)
+class TimedReader:
+    def __init__(self, f):
+        self.f = f
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        data = method(*args)
+        self.seconds += time.perf_counter() - start
+        self.bytes += len(data)
+        return data
+
+    def read(self, *args):
+        return self._timed(self.f.read, *args)
+
+    def readline(self, *args):
+        return self._timed(self.f.readline, *args)
+
+    def read1(self, *args):
+        return self._timed(getattr(self.f, 'read1', self.f.read), *args)
+
+    def readinto(self, buffer):
+        start = time.perf_counter()
+        size = self.f.readinto(buffer)
+        self.seconds += time.perf_counter() - start
+        self.bytes += size or 0
+        return size
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
@@ -0,0 +1,226 @@
+# imports
+import functions_framework
+import duckdb
+import datetime
+import json
+import os
+import tempfile
+import pyarrow as pa
+import pyarrow.parquet as pq
+from shared import geo
+from shared import partitions
+from shared import schema_registry
+from shared import storage_io
+from shared import telemetry
+
+# setup
+bucket_name = "group2-ba882-project"
+
+# output tables, keyed the way the load function reads them, and the stage table each one feeds
+# (response_time is derived from status_history by load)
+output_tables = {
+    'requests': 'requests',
+    'location': 'locations',
+    'department_assignment': 'department_assignment',
+    'status_history': 'status_history',
+}
+
+# parquet has no GEOMETRY type, geometries are written as WKB
+parquet_types = {
+    'GEOMETRY': 'BLOB',
+}
+
+# columns, types and primary keys come from the schema registry
+# (dimension keys are assigned by load, the tables carry the text)
+tables = {
+    name: {
+        'columns': {
+            col: parquet_types.get(col_type, col_type)
+            for col, col_type in schema_registry.tables[stage_table]['columns']
+            if col not in schema_registry.dimension_keys
+        },
+        'primary_key': schema_registry.tables[stage_table]['primary_key'],
+    }
+    for name, stage_table in output_tables.items()
+}
+
+# the table whose geometry and geohash cells are computed after the query, in one vectorized pass (shared/geo.py)
+geo_table = 'location'
+geohash_columns = geo.geohash_columns
+
+# columns that are derived rather than copied from the feed
+derived_columns = {
+    'geom_4326': "CAST(NULL AS BLOB)",
+    **{col: "CAST(NULL AS VARCHAR)" for col in geohash_columns},
+}
+
+# feed columns read with a different type than the stage column they feed (none at the moment)
+source_types = {}
+
+# the time extract pulled the rows, the newest copy of a key wins when a range is reprocessed
+# (files written before extract stamped it read as NULL and fall back to open_dt)
+recency_column = 'extracted_at'
+
+
+# Function to build the typed projection of the feed, one entry per column any table needs
+def source_projection(source_columns):
+    types = {}
+    for spec in tables.values():
+        for col, col_type in spec['columns'].items():
+            if col != 'geom_4326' and col not in geohash_columns:
+                types.setdefault(col, source_types.get(col, col_type))
+    types[recency_column] = 'TIMESTAMP'
+
+    select = []
+    for col, col_type in types.items():
+        if col in source_columns:
+            select.append(f"TRY_CAST({col} AS {col_type}) AS {col}")
+        else:
+            select.append(f"CAST(NULL AS {col_type}) AS {col}")
+    return ",\n        ".join(select)
+
+# Function to build the query for one output table, one row per primary key
+# (the most recently extracted copy wins, then the latest open_dt)
+def table_sql(spec):
+    select = ",\n        ".join(
+        f"{derived_columns[col]} AS {col}" if col in derived_columns else f"src.{col}"
+        for col in spec['columns']
+    )
+    pk = ", ".join(f"src.{col}" for col in spec['primary_key'])
+    not_null = " AND ".join(f"src.{col} IS NOT NULL" for col in spec['primary_key'])
+    return f"""
+    SELECT
+        {select}
+    FROM src
+    WHERE {not_null}
+    QUALIFY row_number() OVER (PARTITION BY {pk} ORDER BY src.{recency_column} DESC NULLS LAST, src.open_dt DESC NULLS LAST) = 1
+    """
+
+# Function to fill in the geometry and geohash columns of the locations and sort them by the finest cell
+def add_geo_columns(table):
+    return geo.add_geo_columns(table).sort_by([(geo.finest_geohash, 'ascending')])
+
+# Function to make the one typed, columnar copy of the feed that every table is cut from
+def create_source(con, reader, tm=None):
+    tm = tm or telemetry.Telemetry('transform')
+    with tm.phase('read_parquet' if reader.startswith('read_parquet') else 'read') as phase:
+        source_columns = [row[0] for row in con.sql(f"DESCRIBE SELECT * FROM {reader}").fetchall()]
+        con.sql(f"""
+        CREATE OR REPLACE TEMP TABLE src AS
+        SELECT
+            {source_projection(source_columns)}
+        FROM {reader};
+        """)
+        phase['rows_out'] = con.sql("SELECT count(*) FROM src").fetchone()[0]
+    return phase['rows_out']
+
+# Function to list the extract files a request asks for
+#   manifest            - the files of one extract run, only the partitions it changed
+#   open_from / open_to - every file in the partitions of these months ('YYYY-MM'), to reprocess a time range
+#   filepath            - a single file, as written before the partitioned layout (extract now returns its manifest here)
+def input_paths(request_json):
+    manifest_path = request_json.get('manifest')
+    if not manifest_path and request_json.get('filepath') and partitions.is_manifest(request_json['filepath']):
+        manifest_path = request_json['filepath']
+    if manifest_path:
+        manifest = partitions.read_manifest(manifest_path)
+        return [f['path'] for f in manifest['files']]
+    if request_json.get('open_from'):
+        names = partitions.partitions_between(request_json['open_from'], request_json.get('open_to', request_json['open_from']))
+        return [obj['uri'] for obj in partitions.partition_files(bucket_name, names)]
+    return [request_json['filepath']]
+
+# Function to read the extract output and write one parquet file per stage table
+def split_tables(con, input_files, output_dir, tm=None):
+    tm = tm or telemetry.Telemetry('transform')
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    file_list = "[" + ", ".join(f"'{f}'" for f in input_files) + "]"
+    if all(f.endswith(".parquet") for f in input_files):
+        reader = f"read_parquet({file_list}, union_by_name = true)"
+    else:
+        reader = f"read_json_auto({file_list}, format = 'newline_delimited', union_by_name = true)"
+    create_source(con, reader, tm)
+
+    outputs = {}
+    for name, spec in tables.items():
+        output_file = os.path.join(output_dir, f"{name}.parquet")
+        with tm.phase('serialize', table=name) as phase:
+            if name == geo_table:
+                table = add_geo_columns(con.sql(table_sql(spec)).fetch_arrow_table())
+                pq.write_table(table, output_file, compression='zstd')
+                rows = table.num_rows
+            else:
+                rows = con.execute(f"COPY ({table_sql(spec)}) TO '{output_file}' (FORMAT PARQUET, COMPRESSION ZSTD);").fetchone()[0]
+            phase['rows_out'] = rows
+            phase['bytes'] = os.path.getsize(output_file)
+        outputs[name] = {'file': output_file, 'rows': rows}
+    return outputs
+
+# Function to split the feed held in memory as arrow into one arrow table per stage table (fused mode)
+def split_arrow(con, feed, tm=None):
+    tm = tm or telemetry.Telemetry('transform')
+    con.register('feed', feed)
+    create_source(con, 'feed', tm)
+    con.unregister('feed')
+    results = {}
+    for name, spec in tables.items():
+        with tm.phase('split', table=name) as phase:
+            results[name] = con.sql(table_sql(spec)).fetch_arrow_table()
+            if name == geo_table:
+                results[name] = add_geo_columns(results[name])
+            phase['rows_out'] = results[name].num_rows
+            phase['bytes'] = results[name].nbytes
+    return results
+
+
+############################################################### main task
+
+@functions_framework.http
+def main(request):
+
+    # Parse the request data
+    request_json = request.get_json(silent=True)
+    print(f"request: {json.dumps(request_json)}")
+
+    # a reprocessing request without a job id gets its own
+    job_id = request_json.get('jobid') or "reprocess-" + datetime.datetime.now().strftime('%Y%m%d%H%M%S')
+    tm = telemetry.Telemetry('transform')
+
+    # local duckdb does the column work
+    con = duckdb.connect()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        # pull down only the partition files the request needs
+        input_files = []
+        with tm.phase('download') as phase:
+            for i, path in enumerate(input_paths(request_json)):
+                input_file = os.path.join(tmp_dir, f"input-{i:05d}-{os.path.basename(path)}")
+                storage_io.download_to_file(path, input_file)
+                input_files.append(input_file)
+            phase['bytes'] = sum(os.path.getsize(f) for f in input_files)
+            phase['files'] = len(input_files)
+
+        if not input_files:
+            con.close()
+            return {'jobid': job_id, 'content_hash': request_json.get('content_hash'), 'rows': {}, 'telemetry': tm.report()}, 200
+
+        # split into the stage tables
+        outputs = split_tables(con, input_files, tmp_dir, tm)
+
+        # upload one parquet file per table
+        # the content hash travels along so the flow can cache load on it
+        result = {'jobid': job_id, 'content_hash': request_json.get('content_hash'), 'rows': {}}
+        for name, output in outputs.items():
+            output_path = storage_io.bucket_uri(bucket_name, f"boston_data/{job_id}/tables/{name}.parquet")
+            with tm.phase('upload', bytes=os.path.getsize(output['file']), table=name):
+                storage_io.upload_file(output['file'], output_path)
+            result[name] = output_path
+            result['rows'][name] = output['rows']
+            print(f"{name}: {output['rows']} rows written to {output_path}")
+
+    con.close()
+
+    result['telemetry'] = tm.report()
+    return result, 200
@@ -0,0 +1,27 @@
+# Test setup
+#
+# The tests import functions/shared the way a deployed function does, the
+# function entry points through flows/backends.py, and the HTTP stand-in from
+# benchmarks/. Bucket files go to a temporary directory.
+
+# imports
+import os
+import sys
+import pytest
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+for folder in ("functions", "flows", "benchmarks"):
+    path = os.path.join(repo_dir, folder)
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from shared import key_index
+from shared import storage_io
+
+
+# a local bucket in a temporary directory, and no key filter cached from an earlier test
+@pytest.fixture
+def bucket(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_io, 'local_dir', str(tmp_path))
+    monkeypatch.setattr(key_index, '_indexes', {})
+    return "test-bucket"
@@ -0,0 +1,131 @@
+# The range downloader against the HTTP stand-in of the data portal
+import os
+import threading
+import time
+import pytest
+import requests
+import http_standin
+from shared import downloader
+
+part_bytes = 64 * 1024
+
+
+@pytest.fixture
+def csv_dir(tmp_path, monkeypatch):
+    # a file of a few dozen small ranges, modified well before the requests
+    monkeypatch.setattr(downloader, 'part_bytes', part_bytes)
+    monkeypatch.setattr(downloader, 'min_parallel_bytes', 2 * part_bytes)
+    monkeypatch.setattr(http_standin.StandInHandler, 'log_message', lambda *args: None)
+    lines = [f"{i},case {i},{'x' * (i % 97)}\n" for i in range(40000)]
+    path = tmp_path / "311.csv"
+    path.write_text("case_enquiry_id,case_title,filler\n" + "".join(lines))
+    modified = time.time() - 3600
+    os.utime(path, (modified, modified))
+    return tmp_path
+
+@pytest.fixture
+def serve(csv_dir):
+    servers = []
+
+    def start(**options):
+        server = http_standin.serve(str(csv_dir), port=0, **options)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return f"http://127.0.0.1:{server.server_address[1]}/311.csv"
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def read_all(download):
+    try:
+        return download.raw.read()
+    finally:
+        download.close()
+
+
+def test_ranges_are_reassembled_in_order(serve, csv_dir):
+    download = downloader.open_url(serve())
+
+    assert download.mode == 'ranges'
+    # more ranges than are held at a time, so later ones download while earlier ones are read
+    assert download.raw.raw.stats['parts'] > downloader.parts_in_flight
+    assert read_all(download) == (csv_dir / "311.csv").read_bytes()
+
+def test_strong_etag_is_the_if_range_validator(serve):
+    download = downloader.open_url(serve())
+
+    assert download.raw.raw.validator == download.headers['ETag']
+    download.close()
+
+def test_weak_etag_falls_back_to_last_modified(serve, csv_dir):
+    download = downloader.open_url(serve(weak_etags=True))
+
+    assert download.mode == 'ranges'
+    assert download.raw.raw.validator == download.headers['Last-Modified']
+    assert read_all(download) == (csv_dir / "311.csv").read_bytes()
+
+def test_weak_etag_without_strong_last_modified_reads_one_stream(serve, csv_dir):
+    # modified just now: the Last-Modified is not at least a second older than the Date
+    now = time.time()
+    os.utime(csv_dir / "311.csv", (now, now))
+    download = downloader.open_url(serve(weak_etags=True))
+
+    assert download.mode == 'stream'
+    assert read_all(download) == (csv_dir / "311.csv").read_bytes()
+
+def test_no_range_support_reads_one_gzip_stream(serve, csv_dir):
+    download = downloader.open_url(serve(ranges=False))
+
+    assert download.mode == 'stream'
+    assert download.headers.get('Content-Encoding') == 'gzip'
+    assert read_all(download) == (csv_dir / "311.csv").read_bytes()
+
+def test_unchanged_file_answers_304(serve):
+    url = serve()
+    first = downloader.open_url(url)
+    first.close()
+
+    download = downloader.open_url(url, {'If-None-Match': first.headers['ETag']})
+
+    assert download.status_code == 304
+    assert download.raw is None
+
+@pytest.mark.parametrize("headers, expected", [
+    ({'ETag': '"abc"'}, '"abc"'),
+    ({'ETag': 'W/"abc"'}, None),
+    ({'ETag': 'W/"abc"', 'Last-Modified': 'Sat, 17 Oct 2026 10:00:00 GMT', 'Date': 'Sun, 18 Oct 2026 10:00:00 GMT'}, 'Sat, 17 Oct 2026 10:00:00 GMT'),
+    ({'ETag': 'W/"abc"', 'Last-Modified': 'Sun, 18 Oct 2026 10:00:00 GMT', 'Date': 'Sun, 18 Oct 2026 10:00:00 GMT'}, None),
+    ({'Last-Modified': 'not a date', 'Date': 'Sun, 18 Oct 2026 10:00:00 GMT'}, None),
+    ({}, None),
+])
+def test_range_validator(headers, expected):
+    assert downloader.range_validator(headers) == expected
+
+def test_plan_parts_cover_the_file():
+    assert downloader.plan_parts(10, 4) == [(0, 3), (4, 7), (8, 9)]
+
+def test_file_changed_during_the_download_is_an_error(serve, csv_dir, monkeypatch):
+    answers = []
+    session_get = requests.Session.get
+
+    def get(self, url, **kwargs):
+        response = session_get(self, url, **kwargs)
+        answers.append((response, kwargs))
+        return response
+
+    monkeypatch.setattr(requests.Session, 'get', get)
+    download = downloader.open_url(serve())
+    # If-Range no longer matches, the server answers the next ranges with 200 and the whole file
+    path = csv_dir / "311.csv"
+    path.write_bytes(path.read_bytes() + b"40000,late,x\n")
+
+    with pytest.raises(Exception, match="status 200"):
+        read_all(download)
+    full_file = [(response, kwargs) for response, kwargs in answers if 'If-Range' in kwargs['headers'] and response.status_code == 200]
+    assert full_file
+    # the whole file was closed unread
+    for response, kwargs in full_file:
+        assert kwargs['stream'] is True
+        assert not response._content_consumed
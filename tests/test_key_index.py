@@ -0,0 +1,130 @@
+# The key filter: dropping known keys, and its snapshot plus delta persistence
+import os
+import duckdb
+import numpy as np
+import pyarrow as pa
+import pytest
+from shared import key_index
+from shared import schema_registry
+from shared import storage_io
+
+stage_table = "requests"
+key_types = {'case_enquiry_id': 'VARCHAR'}
+
+
+@pytest.fixture
+def md():
+    con = duckdb.connect()
+    con.execute(f"ATTACH ':memory:' AS {schema_registry.db}")
+    con.execute(f"CREATE SCHEMA {schema_registry.db_schema}")
+    con.execute(f"CREATE TABLE {schema_registry.db_schema}.{stage_table} (case_enquiry_id VARCHAR PRIMARY KEY, location VARCHAR)")
+    con.execute(f"INSERT INTO {schema_registry.db_schema}.{stage_table} VALUES ('1', 'a'), ('2', 'b'), ('3', NULL)")
+    yield con
+    con.close()
+
+def batch(ids, locations=None):
+    locations = locations or ['x'] * len(ids)
+    return pa.RecordBatch.from_pydict({'case_enquiry_id': ids, 'location': locations})
+
+def kept(index, ids, locations=None):
+    return index.filter(batch(ids, locations)).column('case_enquiry_id').to_pylist()
+
+def delta_files(bucket):
+    return sorted(os.path.basename(obj['uri']) for obj in storage_io.list_objects(key_index.delta_uri(bucket, stage_table)))
+
+
+def test_contains():
+    sorted_hashes = np.array([3, 7, 11], dtype=np.uint64)
+
+    assert key_index.contains(sorted_hashes, np.array([7, 8, 11, 12], dtype=np.uint64)).tolist() == [True, False, True, False]
+    assert key_index.contains(np.empty(0, dtype=np.uint64), np.array([1], dtype=np.uint64)).tolist() == [False]
+
+def test_filter_drops_known_keys_and_repeats(md, bucket):
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 0)
+
+    assert source == 'rebuilt'
+    assert kept(index, ['1', '4', '4', '5']) == ['4', '5']
+    assert kept(index, ['5', '6']) == ['6']
+    assert index.stats['known'] == 1
+    assert index.stats['duplicates'] == 2
+
+def test_batch_keys_hash_like_stage_keys(md, bucket):
+    # an integer key in the batch is cast to the stage type before it is hashed
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    ints = pa.RecordBatch.from_pydict({'case_enquiry_id': pa.array([1, 4], pa.int64()), 'location': ['x', 'y']})
+
+    assert index.filter(ints).column('case_enquiry_id').to_pylist() == [4]
+
+def test_fill_columns_keep_sending_rows_without_them(md, bucket):
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0, ['location'])
+
+    # '3' is in stage without a location, so it is not in the index
+    assert kept(index, ['1', '3', '7'], ['a', 'c', None]) == ['3', '7']
+    # '7' came without a location, it stays out of the index too
+    assert index.added.tolist() == index.batch_hashes(batch(['3'])).tolist()
+
+def test_snapshot_then_deltas(md, bucket):
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    kept(index, ['4'])
+    key_index.save_index(bucket, index, 1)
+    assert storage_io.exists(key_index.index_uri(bucket, stage_table))
+    assert delta_files(bucket) == []
+
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 1)
+    assert source == 'memory'
+    kept(index, ['5'])
+    key_index.save_index(bucket, index, 2)
+    key_index.save_delta(bucket, stage_table, 3)
+    assert delta_files(bucket) == ['2.npz', '3.npz']
+
+    key_index._indexes.clear()
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 3)
+    assert source == 'bucket+deltas'
+    assert kept(index, ['1', '4', '5', '6']) == ['6']
+
+def test_memory_copy_catches_up_with_deltas(md, bucket):
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    key_index.save_index(bucket, index, 1)
+    key_index.save_delta(bucket, stage_table, 2, index.batch_hashes(batch(['9'])))
+
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 2)
+
+    assert source == 'memory+deltas'
+    assert kept(index, ['9', '10']) == ['10']
+
+def test_missing_delta_rebuilds(md, bucket):
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    key_index.save_index(bucket, index, 1)
+    # version 2 was bumped by a load that could not save its keys
+    key_index.save_delta(bucket, stage_table, 3)
+    md.execute(f"INSERT INTO {schema_registry.db_schema}.{stage_table} VALUES ('8', 'h')")
+
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 3)
+
+    assert source == 'rebuilt'
+    assert kept(index, ['8']) == []
+
+def test_snapshot_is_rewritten_every_compact_every_deltas(md, bucket, monkeypatch):
+    monkeypatch.setattr(key_index, 'compact_every', 2)
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    key_index.save_index(bucket, index, 1)
+    for version in (2, 3):
+        index, _ = key_index.get_index(md, bucket, stage_table, key_types, version - 1)
+        kept(index, [str(10 + version)])
+        key_index.save_index(bucket, index, version)
+
+    assert delta_files(bucket) == []
+    key_index._indexes.clear()
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 3)
+    assert source == 'bucket'
+    assert kept(index, ['12', '13', '14']) == ['14']
+
+def test_snapshot_of_other_fill_columns_is_not_used(md, bucket):
+    index, _ = key_index.get_index(md, bucket, stage_table, key_types, 0)
+    key_index.save_index(bucket, index, 1)
+    key_index._indexes.clear()
+
+    index, source = key_index.get_index(md, bucket, stage_table, key_types, 1, ['location'])
+
+    assert source == 'rebuilt'
+    assert kept(index, ['3']) == ['3']
@@ -0,0 +1,137 @@
+# Load: resuming a job that failed midway, and rerunning a job that finished
+import datetime
+import duckdb
+import pyarrow as pa
+import pytest
+import backends
+from shared import connections
+from shared import key_index
+from shared import schema_registry
+
+load = backends.load_function("load")
+
+case_ids = [str(101 + i) for i in range(6)]
+
+
+@pytest.fixture
+def md(tmp_path, monkeypatch):
+    monkeypatch.setattr(load, 'chunk_rows', 2)
+    con = duckdb.connect()
+    connections._load_spatial(con)
+    con.execute(f"ATTACH '{tmp_path / 'stage.duckdb'}' AS {schema_registry.db}")
+    schema_registry.migrate(con)
+    load.prepare_raw_schema(con)
+    yield con
+    con.close()
+
+@pytest.fixture
+def sources():
+    opened = datetime.datetime(2024, 3, 5, 8)
+    return {
+        'requests': pa.table({
+            'case_enquiry_id': case_ids,
+            'subject': ['Public Works', 'Transportation'] * 3,
+            'location': [f"{i} Main St" for i in range(6)],
+        }),
+        'department_assignment': pa.table({
+            'case_enquiry_id': case_ids,
+            'department': ['PWDx', 'BTDT'] * 3,
+        }),
+        'status_history': pa.table({
+            'case_enquiry_id': case_ids,
+            'open_dt': [opened] * 6,
+            'sla_target_dt': [opened + datetime.timedelta(days=2)] * 6,
+            'closed_dt': [opened + datetime.timedelta(days=1)] * 3 + [None] * 3,
+            'case_status': ['Closed'] * 3 + ['Open'] * 3,
+        }),
+    }
+
+# the ingest of the given sources stops with an error after their first chunk committed
+def fail_after_first_chunk(monkeypatch, failing):
+    source_chunks = load.source_chunks
+
+    def chunks(source, columns, rows_per_chunk):
+        for number, chunk in enumerate(source_chunks(source, columns, rows_per_chunk)):
+            if number == 1 and any(source is f for f in failing):
+                raise duckdb.IOException("connection lost")
+            yield chunk
+
+    monkeypatch.setattr(load, 'source_chunks', chunks)
+
+def count(md, table, schema=schema_registry.db_schema):
+    return md.execute(f"SELECT count(*) FROM {schema}.{table}").fetchone()[0]
+
+
+def test_failed_load_resumes_without_losing_or_duplicating_rows(md, bucket, sources, monkeypatch):
+    with monkeypatch.context() as patch:
+        fail_after_first_chunk(patch, [sources['requests'], sources['status_history']])
+        with pytest.raises(duckdb.IOException):
+            load.load_tables(md, sources, job_id="job-1")
+
+    markers = load.table_status(md, "job-1")
+    assert {name: marker['status'] for name, marker in markers.items()} == {
+        'requests': 'failed', 'status_history': 'failed', 'department_assignment': 'done'}
+    assert load.committed_chunks(md, "job-1", f"{load.raw_db_schema}.requests") == {0: 2}
+    assert count(md, 'requests') == 0
+
+    results = load.load_tables(md, sources, job_id="job-1")
+
+    assert {name: result['status'] for name, result in results.items()} == {
+        'requests': 'loaded', 'status_history': 'loaded', 'department_assignment': 'skipped', 'response_time': 'loaded'}
+    # the committed chunk is kept, the rest is ingested once
+    assert results['requests']['raw_rows'] == 6
+    assert count(md, 'requests', load.raw_db_schema) == 6
+    assert count(md, 'status_history', load.raw_db_schema) == 6
+    for table in ('requests', 'department_assignment', 'status_history', 'response_time'):
+        assert count(md, table) == 6
+    assert {name: marker['status'] for name, marker in load.table_status(md, "job-1").items()} == {
+        'requests': 'done', 'status_history': 'done', 'department_assignment': 'done', 'response_time': 'done'}
+
+def test_resumed_key_filter_is_not_saved_as_exact(md, bucket, sources, monkeypatch):
+    with monkeypatch.context() as patch:
+        fail_after_first_chunk(patch, [sources['requests']])
+        with pytest.raises(duckdb.IOException):
+            load.load_tables(md, sources, job_id="job-1")
+    load.load_tables(md, sources, job_id="job-1")
+
+    # the resumed filter never saw the keys of the committed chunk, the next load rebuilds it from stage
+    index, source = key_index.get_index(md, bucket, 'requests', {'case_enquiry_id': 'VARCHAR'},
+                                         key_index.current_version(md), ['location'])
+    assert source == 'rebuilt'
+    assert index.filter(sources['requests'].to_batches()[0]).num_rows == 0
+
+def test_rerun_of_a_finished_job_is_a_no_op(md, bucket, sources):
+    load.load_tables(md, sources, job_id="job-1")
+    versions = (schema_registry.read_data_version(md), key_index.current_version(md))
+    stage = md.execute(f"SELECT * FROM {schema_registry.db_schema}.status_history ORDER BY case_enquiry_id").fetchall()
+
+    results = load.load_tables(md, sources, job_id="job-1")
+
+    assert {result['status'] for result in results.values()} == {'skipped'}
+    assert (schema_registry.read_data_version(md), key_index.current_version(md)) == versions
+    assert md.execute(f"SELECT * FROM {schema_registry.db_schema}.status_history ORDER BY case_enquiry_id").fetchall() == stage
+    assert count(md, 'requests') == 6
+
+def test_response_time_is_derived_for_changed_cases_only(md, bucket, sources):
+    load.load_tables(md, sources, job_id="job-1")
+
+    # the next batch brings every case again, one of them closed since
+    history = sources['status_history'].to_pydict()
+    history['closed_dt'][3] = history['open_dt'][3] + datetime.timedelta(days=3)
+    history['case_status'][3] = 'Closed'
+    results = load.load_tables(md, {'status_history': pa.table(history)}, job_id="job-2")
+
+    assert results['status_history']['raw_rows'] == 6
+    assert results['response_time']['raw_rows'] == 1
+    assert md.execute(f"""
+    SELECT on_time, time_to_close_hours FROM {schema_registry.db_schema}.response_time WHERE case_enquiry_id = ?
+    """, [case_ids[3]]).fetchone() == (False, 72.0)
+
+def test_without_dimension_text_the_decoded_views_read_the_text(md, bucket, sources, monkeypatch):
+    monkeypatch.setattr(load, 'keep_dimension_text', False)
+    load.load_tables(md, sources, job_id="job-1")
+
+    stored = md.execute(f"SELECT DISTINCT subject, subject_key IS NOT NULL FROM {schema_registry.db_schema}.requests").fetchall()
+    assert stored == [(None, True)]
+    decoded = md.execute(f"SELECT case_enquiry_id, subject FROM {schema_registry.db_schema}.requests_decoded ORDER BY ALL").fetchall()
+    assert decoded == list(zip(case_ids, ['Public Works', 'Transportation'] * 3))
@@ -0,0 +1,78 @@
+# Parameter validation of the query function, and its read-only connection
+import duckdb
+import pytest
+import backends
+from shared import connections
+from shared import schema_registry
+
+query = backends.load_function('query')
+
+
+# request stand-in with the JSON body of a call
+class FakeRequest:
+    def __init__(self, body):
+        self.body = body
+
+    def get_json(self, silent=False):
+        return self.body
+
+
+@pytest.mark.parametrize("name, params, message", [
+    ('case', {}, "missing parameter: case_enquiry_id"),
+    ('district_counts', {'district': 'ward; DROP TABLE x', 'open_from': '2024-01-01', 'open_to': '2024-01-31'}, "district must be one of"),
+    ('district_counts', {'open_from': '2024-13-01', 'open_to': '2024-01-31'}, "open_from must be a date"),
+    ('sla_summary', {'group_by': 'subject', 'open_from': '2024-01-01', 'open_to': '2024-01-31'}, "group_by must be one of"),
+    ('sla_summary', {'open_from': '2024-01-01'}, "missing parameter: open_to"),
+])
+def test_bad_parameters_are_rejected(name, params, message):
+    with pytest.raises(ValueError, match=message):
+        query.queries[name](params)
+
+def test_unknown_query_is_rejected():
+    with pytest.raises(ValueError, match="unknown query"):
+        query.run_query('drop_everything', {})
+
+def test_bad_request_answers_400():
+    body, status = query.main(FakeRequest({'query': 'sla_summary', 'params': {'group_by': 'x'}}))
+
+    assert status == 400
+    assert body['queries'] == list(query.queries)
+
+def test_column_parameters_default_and_dates_are_bound():
+    sql, args = query.district_counts_sql({'open_from': '2024-01-01', 'open_to': '2024-01-31'})
+
+    assert "l.neighborhood AS district" in sql
+    assert [str(arg) for arg in args] == ['2024-01-01', '2024-01-31']
+
+
+@pytest.fixture
+def local_stage(tmp_path, monkeypatch):
+    path = str(tmp_path / "stage.duckdb")
+    con = duckdb.connect()
+    con.execute(f"ATTACH '{path}' AS {schema_registry.db}")
+    con.execute(f"CREATE SCHEMA {schema_registry.db_schema}")
+    con.execute(f"CREATE TABLE {schema_registry.db_schema}.t AS SELECT 1 AS x")
+    con.close()
+    monkeypatch.setattr(connections, 'local_duckdb_path', path)
+    monkeypatch.setattr(connections, '_motherduck', {'connection': None, 'last_used': 0.0})
+    monkeypatch.setattr(connections, '_motherduck_readonly', {'connection': None, 'last_used': 0.0})
+    yield path
+    connections.reset_motherduck_readonly()
+    connections.reset_motherduck()
+
+def test_readonly_connection_cannot_write(local_stage):
+    md = connections.get_motherduck_readonly()
+
+    assert md.execute(f"SELECT x FROM {schema_registry.db_schema}.t").fetchall() == [(1,)]
+    with pytest.raises(duckdb.Error):
+        md.execute(f"INSERT INTO {schema_registry.db_schema}.t VALUES (2)")
+
+def test_readonly_connection_is_cached(local_stage):
+    assert connections.get_motherduck_readonly() is connections.get_motherduck_readonly()
+
+def test_pooled_cursors_come_from_the_readonly_connection(local_stage, monkeypatch):
+    monkeypatch.setattr(query, '_pool', {'connection': None, 'cursors': None})
+    with query.pooled_cursor() as cur:
+        with pytest.raises(duckdb.Error):
+            cur.execute(f"DELETE FROM {schema_registry.db_schema}.t")
+    assert query._pool['connection'] is connections.get_motherduck_readonly()
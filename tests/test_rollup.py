@@ -0,0 +1,75 @@
+# Rollups: the incremental update after each load against a rebuild from the stage tables
+import datetime
+import duckdb
+import pyarrow as pa
+import pytest
+import backends
+from shared import connections
+from shared import schema_registry
+
+load = backends.load_function("load")
+rollup = backends.load_function("rollup")
+
+opened = datetime.datetime(2024, 3, 5, 8)
+
+
+@pytest.fixture
+def md(tmp_path):
+    con = duckdb.connect()
+    connections._load_spatial(con)
+    con.execute(f"ATTACH '{tmp_path / 'stage.duckdb'}' AS {schema_registry.db}")
+    schema_registry.migrate(con)
+    load.prepare_raw_schema(con)
+    yield con
+    con.close()
+
+# the tables of a batch of cases, case i opened on day i % 3 in one of two neighborhoods
+def batch(ids, closed_after_days):
+    return {
+        'requests': pa.table({
+            'case_enquiry_id': [str(i) for i in ids],
+            'subject': ['Public Works'] * len(ids),
+            'location': [f"{i % 2} Main St" for i in ids],
+        }),
+        'location': pa.table({
+            'location': ['0 Main St', '1 Main St'],
+            'neighborhood': ['Dorchester', 'Roxbury'],
+        }),
+        'department_assignment': pa.table({
+            'case_enquiry_id': [str(i) for i in ids],
+            'department': ['PWDx' if i % 2 else 'BTDT' for i in ids],
+        }),
+        'status_history': pa.table({
+            'case_enquiry_id': [str(i) for i in ids],
+            'open_dt': [opened + datetime.timedelta(days=i % 3) for i in ids],
+            'sla_target_dt': [opened + datetime.timedelta(days=i % 3 + 2) for i in ids],
+            'closed_dt': [None if days is None else opened + datetime.timedelta(days=i % 3 + days)
+                          for i, days in zip(ids, closed_after_days)],
+            'case_status': ['Open' if days is None else 'Closed' for days in closed_after_days],
+        }),
+    }
+
+def rollup_rows(md, table):
+    return md.execute(f"SELECT * FROM {schema_registry.db_schema}.{table} ORDER BY ALL").fetchall()
+
+
+def test_incremental_update_matches_a_rebuild_after_cases_close(md, bucket):
+    load.load_tables(md, batch(range(12), [1, None, 3, None] * 3), job_id="job-1")
+    rollup.update_rollups(md)
+
+    # the delta closes the open cases, one of them late, and brings two new ones
+    load.load_tables(md, batch([1, 3, 5, 7, 9, 11, 12, 13], [1, 4, 1, 1, 1, 1, None, 2]), job_id="job-2")
+    result = rollup.update_rollups(md)
+    assert result['cases'] == 8
+
+    report = rollup.reconcile(md)
+    assert report['mismatched_groups'] == 0
+    assert report['requests_without_location'] == 0
+    incremental = {table: rollup_rows(md, table) for table in ('rollup_cases', 'rollup_daily')}
+
+    rollup.rebuild_rollups(md)
+
+    assert {table: rollup_rows(md, table) for table in ('rollup_cases', 'rollup_daily')} == incremental
+    daily = md.execute(f"SELECT sum(requests), sum(open_requests), sum(closed_requests) FROM {schema_registry.db_schema}.rollup_daily").fetchone()
+    assert daily == (14, 1, 13)
+    assert md.execute(f"SELECT count(*) FROM {schema_registry.db_schema}.rollup_daily WHERE neighborhood_key = 0").fetchone()[0] == 0
@@ -0,0 +1,80 @@
+# Migrating a stage schema created by the original schema-setup function to the registry
+import duckdb
+import pytest
+from shared import connections
+from shared import schema_registry
+
+# the stage tables as the first schema-setup function created them
+baseline_ddl = [
+    """CREATE TABLE {db_schema}.requests (
+        _id INT, case_enquiry_id VARCHAR, case_title VARCHAR, subject VARCHAR, reason VARCHAR, type VARCHAR,
+        queue VARCHAR, source VARCHAR, submitted_photo VARCHAR, closed_photo VARCHAR,
+        PRIMARY KEY (case_enquiry_id))""",
+    """CREATE TABLE {db_schema}.locations (
+        location VARCHAR, fire_district VARCHAR, pwd_district VARCHAR, city_council_district VARCHAR,
+        police_district VARCHAR, neighborhood VARCHAR, neighborhood_services_district VARCHAR, ward VARCHAR,
+        precinct VARCHAR, location_street_name VARCHAR, location_zipcode VARCHAR, latitude FLOAT, longitude FLOAT,
+        geom_4326 GEOMETRY, PRIMARY KEY (location))""",
+    """CREATE TABLE {db_schema}.department_assignment (
+        case_enquiry_id VARCHAR, department VARCHAR, PRIMARY KEY (case_enquiry_id, department))""",
+    """CREATE TABLE {db_schema}.status_history (
+        case_enquiry_id VARCHAR, open_dt TIMESTAMP, sla_target_dt TIMESTAMP, closed_dt TIMESTAMP,
+        case_status VARCHAR, closure_reason VARCHAR, PRIMARY KEY (case_enquiry_id, open_dt))""",
+    """CREATE TABLE {db_schema}.response_time (
+        case_enquiry_id VARCHAR, on_time BOOLEAN, PRIMARY KEY (case_enquiry_id))""",
+]
+
+
+@pytest.fixture
+def md(tmp_path):
+    con = duckdb.connect()
+    connections._load_spatial(con)
+    con.execute(f"ATTACH '{tmp_path / 'stage.duckdb'}' AS {schema_registry.db}")
+    yield con
+    con.close()
+
+@pytest.fixture
+def baseline(md):
+    md.execute(f"CREATE SCHEMA {schema_registry.db_schema}")
+    for ddl in baseline_ddl:
+        md.execute(ddl.format(db_schema=schema_registry.db_schema))
+    md.execute(f"INSERT INTO {schema_registry.db_schema}.requests (case_enquiry_id, subject) VALUES ('101', 'Public Works')")
+    md.execute(f"INSERT INTO {schema_registry.db_schema}.response_time VALUES ('101', true)")
+    return md
+
+def columns(md, table):
+    return [(row[0], row[1]) for row in md.execute(f"DESCRIBE {schema_registry.db_schema}.{table}").fetchall()]
+
+
+def test_migrate_baseline_schema_to_registry(baseline):
+    result = schema_registry.migrate(baseline)
+
+    assert result['status'] == 'migrated'
+    assert set(result['tables']) == set(schema_registry.tables)
+    for name in schema_registry.tables:
+        assert {col for col, _ in columns(baseline, name)} == {col for col, _ in schema_registry.tables[name]['columns']}
+
+def test_migrate_keeps_existing_rows(baseline):
+    schema_registry.migrate(baseline)
+
+    assert baseline.execute(f"SELECT case_enquiry_id, subject, location FROM {schema_registry.db_schema}.requests").fetchall() == [('101', 'Public Works', None)]
+    assert baseline.execute(f"SELECT on_time, time_to_close_hours FROM {schema_registry.db_schema}.response_time").fetchall() == [(True, None)]
+
+def test_migrate_again_is_unchanged(baseline):
+    schema_registry.migrate(baseline)
+
+    assert schema_registry.migrate(baseline) == {'status': 'unchanged', 'tables': []}
+
+def test_migrate_empty_database(md):
+    result = schema_registry.migrate(md)
+
+    assert result['status'] == 'migrated'
+    assert schema_registry.read_data_version(md) == 0
+
+def test_primary_key_change_is_refused(baseline, monkeypatch):
+    schema_registry.migrate(baseline)
+    spec = {**schema_registry.tables['department_assignment'], 'primary_key': ['case_enquiry_id']}
+    monkeypatch.setitem(schema_registry.tables, 'department_assignment', spec)
+
+    with pytest.raises(Exception, match=r"department_assignment has primary key \(case_enquiry_id, department\)"):
+        schema_registry.migrate(baseline)
@@ -0,0 +1,52 @@
+# Transform: reprocessing a range of partitions that holds several versions of a key
+import datetime
+import duckdb
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+import backends
+from shared import telemetry
+
+extract = backends.load_function("extract")
+transform = backends.load_function("transform")
+
+
+def feed_rows(status, closed_dt, extracted_at):
+    return pd.DataFrame({
+        'case_enquiry_id': ['101', '102'],
+        'open_dt': ['2024-03-05 08:00:00', '2024-03-06 09:00:00'],
+        'closed_dt': [closed_dt, None],
+        'case_status': [status, 'Open'],
+    }).assign(extracted_at=extracted_at)
+
+def write_run(df, job_id, output_format):
+    extract.write_partitions(df, extract.to_arrow_table(df), job_id, output_format, telemetry.Telemetry('extract'))
+
+
+def test_stamp_extracted_at():
+    df = extract.stamp_extracted_at(pd.DataFrame({'case_enquiry_id': ['1']}))
+
+    assert extract.to_arrow_table(df).schema.field('extracted_at').type == extract.parquet_types['extracted_at']
+
+@pytest.mark.parametrize("output_format", ["parquet", "json"])
+def test_reprocess_keeps_the_most_recent_version(bucket, tmp_path, output_format):
+    # the later run closes case 101, its file sorts first by name
+    write_run(feed_rows('Open', None, '2024-03-05T10:00:00.000000'), "zz-first-run", output_format)
+    write_run(feed_rows('Closed', '2024-03-07 12:00:00', '2024-03-08T10:00:00.000000'), "aa-second-run", output_format)
+    # a file from before extract stamped its rows loses to both
+    write_run(feed_rows('Open', None, None).drop(columns='extracted_at'), "00-legacy-run", output_format)
+
+    input_files = transform.input_paths({'open_from': '2024-03'})
+    assert len(input_files) == 3
+
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    con = duckdb.connect()
+    outputs = transform.split_tables(con, input_files, str(out_dir))
+    con.close()
+
+    history = pq.read_table(outputs['status_history']['file']).to_pandas().set_index('case_enquiry_id')
+    assert outputs['status_history']['rows'] == 2
+    assert history.loc['101', 'case_status'] == 'Closed'
+    assert history.loc['101', 'closed_dt'] == datetime.datetime(2024, 3, 7, 12)
+    assert outputs['requests']['rows'] == 2